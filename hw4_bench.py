@@ -0,0 +1,1367 @@
+#
+# hw4_bench.py
+# Written by: Daniel Dukeshire, Thomas Durkin, Chris Pence, Chris Allen
+# Date: 11.30.2020
+# Benchmarks for the control server. Each one launches hw4_control.py locally,
+# drives it over the sensor protocol, and prints a table of the results.
+#
+# Usage: python3 hw4_bench.py [benchmark] [--flags]
+#   engines   Connection scaling and command throughput of --engine=select vs --engine=selectors
+#             --sensors=100,500,1000,2000  --rounds=20  --topology=hw4_3_by_3.txt  --json=[file]
+#   shards    UPDATEPOSITION throughput of one process vs --shards=N, and the CPU time per move of the
+#             front and of the workers. The front's bounds the throughput however many cores there are
+#             --shards=1,2,4  --sensors=200  --rounds=50  --side=100  --range=15  --json=[file]
+#   batch     Moves per second from one gateway connection, sent as UPDATEPOSITION round trips
+#             vs UPDATEPOSITIONS batches of each size
+#             --batch=1,10,100  --sensors=500  --rounds=20  --side=100  --range=15  --json=[file]
+#   codec     Encode and decode time and size of each message, text strings vs the binary codec
+#             --neighbours=0,8,64  --count=20000  --json=[file]
+#   startup   Time for the server to start on a grid of side x side base stations: parsing the text,
+#             the first start that also writes the snapshot, and starting from the snapshot
+#             --side=100,300,1000  --json=[file]
+#   load      Throughput and p50/p99 latency of MOVE, SENDDATA and WHERE from a fleet of sensors
+#             --sensors=100  --rate=0 (commands/s, 0 for flat out)  --seconds=10  --range=15
+#             --mix=move:50,senddata:25,where:25  --burst=1 (UPDATEPOSITIONs per move)
+#             --server=--engine=selectors,[more flags]  --topology=grid|geometric|[file]  --json=[file]
+#   gateway   CPU time and peak memory per sensor, of the sensors and of the server, for a hw4_client.py
+#             process per sensor vs one hw4_gateway.py hosting them all, each sensor making the same moves
+#             --sensors=25,100  --rounds=20  --side=50  --range=15  --json=[file]
+#   verify    Randomized checks that the faster paths give exactly what the plain ones do: the looped dfs()
+#             against the recursive original, UPDATEPOSITIONS against the same moves one at a time,
+#             --storage=arrays against dicts, and --shards=N against one process, moves raced against routes
+#             included. Exits with 1 on a difference
+#             --seeds=10  --seed=1 (the first)  --sensors=12  --steps=60  --shards=2,3  --json=[file]
+#   topology  Writes a base station file: --out=[file]
+#             --topology=grid  --side=50  --spacing=10
+#             --topology=geometric  --stations=2500  --radius=15  --degree=6  --seed=1
+#
+# python3 hw4_bench.py compare [old.json] [new.json] prints two --json runs side by side.
+#
+
+import sys
+import os
+import time
+import math
+import random
+import tempfile
+import io
+import collections
+import json
+import socket
+import selectors
+import resource
+import subprocess
+from hw4_protocol import FrameReader, TextCodec, BinaryCodec, frame, splitOptions
+from hw4_topology import SNAPSHOT_SUFFIX, parseTopology
+from hw4_events import EventLog, TextSink
+import hw4_control as control
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+#
+# freePort()
+# Returns a TCP port nothing is listening on.
+#
+def freePort():
+    probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    probe.bind(('', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    return port
+
+#
+# raiseFileLimit()
+# Lifts the soft open-file limit to the hard one, for this process and the servers it launches.
+#
+def raiseFileLimit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+#
+# launchServer()
+# Starts hw4_control.py on a free port with the given base station file and flags,
+# and returns the process and the port once it accepts connections.
+#
+def launchServer(topology, flags):
+    port = freePort()
+    command = [sys.executable, os.path.join(here, 'hw4_control.py'), str(port), topology] + flags
+    process = subprocess.Popen(command, cwd=here, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.PIPE, text=True)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('localhost', port)).close()
+            return process, port
+        except ConnectionRefusedError:
+            if process.poll() is not None:
+                break
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError('control server did not start: ' + process.stderr.read())
+
+#
+# stopServer()
+# Sends QUIT to a launched server, and returns True if it exited cleanly on it.
+#
+def stopServer(process):
+    try:
+        process.stdin.write('QUIT\n')
+        process.stdin.flush()
+        process.wait(timeout=10)
+    except (BrokenPipeError, subprocess.TimeoutExpired):
+        process.kill()
+        process.wait()
+    return process.returncode == 0
+
+#
+# class SensorPool
+# Many framed sensor connections to one server, driven from a single selector. Each sensor
+# has at most one request outstanding; request() sends one and run() waits for the replies.
+#
+class SensorPool(object):
+    def __init__(self, port, count, prefix='bench'):
+        self.selector = selectors.DefaultSelector()
+        self.sockets = []
+        self.readers = {}
+        self.waiting = {}                                           # Socket: number of replies still owed to it
+        for n in range(count):
+            client = socket.create_connection(('localhost', port))
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.sockets.append(client)
+            self.readers[client] = FrameReader()
+            self.waiting[client] = 0
+            self.selector.register(client, selectors.EVENT_READ)
+        self.ids = ['{}{}'.format(prefix, n) for n in range(count)]
+
+    def request(self, index, message, replies=1):                   # Sends a message that the server answers
+        client = self.sockets[index]
+        client.sendall(frame(message, True))
+        self.waiting[client] += replies
+
+    def run(self, on_reply=None, timeout=120):                      # Reads until no replies are owed; on_reply(index, frame) may send more
+        index = {client: n for n, client in enumerate(self.sockets)}
+        owed = sum(self.waiting.values())
+        deadline = time.time() + timeout
+        while owed > 0:
+            if time.time() > deadline:
+                raise RuntimeError('timed out with {} replies outstanding'.format(owed))
+            for key, mask in self.selector.select(1):
+                client = key.fileobj
+                data = client.recv(65536)
+                if not data:
+                    raise RuntimeError('the control server hung up')
+                for message in self.readers[client].feed(data):
+                    self.waiting[client] -= 1
+                    owed -= 1
+                    if on_reply is not None:
+                        before = self.waiting[client]
+                        on_reply(index[client], message)
+                        owed += self.waiting[client] - before
+
+    def close(self):
+        for client in self.sockets:
+            self.selector.unregister(client)
+            client.close()
+        self.selector.close()
+
+#
+# class LoadGenerator
+# A fleet of headless sensors on one server, speaking the framed text protocol the way
+# hw4_client.py does, from a single selector. run() has them carry out a random mix of commands
+# at a set rate, each sensor one command at a time, and records how long each one took:
+#   move      UPDATEPOSITION to a random spot, until the REACHABLE. With burst above 1, the
+#             sensor gets there in that many steps, sending them all at once as a moving
+#             sensor would, and the move is done at the last of their REACHABLEs
+#   where     WHERE a random node, until the THERE
+#   senddata  UPDATEPOSITION, then DATAMESSAGE to a random node, as SENDDATA does. The server
+#             does not answer a DATAMESSAGE, so a WHERE is sent behind it, and the command is
+#             done at the THERE, once the server has played the message out.
+# DATAMESSAGEs the server pushes to a sensor on a route are counted as deliveries.
+# A command's time is counted from when it was due, not when a sensor was free to send it, so
+# a server that falls behind the rate is charged for the wait.
+#
+class LoadGenerator(object):
+    def __init__(self, port, count, sensor_range, extent, prefix='load', burst=1):
+        self.selector = selectors.DefaultSelector()
+        self.sockets = []
+        self.codecs = {}
+        self.index = {}
+        for n in range(count):
+            client = socket.create_connection(('localhost', port))
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.sockets.append(client)
+            self.codecs[client] = TextCodec(True)
+            self.index[client] = n
+            self.selector.register(client, selectors.EVENT_READ)
+        self.ids = ['{}{}'.format(prefix, n) for n in range(count)]
+        self.sensor_range = sensor_range
+        self.extent = extent
+        self.burst = burst
+        self.positions = [(0, 0)] * count
+        self.reachable = [()] * count                                # The IDs in each sensor's last REACHABLE
+        self.pending = {}                                           # Sensor: [command, due, the reply it waits for, destination, how many of it]
+        self.deliveries = 0
+
+    def send(self, n, data):
+        self.sockets[n].sendall(data)
+
+    def move(self, n, scatter, steps=1):                            # Sends UPDATEPOSITIONs, to a random spot if scatter is given
+        codec = self.codecs[self.sockets[n]]
+        x, y = self.positions[n]
+        if scatter is not None:
+            self.positions[n] = (scatter.randrange(self.extent), scatter.randrange(self.extent))
+        data = []
+        for step in range(1, steps + 1):                            # Evenly along the way, the last step where it ends up
+            data.append(codec.updatePosition(self.ids[n], self.sensor_range, x + (self.positions[n][0] - x) * step // steps,
+                                             y + (self.positions[n][1] - y) * step // steps))
+        self.send(n, b''.join(data))
+
+    def register(self, scatter):                                    # Places every sensor, and waits for all of them to be in
+        for n in range(len(self.sockets)):
+            self.pending[n] = ['register', None, 'REACHABLE', None, 1]
+            self.move(n, scatter)
+        self.wait(lambda: self.pending, None)
+
+    def issue(self, n, command, due, scatter, targets):
+        if command == 'move':
+            self.pending[n] = [command, due, 'REACHABLE', None, self.burst]
+            self.move(n, scatter, self.burst)
+        elif command == 'where':
+            self.pending[n] = [command, due, 'THERE', None, 1]
+            self.send(n, self.codecs[self.sockets[n]].where(scatter.choice(targets)))
+        elif command == 'senddata':
+            self.pending[n] = [command, due, 'REACHABLE', scatter.choice(targets), 1]
+            self.move(n, None)                                      # From where it is, as SENDDATA does
+        else:
+            raise ValueError('unknown command: ' + command)
+
+    def answer(self, n, message):                                   # Takes a reply, and returns the command it finished, if any
+        state = self.pending.get(n)
+        if state is None or message[0] != state[2]:
+            raise RuntimeError('{} got an unexpected {}'.format(self.ids[n], message[0]))
+        if message[0] == 'REACHABLE':
+            self.reachable[n] = [entry[0] for entry in message[2]]
+        state[4] -= 1
+        if state[4]:                                                # More of a burst's REACHABLEs to come
+            return None
+        if state[0] == 'senddata' and state[2] == 'REACHABLE':
+            destination = state[3]
+            codec = self.codecs[self.sockets[n]]
+            next_id = destination if destination in self.reachable[n] else '-1'
+            self.send(n, codec.dataMessage(self.ids[n], next_id, destination, [self.ids[n]]) + codec.where(destination))
+            state[2] = 'THERE'
+            state[4] = 1
+            return None
+        del self.pending[n]
+        return state
+
+    def wait(self, busy, on_done, timeout=120):                     # Reads replies while busy() is true; on_done(n, state) for each finished command
+        deadline = time.time() + timeout
+        while busy():
+            if time.time() > deadline:
+                raise RuntimeError('timed out with {} commands outstanding'.format(len(self.pending)))
+            self.poll(on_done, 1)
+
+    def poll(self, on_done, timeout):                               # Handles whatever arrives within timeout seconds
+        for key, mask in self.selector.select(timeout):
+            client = key.fileobj
+            data = client.recv(65536)
+            if not data:
+                raise RuntimeError('the control server hung up')
+            n = self.index[client]
+            for message in self.codecs[client].feed(data):
+                if message[0] == 'DATAMESSAGE':                     # Pushed along a route, not a reply
+                    self.deliveries += 1
+                    continue
+                state = self.answer(n, message)
+                if state is not None and on_done is not None:
+                    on_done(n, state)
+
+    def run(self, mix, rate, seconds, targets, seed=1):            # Returns {command: [latency seconds...]} and the elapsed time
+        scatter = random.Random(seed)
+        names = [name for name, weight in mix]
+        weights = [weight for name, weight in mix]
+        latencies = {name: [] for name in names}
+        idle = collections.deque(range(len(self.sockets)))
+        def done(n, state):
+            latencies[state[0]].append(time.perf_counter() - state[1])
+            idle.append(n)
+        issued = 0
+        start = time.perf_counter()
+        end = start + seconds
+        while True:
+            now = time.perf_counter()
+            due = start + issued / rate if rate else now
+            while idle and now < end and due <= now:
+                self.issue(idle.popleft(), scatter.choices(names, weights)[0], due, scatter, targets)
+                issued += 1
+                due = start + issued / rate if rate else now
+            if now >= end:
+                break
+            self.poll(done, max(0, min(due, end) - now) if idle else min(1, end - now))
+        self.wait(lambda: self.pending, done)                       # Let the last commands finish
+        return latencies, time.perf_counter() - start
+
+    def close(self):
+        for client in self.sockets:
+            self.selector.unregister(client)
+            client.close()
+        self.selector.close()
+
+#
+# percentile()
+# Takes a sorted list of numbers and a percentage, and returns the nearest-rank percentile.
+#
+def percentile(values, percent):
+    if not values:
+        return None
+    return values[max(0, math.ceil(percent / 100.0 * len(values)) - 1)]
+
+#
+# benchEngines()
+# For each engine and each sensor count: times connecting that many sensors and getting all of
+# their first UPDATEPOSITIONs answered, then has each one do a number of WHERE round trips
+# back to back and reports the commands per second.
+#
+def benchEngines(options):
+    raiseFileLimit()
+    counts = [int(n) for n in str(options.get('sensors', '100,500,1000,2000')).split(',')]
+    rounds = int(options.get('rounds', 20))
+    topology = options.get('topology', os.path.join(here, 'hw4_3_by_3.txt'))
+    results = []
+    for engine in ('select', 'selectors'):
+        for count in counts:
+            result = {'engine': engine, 'sensors': count}
+            process, port = launchServer(topology, ['--framed', '--engine=' + engine])
+            pool = None
+            try:
+                start = time.perf_counter()
+                pool = SensorPool(port, count)
+                result['connect_seconds'] = time.perf_counter() - start
+                start = time.perf_counter()
+                for n, sensor in enumerate(pool.ids):                       # Spread out, so no two sensors are in range
+                    pool.request(n, 'UPDATEPOSITION {} 5 {} {}'.format(sensor, (n % 100) * 20, (n // 100) * 20))
+                pool.run()
+                result['register_seconds'] = time.perf_counter() - start
+
+                left = [rounds - 1] * count
+                def again(n, message):
+                    if left[n] > 0:
+                        left[n] -= 1
+                        pool.request(n, 'WHERE base_station_a')
+                start = time.perf_counter()
+                for n in range(count):
+                    pool.request(n, 'WHERE base_station_a')
+                pool.run(again)
+                elapsed = time.perf_counter() - start
+                result['commands_per_second'] = count * rounds / elapsed
+                result['ok'] = True
+            except (RuntimeError, OSError) as error:
+                result['ok'] = False
+                result['error'] = str(error)
+            finally:
+                if pool is not None:
+                    pool.close()
+                if not stopServer(process):
+                    result['ok'] = False
+                    result['error'] = 'control server died: ' + process.stderr.read().strip().splitlines()[-1]
+            results.append(result)
+            printResult(result)
+    return results
+
+#
+# openTopology()
+# Opens the file a generated topology is written to: path, or a new temporary file if it is None.
+#
+def openTopology(path, prefix):
+    if path is None:
+        return tempfile.NamedTemporaryFile('w', suffix='.txt', prefix=prefix, delete=False)
+    return open(path, 'w')
+
+#
+# gridTopology()
+# Writes a side x side grid of base stations, spacing apart and each linked to its neighbours,
+# to path (a temporary file if None) and returns its path.
+#
+def gridTopology(side, spacing=10, path=None):
+    fp = openTopology(path, 'hw4_grid_')
+    for x in range(side):
+        for y in range(side):
+            links = ['base_{}_{}'.format(a, b) for a, b in ((x - 1, y), (x + 1, y), (x, y - 1), (x, y + 1))
+                     if 0 <= a < side and 0 <= b < side]
+            fp.write('base_{}_{} {} {} {} {}\n'.format(x, y, x * spacing, y * spacing, len(links), ' '.join(links)))
+    fp.close()
+    return fp.name
+
+#
+# geometricTopology()
+# Writes count base stations scattered at random, each linked to every other within radius, to
+# path (a temporary file if None) and returns its path. The square they are scattered over is
+# sized so that a station has about degree links on average.
+#
+def geometricTopology(count, radius=15, degree=6, seed=1, path=None):
+    scatter = random.Random(seed)
+    extent = max(1, int(math.sqrt(count * math.pi * radius * radius / degree)))
+    stations = [('base_{}'.format(n), scatter.randrange(extent), scatter.randrange(extent)) for n in range(count)]
+    cells = collections.defaultdict(list)                           # Buckets of side radius, so only neighbouring ones are compared
+    for station in stations:
+        cells[(station[1] // radius, station[2] // radius)].append(station)
+    fp = openTopology(path, 'hw4_geometric_')
+    for id, x, y in stations:
+        links = []
+        for cx in range(x // radius - 1, x // radius + 2):
+            for cy in range(y // radius - 1, y // radius + 2):
+                for other, ox, oy in cells.get((cx, cy), ()):
+                    if other != id and (x - ox) ** 2 + (y - oy) ** 2 <= radius * radius:
+                        links.append(other)
+        fp.write('{} {} {} {} {}\n'.format(id, x, y, len(links), ' '.join(links)))
+    fp.close()
+    return fp.name
+
+#
+# makeTopology()
+# Takes the benchmark options, and writes the topology they ask for: --topology=grid (--side by
+# --side, --spacing apart), --topology=geometric (--stations scattered, linked within --radius),
+# both to --out if given, or else the path of an existing file. Returns the path, and whether it
+# was generated (and is for the caller to remove).
+#
+def makeTopology(options, default='grid'):
+    kind = options.get('topology', default)
+    out = options.get('out')
+    if kind == 'grid':
+        return gridTopology(int(options.get('side', 50)), int(options.get('spacing', 10)), out), out is None
+    if kind == 'geometric':
+        return geometricTopology(int(options.get('stations', 2500)), int(options.get('radius', 15)),
+                                 float(options.get('degree', 6)), int(options.get('seed', 1)), out), out is None
+    return kind, False
+
+#
+# removeTopology()
+# Deletes a topology file written by gridTopology(), and the snapshot the server made of it.
+#
+def removeTopology(path):
+    os.unlink(path)
+    if os.path.exists(path + SNAPSHOT_SUFFIX):
+        os.unlink(path + SNAPSHOT_SUFFIX)
+
+#
+# benchStartup()
+# For each grid size, times how long the control server takes to start accepting sensors: parsing
+# the text with --snapshot=off, parsing it and writing the snapshot the first time, and then
+# loading that snapshot.
+#
+def benchStartup(options):
+    sides = [int(n) for n in str(options.get('side', '100,300,1000')).split(',')]
+    results = []
+    for side in sides:
+        topology = gridTopology(side)
+        result = {'stations': side * side, 'text_bytes': os.path.getsize(topology)}
+        try:
+            for label, flags in (('text', ['--snapshot=off']), ('first', []), ('snapshot', [])):
+                start = time.perf_counter()
+                process, port = launchServer(topology, flags)
+                result[label + '_s'] = time.perf_counter() - start
+                stopServer(process)
+            result['snapshot_bytes'] = os.path.getsize(topology + SNAPSHOT_SUFFIX)
+        finally:
+            removeTopology(topology)
+        results.append(result)
+        printResult(result)
+    return results
+
+#
+# childPids()
+# Takes the pid of a running process, and returns the pids of its children, from /proc.
+#
+def childPids(pid):
+    children = []
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open('/proc/{}/stat'.format(entry)) as fp:
+                    fields = fp.read().rsplit(')', 1)[1].split()
+            except OSError:                                         # Gone since
+                continue
+            if int(fields[1]) == pid:
+                children.append(int(entry))
+    return children
+
+#
+# benchShards()
+# Moves a fleet of sensors around a grid of base stations, each sensor doing a number of
+# UPDATEPOSITION round trips back to back, against one process and against each shard count.
+# Reports the CPU time per move of the front (the whole server, for one process) and of the
+# workers between them. Every move goes through the front, so 1 / its time per move is as many
+# moves a second as the server could make with a core for each process (front_limit).
+#
+def benchShards(options):
+    raiseFileLimit()
+    counts = [int(n) for n in str(options.get('shards', '1,2,4')).split(',')]
+    sensors = int(options.get('sensors', 200))
+    rounds = int(options.get('rounds', 50))
+    side = int(options.get('side', 100))
+    sensor_range = options.get('range', 15)
+    topology = gridTopology(side)
+    extent = side * 10
+    results = []
+    try:
+        for count in [0] + counts:
+            flags = ['--framed', '--engine=selectors'] + (['--shards={}'.format(count)] if count else [])
+            result = {'shards': count, 'sensors': sensors}
+            process, port = launchServer(topology, flags)
+            pool = SensorPool(port, sensors)
+            try:
+                moves = random.Random(1)
+                def move(n, message=None):
+                    if message is None or left[n] > 0:
+                        left[n] -= 1
+                        pool.request(n, 'UPDATEPOSITION {} {} {} {}'.format(pool.ids[n], sensor_range,
+                                                                            moves.randrange(extent), moves.randrange(extent)))
+                left = [rounds] * sensors
+                workers = childPids(process.pid)
+                before = [processUsage(pid)[0] for pid in [process.pid] + workers]
+                start = time.perf_counter()
+                for n in range(sensors):
+                    move(n)
+                pool.run(move)
+                result['moves_per_second'] = sensors * rounds / (time.perf_counter() - start)
+                after = [processUsage(pid)[0] for pid in [process.pid] + workers]
+                result['front_cpu_us'] = (after[0] - before[0]) * 1e6 / (sensors * rounds)
+                result['shard_cpu_us'] = (sum(after[1:]) - sum(before[1:])) * 1e6 / (sensors * rounds)
+                result['front_limit'] = 1e6 / result['front_cpu_us'] if result['front_cpu_us'] else None
+                result['ok'] = True
+            except (RuntimeError, OSError) as error:
+                result['ok'] = False
+                result['error'] = str(error)
+            finally:
+                pool.close()
+                if not stopServer(process):
+                    result['ok'] = False
+            results.append(result)
+            printResult(result)
+    finally:
+        removeTopology(topology)
+    return results
+
+#
+# benchBatch()
+# One connection moves a fleet of sensors around a grid of base stations, a number of rounds,
+# with each batch sent only once the last was answered. A batch of 1 is a plain UPDATEPOSITION.
+#
+def benchBatch(options):
+    sizes = [int(n) for n in str(options.get('batch', '1,10,100')).split(',')]
+    sensors = int(options.get('sensors', 500))
+    rounds = int(options.get('rounds', 20))
+    side = int(options.get('side', 100))
+    sensor_range = options.get('range', 15)
+    topology = gridTopology(side)
+    extent = side * 10
+    results = []
+    try:
+        for size in sizes:
+            result = {'batch': size, 'sensors': sensors}
+            process, port = launchServer(topology, ['--framed', '--engine=selectors'])
+            pool = SensorPool(port, 1, 'gateway')
+            try:
+                moves = random.Random(1)
+                ids = ['bench{}'.format(n) for n in range(sensors)]
+                chunks = collections.deque()
+                for n in range(rounds):
+                    for start in range(0, sensors, size):
+                        chunks.append([(id, sensor_range, moves.randrange(extent), moves.randrange(extent))
+                                       for id in ids[start:start + size]])
+                def send(n=0, message=None):
+                    if chunks:
+                        chunk = chunks.popleft()
+                        if size == 1:
+                            pool.request(0, 'UPDATEPOSITION {} {} {} {}'.format(*chunk[0]))
+                        else:
+                            pool.request(0, 'UPDATEPOSITIONS {} {}'.format(len(chunk), ' '.join('{} {} {} {}'.format(*move) for move in chunk)))
+                start = time.perf_counter()
+                send()
+                pool.run(send)
+                result['moves_per_second'] = sensors * rounds / (time.perf_counter() - start)
+                result['ok'] = True
+            except (RuntimeError, OSError) as error:
+                result['ok'] = False
+                result['error'] = str(error)
+            finally:
+                pool.close()
+                if not stopServer(process):
+                    result['ok'] = False
+            results.append(result)
+            printResult(result)
+    finally:
+        removeTopology(topology)
+    return results
+
+#
+# timeCodec()
+# Takes a codec, a function encoding one message with it, and a repeat count. Returns the
+# microseconds per encode, the microseconds per decode, and the bytes of one message, once
+# its IDs are known to the other side.
+#
+def timeCodec(codec, encode, count):
+    decoder = TextCodec(True) if isinstance(codec, TextCodec) else BinaryCodec()
+    decoder.feed(encode(codec))                                     # Defines the IDs, as the first message would
+    start = time.perf_counter()
+    for n in range(count):
+        data = encode(codec)
+    encode_time = (time.perf_counter() - start) / count
+    start = time.perf_counter()
+    for n in range(count):
+        decoder.feed(data)
+    decode_time = (time.perf_counter() - start) / count
+    return encode_time * 1e6, decode_time * 1e6, len(data)
+
+#
+# benchCodec()
+# For each message the sensors and the server trade, and REACHABLE at each neighbour count,
+# times encoding and decoding it with the text protocol (framed) and with the binary codec.
+#
+def benchCodec(options):
+    counts = [int(n) for n in str(options.get('neighbours', '0,8,64')).split(',')]
+    count = int(options.get('count', 20000))
+    messages = [('UPDATEPOSITION', lambda codec: codec.updatePosition('sensor_17', 15, 1234, -56)),
+                ('WHERE', lambda codec: codec.where('base_station_a')),
+                ('THERE', lambda codec: codec.there('base_station_a', 1234, -56)),
+                ('DATAMESSAGE', lambda codec: codec.dataMessage('sensor_17', 'base_4_2', 'sensor_3', ['sensor_17']))]
+    for neighbours in counts:
+        entries = [('base_{}_{}'.format(n // 10, n % 10), n * 10, n * 7) for n in range(neighbours)]
+        messages.append(('REACHABLE/{}'.format(neighbours), lambda codec, entries=entries: codec.reachable(entries)))
+    results = []
+    for name, encode in messages:
+        result = {'message': name}
+        for label, codec in (('text', TextCodec(True)), ('binary', BinaryCodec())):
+            encode_us, decode_us, size = timeCodec(codec, encode, count)
+            result[label + '_encode_us'] = encode_us
+            result[label + '_decode_us'] = decode_us
+            result[label + '_bytes'] = size
+        results.append(result)
+        printResult(result)
+    return results
+
+#
+# benchLoad()
+# Launches the server on a generated topology (see makeTopology(), or --topology=[file]),
+# connects a fleet of sensors, and has them run a mix of commands for a number of seconds at a
+# total rate (0 for as fast as they are answered). Reports the throughput and the p50 and p99
+# latency of each command, and of all of them together, with the server's CPU time per command
+# (on Linux), which still shows what a change saves when the sensors are the bottleneck.
+#
+def benchLoad(options):
+    raiseFileLimit()
+    sensors = int(options.get('sensors', 100))
+    rate = float(options.get('rate', 0))
+    seconds = float(options.get('seconds', 10))
+    sensor_range = options.get('range', 15)
+    burst = int(options.get('burst', 1))
+    mix = [(name, float(weight)) for name, _, weight in
+           (part.partition(':') for part in str(options.get('mix', 'move:50,senddata:25,where:25')).split(','))]
+    flags = ['--framed'] + [flag for flag in str(options.get('server', '--engine=selectors')).split(',') if flag]
+    topology, generated = makeTopology(options)
+    with open(topology) as fp:
+        stations = parseTopology(fp)
+    extent = max(stations.high, max(stations.ys, default=0), 1)
+    results = []
+    try:
+        process, port = launchServer(topology, flags)
+        load = None
+        try:
+            load = LoadGenerator(port, sensors, sensor_range, extent, burst=burst)
+            load.register(random.Random(0))
+            targets = stations.names[:stations.count] + load.ids    # Base stations and sensors alike
+            cpu = processUsage(process.pid)[0] if os.path.exists('/proc') else None
+            latencies, elapsed = load.run(mix, rate, seconds, targets)
+            if cpu is not None:
+                cpu = processUsage(process.pid)[0] - cpu
+            latencies['all'] = [latency for name, _ in mix for latency in latencies[name]]
+            for name, values in latencies.items():
+                values.sort()
+                result = {'command': name, 'sensors': sensors, 'rate': rate, 'burst': burst, 'count': len(values),
+                          'per_second': len(values) / elapsed,
+                          'p50_ms': percentile(values, 50) * 1e3 if values else None,
+                          'p99_ms': percentile(values, 99) * 1e3 if values else None}
+                if name == 'all':
+                    result['deliveries'] = load.deliveries
+                    if cpu is not None and values:
+                        result['server_cpu_ms'] = cpu / len(values) * 1e3
+                results.append(result)
+            ok = True
+        except (RuntimeError, OSError) as error:
+            results.append({'command': 'all', 'sensors': sensors, 'rate': rate, 'error': str(error)})
+            ok = False
+        finally:
+            if load is not None:
+                load.close()
+            if not stopServer(process):
+                ok = False
+        for result in results:
+            result['ok'] = ok
+            printResult(result)
+    finally:
+        if generated:
+            removeTopology(topology)
+    return results
+
+#
+# processUsage()
+# Takes the pid of a running process, and returns its CPU seconds so far and its peak resident
+# memory in KB, from /proc (so Linux only).
+#
+def processUsage(pid):
+    with open('/proc/{}/stat'.format(pid)) as fp:
+        fields = fp.read().rsplit(')', 1)[1].split()                # From the state on, as the name may hold spaces
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    peak = 0
+    with open('/proc/{}/status'.format(pid)) as fp:
+        for line in fp:
+            if line.startswith('VmHWM:'):
+                peak = int(line.split()[1])
+    return cpu, peak
+
+#
+# reapProcess()
+# Takes a launched process whose stdin was written and closed, and waits for it to exit.
+# Returns its CPU seconds and peak resident memory in KB.
+#
+def reapProcess(process):
+    pid, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return usage.ru_utime + usage.ru_stime, usage.ru_maxrss
+
+#
+# runSensors()
+# Takes the model, the server's port and each sensor's (range, x, y) and moves, and runs them:
+# a hw4_client.py --framed per sensor, or one hw4_gateway.py hosting them all, each fed its MOVEs
+# and QUIT. Returns the CPU seconds and the peak memory in KB of all of the sensor processes.
+#
+def runSensors(model, port, sensors, moves):
+    ids = ['bench{}'.format(n) for n in range(len(sensors))]
+    processes = []
+    if model == 'processes':
+        for id, (sensor_range, x, y), path in zip(ids, sensors, moves):
+            command = [sys.executable, os.path.join(here, 'hw4_client.py'), 'localhost', str(port), id,
+                       str(sensor_range), str(x), str(y), '--framed']
+            processes.append((subprocess.Popen(command, cwd=here, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL),
+                              ''.join('MOVE {} {}\n'.format(x, y) for x, y in path) + 'QUIT\n'))
+    else:
+        descriptor, sensor_file = tempfile.mkstemp(prefix='hw4_gateway_', suffix='.txt')
+        with os.fdopen(descriptor, 'w') as fp:
+            for id, (sensor_range, x, y) in zip(ids, sensors):
+                fp.write('{} {} {} {}\n'.format(id, sensor_range, x, y))
+        command = [sys.executable, os.path.join(here, 'hw4_gateway.py'), 'localhost', str(port), sensor_file]
+        script = ''.join('{} MOVE {} {}\n'.format(id, *path[n]) for n in range(len(moves[0])) for id, path in zip(ids, moves))
+        processes.append((subprocess.Popen(command, cwd=here, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL),
+                          script + 'QUIT\n'))
+    try:
+        for process, script in processes:
+            process.stdin.write(script.encode())
+            process.stdin.close()
+        cpu = peak = 0
+        for process, script in processes:
+            process_cpu, process_peak = reapProcess(process)
+            cpu += process_cpu
+            peak += process_peak
+            if process.returncode != 0:
+                raise RuntimeError('a sensor process exited with {}'.format(process.returncode))
+        return cpu, peak
+    finally:
+        if model != 'processes':
+            os.unlink(sensor_file)
+
+#
+# benchGateway()
+# For each fleet size, has the sensors make the same random moves as a process per sensor and
+# then as one gateway, and reports the CPU time and peak memory per sensor of the sensor processes
+# and of the server. The processes are charged for starting Python, which is part of their cost.
+#
+def benchGateway(options):
+    raiseFileLimit()
+    counts = [int(n) for n in str(options.get('sensors', '25,100')).split(',')]
+    rounds = int(options.get('rounds', 20))
+    side = int(options.get('side', 50))
+    sensor_range = int(options.get('range', 15))
+    topology = gridTopology(side)
+    extent = side * 10
+    results = []
+    try:
+        for count in counts:
+            spots = random.Random(count)
+            sensors = [(sensor_range, spots.randrange(extent), spots.randrange(extent)) for n in range(count)]
+            moves = [[(spots.randrange(extent), spots.randrange(extent)) for r in range(rounds)] for n in range(count)]
+            for model in ('processes', 'gateway'):
+                result = {'model': model, 'sensors': count, 'rounds': rounds}
+                process, port = launchServer(topology, ['--framed', '--engine=selectors'])
+                try:
+                    server_cpu, server_peak = processUsage(process.pid)
+                    start = time.perf_counter()
+                    cpu, peak = runSensors(model, port, sensors, moves)
+                    result['seconds'] = time.perf_counter() - start
+                    result['sensor_cpu_ms'] = cpu / count * 1e3
+                    result['sensor_rss_kb'] = peak / count
+                    after_cpu, after_peak = processUsage(process.pid)
+                    result['server_cpu_ms'] = (after_cpu - server_cpu) / count * 1e3
+                    result['server_rss_kb'] = (after_peak - server_peak) / count
+                    result['ok'] = True
+                except (RuntimeError, OSError) as error:
+                    result['ok'] = False
+                    result['error'] = str(error)
+                finally:
+                    if not stopServer(process):
+                        result['ok'] = False
+                results.append(result)
+                printResult(result)
+    finally:
+        removeTopology(topology)
+    return results
+
+#
+# benchTopology()
+# Only writes a topology, as makeTopology() does, to --out. Reports its size.
+#
+def benchTopology(options):
+    if 'out' not in options:
+        raise SystemExit('topology needs --out=[file]')
+    path, generated = makeTopology(options)
+    with open(path) as fp:
+        stations = parseTopology(fp)
+    result = {'path': path, 'stations': stations.count, 'links': len(stations.links)}
+    printResult(result)
+    return [result]
+
+#
+# class PlainGraph
+# The graph the way hw4_control.py first kept it, for verify to check the faster paths against: a
+# list of edges per node, every UPDATEPOSITION scanning every node, and the walk of dfs() recursing
+# once per hop over its edges sorted by distance to the destination. Only an edge already there is
+# not added twice, as Graph has not added one twice since it kept them in dictionaries.
+#
+class PlainGraph(object):
+    def __init__(self, topology):
+        self.graph = {}
+        self.positions = {}
+        self.type = {}
+        stations = list(topology.stations())
+        for BaseId, XPos, YPos, edges in stations:
+            self.graph[BaseId] = []
+            self.positions[BaseId] = (XPos, YPos)
+            self.type[BaseId] = -1
+        for BaseId, XPos, YPos, edges in stations:
+            for edge in edges:
+                self.add_edge(BaseId, edge)
+
+    def add_edge(self, id, edge):
+        if id in self.graph and edge not in self.graph[id]:
+            self.graph[id].append(edge)
+
+    def move(self, sensor_id, sensor_range, x, y):                  # One UPDATEPOSITION: clear the sensor's edges, then scan for new ones
+        if sensor_id in self.graph:
+            for vertex in self.graph:
+                if sensor_id in self.graph[vertex]:
+                    self.graph[vertex].remove(sensor_id)
+        self.graph[sensor_id] = []
+        self.positions[sensor_id] = (int(x), int(y))
+        self.type[sensor_id] = float(sensor_range)
+        a = self.positions[sensor_id]
+        for vertex in self.graph:
+            if vertex != sensor_id:
+                b = self.positions[vertex]
+                dst = math.sqrt( (a[0]-b[0])**2 + (a[1]-b[1])**2 )
+                if float(sensor_range) >= dst and (self.type[vertex] == -1 or self.type[vertex] >= dst):
+                    self.add_edge(sensor_id, vertex)
+                    self.add_edge(vertex, sensor_id)
+
+    def reachable(self, sensor_id):                                 # The (id, x, y) of each neighbour, as a REACHABLE lists them
+        return [(i, self.positions[i][0], self.positions[i][1]) for i in self.graph[sensor_id]]
+
+    def dfs(self, start_node, visited, end_node):
+        visited.append(start_node)
+        if start_node == end_node:
+            return visited
+        a = self.positions[end_node]
+        dist = sorted(self.graph[start_node], key=lambda edge: (math.sqrt( (a[0]-self.positions[edge][0])**2 +
+                                                                          (a[1]-self.positions[edge][1])**2 ), edge))
+        for neighbour in dist:
+            if neighbour not in visited:
+                return self.dfs(neighbour, visited, end_node)
+
+#
+# randomMove()
+# Takes a random.Random, a sensor ID, the extent of the topology and a typical range, and returns an
+# UPDATEPOSITION's (SensorID, SensorRange, X, Y): mostly a typical range, now and then one far bigger
+# or smaller than a grid cell, and now and then a spot just off the edge of the topology. A third of
+# the moves land on the lattice of a 10 apart grid with a range a whole number of steps, so that
+# distances tie and a node sits right at the edge of a range.
+#
+def randomMove(scatter, sensor_id, extent, typical):
+    sensor_range = scatter.choice((scatter.randint(1, typical), scatter.randint(1, typical * 3), scatter.randint(1, 4),
+                                   extent * 2))
+    x = scatter.randint(-extent // 10, extent + extent // 10)
+    y = scatter.randint(-extent // 10, extent + extent // 10)
+    if scatter.random() < 1 / 3:
+        sensor_range, x, y = max(10, sensor_range // 10 * 10), x // 10 * 10, y // 10 * 10
+    return (sensor_id, sensor_range, x, y)
+
+#
+# takeReply()
+# Takes the control module's end of a socket pair, the end standing in for the sensor, and its
+# FrameReader, and returns the bytes of the one message the control module sent down it.
+#
+def takeReply(client, sensor, reader):
+    data = b''
+    while True:
+        control.flushOutput(client)                                 # Whatever did not fit in the socket at once
+        chunk = sensor.recv(1 << 20)
+        data += chunk
+        if reader.feed(chunk):
+            return data
+
+#
+# verifyGraphs()
+# Moves sensors around a random geometric topology or grid, the same random moves going to a PlainGraph and,
+# for each storage, to one graph through handleUpdatePosition() one move at a time and to another
+# through handleUpdatePositions() in batches. Checks that every REACHABLE and REACHABLES is
+# byte-identical to what the PlainGraph gives, that every graph ends each batch with the same edges
+# in the same order (and a reverse index to match), and that route() and dfs() take the recursive
+# walk between random nodes, cached routes included. Raises RuntimeError at the first difference.
+#
+def verifyGraphs(seed, sensors, steps):
+    scatter = random.Random(seed)
+    radius = scatter.randint(8, 30)
+    if scatter.random() < 0.5:
+        path = geometricTopology(scatter.randint(10, 150), radius, scatter.uniform(2, 8), seed)
+    else:
+        path = gridTopology(scatter.randint(2, 14))
+    try:
+        with open(path) as fp:
+            topology = parseTopology(fp)
+    finally:
+        removeTopology(path)
+    extent = max(max(topology.xs), max(topology.ys)) + 1
+    plain = PlainGraph(topology)
+    kinds = [('dicts', control.Graph)] + ([('arrays', control.ArrayGraph)] if control.numpy is not None else [])
+    graphs = []                                                     # (storage, batched, graph, route cache)
+    for storage, kind in kinds:
+        for batched in (False, True):
+            graph = kind(cell_size=scatter.choice((1, 5, radius, extent)), adaptive=scatter.random() < 0.5)
+            if storage == 'arrays':                                 # Through the arrays however few the nodes, as dicts covers the loops
+                graph.vector_min = graph.nearest_min = 1
+            graph.load(topology)
+            graphs.append((storage, batched, graph, control.RouteCache(graph)))
+    client, sensor = socket.socketpair()
+    client.setblocking(0)
+    sensor.settimeout(10)
+    codec = TextCodec(True)
+    control.codecs[client] = codec
+    reader = FrameReader()
+    ids = ['verify{}'.format(n) for n in range(sensors)]
+    result = {'moves': 0, 'batches': 0, 'routes': 0}
+    try:
+        for step in range(steps):
+            moves = [randomMove(scatter, scatter.choice(ids), extent, radius) for n in range(scatter.choice((1, 1, 2, 8)))]
+            expected = []
+            for move in moves:
+                plain.move(*move)
+                expected.append(codec.reachable(plain.reachable(move[0])))
+            final = collections.OrderedDict((move[0], None) for move in moves)
+            expected_batch = codec.reachables([(sensor_id, plain.reachable(sensor_id)) for sensor_id in final])
+            for storage, batched, graph, cache in graphs:
+                control.graph, control.route_cache = graph, cache
+                label = '{} {}'.format(storage, 'UPDATEPOSITIONS' if batched else 'UPDATEPOSITION')
+                if batched:
+                    control.handleUpdatePositions(codec.decode(codec.updatePositions(moves).strip()), client)
+                    if takeReply(client, sensor, reader) != expected_batch:
+                        raise RuntimeError('{}: the REACHABLES of {} differ'.format(label, moves))
+                else:
+                    for move, reply in zip(moves, expected):
+                        control.handleUpdatePosition(codec.decode(codec.updatePosition(*move).strip()), client)
+                        if takeReply(client, sensor, reader) != reply:
+                            raise RuntimeError('{}: the REACHABLE of {} differs'.format(label, move))
+                if {node: list(edges) for node, edges in graph.graph.items()} != plain.graph:
+                    raise RuntimeError('{}: the edges differ after {}'.format(label, moves))
+                reverse = {}
+                for node, edges in graph.graph.items():
+                    for edge in edges:
+                        reverse.setdefault(edge, set()).add(node)
+                if reverse != {node: set(nodes) for node, nodes in graph.reverse.items() if nodes}:
+                    raise RuntimeError('{}: the reverse index is out of step after {}'.format(label, moves))
+            result['moves'] += len(moves)
+            result['batches'] += 1
+            nodes = list(plain.graph)
+            placed = [sensor_id for sensor_id in ids if sensor_id in plain.graph]
+            for n in range(4):
+                origin, destination = scatter.choice(placed), scatter.choice(nodes)
+                walk = []
+                path = plain.dfs(origin, walk, destination)
+                for storage, batched, graph, cache in graphs:
+                    control.graph, control.route_cache = graph, cache
+                    if control.route(origin, destination) != (path, walk) or control.dfs(origin, [], destination) != path:
+                        raise RuntimeError('{}: the walk from {} to {} differs'.format(storage, origin, destination))
+                result['routes'] += 1
+    finally:
+        control.codecs.pop(client, None)
+        control.message_queues.pop(client, None)
+        client.close()
+        sensor.close()
+    result['storages'] = ','.join(storage for storage, kind in kinds)
+    return result
+
+#
+# class Session
+# A number of framed sensor connections to one launched server, each kept to itself: every frame a
+# sensor is sent is recorded, in order, and expect() reads one sensor's socket until the reply it
+# waits for turns up. DATAMESSAGEs pushed along a route are recorded along the way.
+#
+class Session(object):
+    def __init__(self, port, count):
+        self.sockets = [socket.create_connection(('localhost', port)) for n in range(count)]
+        for client in self.sockets:
+            client.settimeout(30)
+        self.readers = [FrameReader() for n in range(count)]
+        self.frames = [[] for n in range(count)]                    # Every frame each sensor was sent
+        self.unread = [collections.deque() for n in range(count)]   # Those expect() has not gone past yet
+
+    def send(self, n, data):
+        self.sockets[n].sendall(data)
+
+    def expect(self, n, kind):                                      # Returns the next frame of sensor n that is a kind, e.g. b'REACHABLE'
+        while True:
+            while self.unread[n]:
+                message = self.unread[n].popleft()
+                if message.split(b' ', 1)[0] == kind:
+                    return message
+            data = self.sockets[n].recv(65536)
+            if not data:
+                raise RuntimeError('the control server hung up')
+            frames = self.readers[n].feed(data)
+            self.frames[n].extend(frames)
+            self.unread[n].extend(frames)
+
+    def close(self):
+        for client in self.sockets:
+            client.close()
+
+#
+# sessionScript()
+# Takes a random.Random, the sensor count and the grid's side, and returns the commands of a session:
+# ('move', n, move), ('batch', n, [moves]) sent by sensor n as a gateway would, ('send', n, Destination)
+# a DATAMESSAGE from sensor n and a WHERE behind it, and ('where', n, Id).
+#
+def sessionScript(scatter, count, side, steps):
+    extent = side * 10
+    ids = ['verify{}'.format(n) for n in range(count)]
+    nodes = ids + ['base_{}_{}'.format(x, y) for x in range(side) for y in range(side)]
+    script = [('move', n, randomMove(scatter, ids[n], extent, 25)) for n in range(count)]
+    for step in range(steps):
+        n = scatter.randrange(count)
+        kind = scatter.choice(('move', 'move', 'batch', 'send', 'send', 'where'))
+        if kind == 'move':
+            script.append(('move', n, randomMove(scatter, ids[n], extent, 25)))
+        elif kind == 'batch':
+            script.append(('batch', n, [randomMove(scatter, scatter.choice(ids), extent, 25) for m in range(scatter.randint(1, 6))]))
+        elif kind == 'send':
+            script.append(('send', n, scatter.choice(nodes)))
+        else:
+            script.append(('where', n, scatter.choice(nodes + ['nowhere'])))
+    return script
+
+#
+# runSession()
+# Launches the control server with the given flags on the topology, and plays the script on it one
+# command at a time. Then every sensor sends rounds of commands all at once, moves and DATAMESSAGEs
+# each with a WHERE behind it, and once those are all answered each sensor makes its last move again,
+# one after the other. Returns every frame each sensor was sent in the script, the lines the server
+# logged meanwhile, and the REACHABLE of each of those last moves: what the rounds left behind.
+#
+def runSession(topology, flags, script, count, side, rounds, seed):
+    log = tempfile.NamedTemporaryFile('r', suffix='.log', prefix='hw4_verify_')
+    process, port = launchServer(topology, flags + ['--framed', '--log-file=' + log.name, '--log-sync'])
+    session = Session(port, count)
+    try:
+        codec = TextCodec(True)
+        ids = ['verify{}'.format(n) for n in range(count)]
+        last = {}                                                   # SensorID: its last (SensorID, SensorRange, X, Y)
+        for command, n, value in script:
+            if command == 'move':
+                session.send(n, codec.updatePosition(*value))
+                session.expect(n, b'REACHABLE')
+                last[value[0]] = value
+            elif command == 'batch':
+                session.send(n, codec.updatePositions(value))
+                session.expect(n, b'REACHABLES')
+                last.update((move[0], move) for move in value)
+            elif command == 'send':
+                session.send(n, codec.dataMessage(ids[n], '-1', value, [ids[n]]) + codec.where(value))
+                session.expect(n, b'THERE')
+            else:
+                session.send(n, codec.where(value))
+                session.expect(n, b'THERE')
+        for n in range(count):                                      # Every DATAMESSAGE pushed so far comes before this THERE
+            session.send(n, codec.where(ids[n]))
+            session.expect(n, b'THERE')
+        frames = session.frames
+        session.frames = [[] for n in range(count)]
+        with open(log.name) as fp:
+            lines = fp.read()
+        scatter = random.Random(seed)
+        owed = []                                                   # The replies each sensor waits for, in order
+        for n in range(count):
+            data = []
+            owed.append([])
+            for m in range(rounds):
+                if scatter.random() < 0.5:
+                    last[ids[n]] = randomMove(scatter, ids[n], side * 10, 25)
+                    data.append(codec.updatePosition(*last[ids[n]]))
+                    owed[n].append(b'REACHABLE')
+                else:
+                    data.append(codec.dataMessage(ids[n], '-1', scatter.choice(ids), [ids[n]]) + codec.where(ids[n]))
+                    owed[n].append(b'THERE')
+            session.send(n, b''.join(data))
+        for n in range(count):
+            for kind in owed[n]:
+                session.expect(n, kind)
+        for n in range(count):                                      # Past any DATAMESSAGE the rounds pushed
+            session.send(n, codec.where(ids[n]))
+            session.expect(n, b'THERE')
+        settled = []
+        for n in range(count):
+            session.send(n, codec.updatePosition(*last[ids[n]]))
+            settled.append(session.expect(n, b'REACHABLE'))
+    finally:
+        session.close()
+        clean = stopServer(process)
+        log.close()
+    if not clean:
+        raise RuntimeError('the control server did not exit cleanly on QUIT')
+    return frames, lines, settled
+
+#
+# verifyShards()
+# Plays the same random session on one process and on each shard count, over a grid of base
+# stations, and checks that every frame each sensor was sent and every line logged are the same,
+# and that the rounds sent all at once leave each sensor with the same REACHABLE. Raises RuntimeError
+# at the first difference.
+#
+def verifyShards(seed, counts, sensors, steps):
+    scatter = random.Random(seed)
+    side = scatter.randint(4, 15)
+    script = sessionScript(scatter, sensors, side, steps)
+    rounds = scatter.randint(1, 8)
+    topology = gridTopology(side)
+    try:
+        expected = runSession(topology, [], script, sensors, side, rounds, seed)
+        for count in counts:
+            frames, lines, settled = runSession(topology, ['--shards={}'.format(count)], script, sensors, side, rounds, seed)
+            for n in range(sensors):
+                if frames[n] != expected[0][n]:
+                    sent = next(m for m in range(len(frames[n]) + 1) if frames[n][m:m + 1] != expected[0][n][m:m + 1])
+                    raise RuntimeError('--shards={}: verify{} was sent {} where one process sent {}'.format(
+                        count, n, frames[n][sent:sent + 1], expected[0][n][sent:sent + 1]))
+            if lines != expected[1]:
+                raise RuntimeError('--shards={}: the log differs from that of one process'.format(count))
+            for n in range(sensors):
+                if settled[n] != expected[2][n]:
+                    raise RuntimeError('--shards={}: verify{} settled on {} where one process gave {}'.format(
+                        count, n, settled[n], expected[2][n]))
+    finally:
+        removeTopology(topology)
+    return {'commands': len(script), 'rounds': rounds, 'lines': expected[1].count('\n')}
+
+#
+# verifyRaces()
+# Races moves against routes on each shard count, over a grid of base stations: sensors join one by
+# one, then in each trial one sensor moves while another sends a DATAMESSAGE, both at once from their
+# own connections. Whichever the server took first, what it logs for the message must be what one
+# process logs with the message sent just before the move or just after it, never a walk over a move
+# only some of the shards have applied. Raises RuntimeError at the first difference.
+#
+def verifyRaces(seed, counts, sensors, trials):
+    scatter = random.Random(seed)
+    side = scatter.randint(4, 15)
+    extent = side * 10
+    ids = ['verify{}'.format(n) for n in range(sensors)]
+    nodes = ids + ['base_{}_{}'.format(x, y) for x in range(side) for y in range(side)]
+    joins = [randomMove(scatter, sensor_id, extent, 25) for sensor_id in ids]
+    races = [(scatter.randrange(sensors), scatter.randrange(sensors), scatter.choice(nodes)) for n in range(trials)]
+    races = [(mover, sender, ids[mover] if scatter.random() < 0.5 else destination, randomMove(scatter, ids[mover], extent, 25))
+             for mover, sender, destination in races if mover != sender]  # Half of them to the sensor moving
+    topology = gridTopology(side)
+    try:
+        with open(topology) as fp:
+            stations = parseTopology(fp)
+        for count in counts:
+            graph = control.Graph()                                 # One process, in this one, with its log kept in memory
+            graph.load(stations)
+            control.graph, control.route_cache = graph, control.RouteCache(graph)
+            logged = io.StringIO()
+            control.events = EventLog(TextSink(logged), threaded=False)
+            client, sensor = socket.socketpair()
+            client.setblocking(0)
+            sensor.settimeout(10)
+            codec = TextCodec(True)
+            control.codecs[client] = codec
+            reader = FrameReader()
+            def logOf(command):                                     # What one process logs for a command, just now
+                start = len(logged.getvalue())
+                command()
+                control.events.flush()
+                return logged.getvalue()[start:]
+            def move(value):
+                control.handleUpdatePosition(codec.decode(codec.updatePosition(*value).strip()), client)
+                takeReply(client, sensor, reader)
+            log = tempfile.NamedTemporaryFile('r', suffix='.log', prefix='hw4_verify_')
+            process, port = launchServer(topology, ['--framed', '--shards={}'.format(count), '--log-file=' + log.name, '--log-sync'])
+            session = Session(port, sensors)
+            try:
+                for n, value in enumerate(joins):
+                    session.send(n, codec.updatePosition(*value))
+                    session.expect(n, b'REACHABLE')
+                    move(value)
+                for mover, sender, destination, value in races:
+                    data = ['DATAMESSAGE', ids[sender], '-1', destination]
+                    before = logOf(lambda: control.handleDataMessage(data, client))
+                    move(value)
+                    after = logOf(lambda: control.handleDataMessage(data, client))
+                    session.send(mover, codec.updatePosition(*value))
+                    session.send(sender, codec.dataMessage(ids[sender], '-1', destination, [ids[sender]]) + codec.where(destination))
+                    session.expect(mover, b'REACHABLE')
+                    session.expect(sender, b'THERE')
+                    lines = log.read()
+                    if lines not in (before, after):
+                        raise RuntimeError('--shards={}: {} sending to {} while {} moved to {} logged {!r}, where one process '
+                                           'logs {!r} or {!r}'.format(count, ids[sender], destination, ids[mover], value[1:],
+                                                                     lines, before, after))
+            finally:
+                session.close()
+                clean = stopServer(process)
+                log.close()
+                control.codecs.pop(client, None)
+                control.message_queues.pop(client, None)
+                client.close()
+                sensor.close()
+            if not clean:
+                raise RuntimeError('the control server did not exit cleanly on QUIT')
+    finally:
+        removeTopology(topology)
+    return {'trials': len(races)}
+
+#
+# benchVerify()
+# Runs the randomized equivalence checks, a seed at a time: verifyGraphs() for the looped dfs()
+# against the recursive one, UPDATEPOSITIONS against the same moves one at a time and
+# --storage=arrays against dicts, then verifyShards() and verifyRaces() for --shards against one process.
+# Every check that finds a difference is reported with it, and the run then exits with 1.
+#
+def benchVerify(options):
+    raiseFileLimit()
+    seeds = int(options.get('seeds', 10))
+    first = int(options.get('seed', 1))
+    counts = [int(n) for n in str(options.get('shards', '2,3')).split(',') if n]
+    sensors = int(options.get('sensors', 12))
+    steps = int(options.get('steps', 60))
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 10000))      # PlainGraph.dfs() recurses once per hop
+    results = []
+    for seed in range(first, first + seeds):
+        for check, run in (('graphs', lambda: verifyGraphs(seed, sensors, steps)),
+                           ('shards', lambda: verifyShards(seed, counts, sensors, steps)),
+                           ('races', lambda: verifyRaces(seed, counts, sensors, steps // 2))):
+            if check != 'graphs' and not counts:
+                continue
+            result = {'check': check, 'seed': seed}
+            try:
+                result.update(run())
+                result['ok'] = True
+            except Exception as error:                              # An exception out of the code checked is a difference too
+                result['ok'] = False
+                result['error'] = str(error) if isinstance(error, RuntimeError) else repr(error)
+            results.append(result)
+            printResult(result)
+    return results
+
+#
+# compareResults()
+# Takes the paths of two --json results of the same benchmark, and prints each numeric field of
+# each result side by side with the new/old ratio.
+#
+def compareResults(old_path, new_path):
+    with open(old_path) as fp:
+        old = json.load(fp)
+    with open(new_path) as fp:
+        new = json.load(fp)
+    if old['benchmark'] != new['benchmark']:
+        raise SystemExit('{} is a {} run but {} is a {} run'.format(old_path, old['benchmark'], new_path, new['benchmark']))
+    print('{} ({}) vs {} ({})'.format(old_path, old.get('commit'), new_path, new.get('commit')))
+    for before, after in zip(old['results'], new['results']):
+        fields = []
+        for key, value in after.items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or not isinstance(before.get(key), (int, float)):
+                fields.append('{}={}'.format(key, value))
+            elif isinstance(value, float):
+                ratio = '{:.2f}x'.format(value / before[key]) if before[key] else '-'
+                fields.append('{}={:.3f}->{:.3f} ({})'.format(key, before[key], value, ratio))
+            else:
+                fields.append('{}={}->{}'.format(key, before[key], value))
+        print('  '.join(fields))
+
+#
+# runInfo()
+# Returns what a --json result records about the run, so runs of different versions can be told apart.
+#
+def runInfo():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=here, capture_output=True,
+                                text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.TimeoutExpired):
+        commit = None
+    return {'commit': commit, 'python': sys.version.split()[0], 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+#
+# printResult()
+# Prints one result dictionary as a line of key=value pairs.
+#
+def printResult(result):
+    fields = []
+    for key, value in result.items():
+        if isinstance(value, float):
+            value = '{:.3f}'.format(value)
+        fields.append('{}={}'.format(key, value))
+    print('  '.join(fields))
+    sys.stdout.flush()
+
+benchmarks = {
+    'engines': benchEngines,
+    'shards': benchShards,
+    'batch': benchBatch,
+    'codec': benchCodec,
+    'startup': benchStartup,
+    'load': benchLoad,
+    'gateway': benchGateway,
+    'topology': benchTopology,
+    'verify': benchVerify,
+}
+
+#
+# main()
+# Runs the benchmark named on the command line, and writes its results as JSON if --json is given.
+# Exits with 1 if any of its results is not ok.
+#
+if __name__ == '__main__':
+    argv, options = splitOptions(sys.argv)
+    if len(argv) == 4 and argv[1] == 'compare':
+        compareResults(argv[2], argv[3])
+        exit(0)
+    if len(argv) != 2 or argv[1] not in benchmarks:
+        print("Error, correct usage is {} [{}] [--flags], or {} compare [old.json] [new.json]".format(argv[0], '|'.join(benchmarks), argv[0]))
+        exit(1)
+    results = benchmarks[argv[1]](options)
+    if 'json' in options:
+        path = options['json'] if options['json'] is not True else argv[1] + '.json'
+        record = {'benchmark': argv[1], 'options': options}
+        record.update(runInfo())
+        record['results'] = results
+        with open(path, 'w') as fp:
+            json.dump(record, fp, indent=2)
+    if not all(result.get('ok', True) for result in results):       # So a script can tell a failed run, verify's above all
+        exit(1)
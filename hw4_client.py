@@ -8,8 +8,11 @@
 
 import sys
 import socket
-import queue
 import select
+import time
+import collections
+from hw4_protocol import RequestQueue, splitOptions, makeCodec, askHello, readLines, FEATURES
+from hw4_events import openEventLog
 
 control_address = None      # The address to connect to
 control_port = None         # The port to connect to
@@ -17,91 +20,155 @@ sensor_id = None            # This client's sensor ID
 sensor_range = None         # The range of this clint
 x_coordinate = None         # The current x_coordinate of this client
 y_coordinate = None         # The current y_coordinate of this client
+options = {}                # The optional --flags from the command line, e.g. --framed
+codec = None                # The TextCodec or BinaryCodec spoken with the server, holding what is partially received
+reachable = {}              # The nodes in range as of the last REACHABLE, {ID: (x, y)}, patched by each REACHABLEDELTA
+reachable_sequence = 0      # The sequence number of the last REACHABLEDELTA applied to reachable
+held = collections.deque()  # Commands from stdin that can not go out yet, see canSend()
+stdin_buffer = bytearray()  # The start of a line of stdin whose end has not been read yet
+requests = None             # The RequestQueue of what was sent to the server: what waits on a reply, and what waits to go out
+sending_data = 0            # SENDDATAs waiting on their REACHABLE before their DATAMESSAGE can go out
+resync_waiting = None       # While a RESYNC is out, the callbacks of the replies that came in ahead of it
+running = True              # Until QUIT
+events = None               # The EventLog every line of output goes through, see hw4_events.py
+where_cache = {}            # With --cache, what THEREs said: {ID: (x, y, time.monotonic() it expires at, or None for a base station)}
+reachable_fresh = False     # With --cache, whether reachable is still what the server would answer, no INVALIDATE for it since
+cache_ttl = 10.0            # Seconds a sensor's position is kept for at most (--cache-ttl), though an INVALIDATE drops it sooner
 
 
-def handleDataMessage(str_list, i):
+#
+# handleDataMessage()
+# Handles a DATAMESSAGE the server delivered to this sensor, at any time, for it or to pass on.
+#
+def handleDataMessage(str_list):
     destinationID = str_list[3]
     originID = str_list[1]
     if(destinationID == sensor_id):
-        print_string = "{}: Message from {} to {} successfully received.".format(sensor_id, originID, sensor_id)
-        print(print_string)
+        events.emit('received', sensor_id, originID, sensor_id)
     else:
-        print_string = "{}: Message from {} to {} being forwarded through {}".format(sensor_id, originID, destinationID, sensor_id)
-        print(print_string)
-
+        events.emit('forwarded', sensor_id, originID, destinationID)
 
+#
+# handleReply()
+# Takes a message that answers a request, and hands it to the oldest pending request.
+#
+def handleReply(message):
+    if not requests.answer(message):
+        events.output("{}: Unexpected {} from the server".format(sensor_id, message[0]))
 
 #
 # sendUpdatePosition
 # Takes a client object, and sends an updte position message to the server in the form of:
 # UPDATEPOSITION [SensorID] [SensorRange] [CurrentXPosition] [CurrentYPosition]
+# Once the reply is in, the reachable dictionary is brought up to date and passed to then, if given.
 #
-def sendUpdatePosition(client):
-    send_string = "UPDATEPOSITION {} {} {} {}".format(sensor_id, sensor_range, x_coordinate, y_coordinate)
-    client.send(send_string.encode('utf-8'))
-    buf = client.recv(1024)
-    return buf
+def sendUpdatePosition(client, then=None):
+    requests.send(codec.updatePosition(sensor_id, sensor_range, x_coordinate, y_coordinate),
+                  ('REACHABLE', 'REACHABLEDELTA'), lambda message: positionReplied(message, client, then))
+
+#
+# positionReplied()
+# Takes the reply to an UPDATEPOSITION. With --cache, the list is up to date as of this reply,
+# even if it waits on a RESYNC to be pieced together, until an INVALIDATE says otherwise.
+#
+def positionReplied(message, client, then):
+    global reachable_fresh
+    reachable_fresh = 'cache' in codec.features
+    interpretPositionString(message, client, then)
 
 #
 # interpretPositionString()
-# takes as input the result from UPDATEPOSITION and returns a proper dictionary of reachable items.
-# Input in format: REACHABLE [NumReachable] [ReachableList]
-# Where ReachableList in space delimited format: [ID] [XPOS] [YPOS]
-# returns dictionary in format: {Key = station_name, Value = coord_tuple (x,y)}
-#
-def interpretPositionString(msg):
-	output = {}
-	delim_str = msg.decode("utf-8").split()
-	numReachable = int(delim_str[1])
-
-	# Get the list and loop through the items
-	i = 0
-	lis = delim_str[2:]
-	while i < (3 * numReachable):
-		name = lis[i].strip('[],\'\"')
-		xpos = int(lis[i+1].strip('[],\'\"'))
-		ypos = int(lis[i+2].strip('[],\'\"'))
-		output[name] = (xpos,ypos)
-		i += 3
-	return output
+# takes as input the result from UPDATEPOSITION and brings the dictionary of reachable items up to date.
+# Input in format: ['REACHABLE', NumReachable, [(ID, XPOS, YPOS), ...]], as the codec decodes it,
+# or ['REACHABLEDELTA', Seq, Full, [(ID, XPOS, YPOS), ...], [RemovedID, ...]] with --delta
+# dictionary in format: {Key = station_name, Value = coord_tuple (x,y)}, passed to then if given.
+# The dictionary is the reachable global, patched in place by a delta. If a delta is not
+# the one after the last applied, the whole list is asked for again with RESYNC, and then (and
+# that of every delta that comes in before the answer) waits for it.
+#
+def interpretPositionString(msg, client, then=None):
+    global reachable_sequence, resync_waiting
+    if msg[0] == 'REACHABLE':
+        reachable.clear()
+        for name, xpos, ypos in msg[2]:
+            reachable[name] = (xpos,ypos)
+    else:
+        sequence, full, added, removed = msg[1:5]
+        if not full and (resync_waiting is not None or sequence != reachable_sequence + 1):     # Missed one, so the map can not be patched
+            if resync_waiting is None:
+                resync_waiting = []
+                requests.send(codec.resync(sensor_id), ('REACHABLEDELTA',), lambda message: resynced(message, client))
+            resync_waiting.append(then)
+            return
+        if full:
+            reachable.clear()
+        for name in removed:
+            reachable.pop(name, None)
+        for name, xpos, ypos in added:
+            reachable[name] = (xpos,ypos)
+        reachable_sequence = sequence
+    if then is not None:
+        then(reachable)
+
+#
+# resynced()
+# Takes the answer to a RESYNC, and runs the callbacks that were waiting on it.
+#
+def resynced(message, client):
+    global resync_waiting
+    waiting = resync_waiting
+    resync_waiting = None
+    interpretPositionString(message, client)
+    for then in waiting:
+        if then is not None:
+            then(reachable)
 
 #
 # handleSendData()
-# Handles the send data call from stdin. Sends a data message to the server in the form:
-# DATAMESSAGE [OriginID] [NextID] [DestinationID] [HopListLength] [HopList]
+# Handles the send data call from stdin. Starts by updating the current position, and once the
+# reachable dict is back, sendData() sends the message. With --cache, a reachable dict the server
+# has not invalidated is used as it is, when no reply is outstanding to print ahead of it.
 #
 def handleSendData(destinationID, client):
-    msg = sendUpdatePosition(client)                # Starts by updating the current position
-    reachable = interpretPositionString(msg)		# Converts reachable string to dict object
+    global sending_data
+    sending_data += 1
+    if reachable_fresh and not requests.pending:                    # Nothing has changed since the last REACHABLE, so it is sent from that
+        sendData(destinationID, reachable, client)
+        return
+    sendUpdatePosition(client, lambda reachable: sendData(destinationID, reachable, client))
+
+#
+# sendData()
+# Sends a data message to the server in the form:
+# DATAMESSAGE [OriginID] [NextID] [DestinationID] [HopListLength] [HopList]
+#
+def sendData(destinationID, reachable, client):
+    global sending_data
+    sending_data -= 1
     nextID = "-1"
-    hopListLength = 1
-    hopList = [sensor_id]							# Start off with the current sensor in hop list
+    hopList = [sensor_id]                           # Start off with the current sensor in hop list
 
     # Check for case where no reachable nodes
     if(len(reachable) == 0):
-    	print_str = "{}: Message from {} to {} could not be delivered.".format(sensor_id, sensor_id, destinationID)
-    	print(print_str)
-    	return # No data should be sent to control in this case
+        events.emit('undeliverable', sensor_id, sensor_id, destinationID, 0)
+        return # No data should be sent to control in this case
 
-    #print(reachable)
     # Check if element in list matches dest name
-    dest_reachable = False							# Variable to track if destination immediately reachable
+    dest_reachable = False                          # Variable to track if destination immediately reachable
     for key,(x,y) in reachable.items():
-    	if key == destinationID:
-    		nextID = destinationID 					# destID becomes our nextID
-    		dest_reachable = True
-    		break
+        if key == destinationID:
+            nextID = destinationID                  # destID becomes our nextID
+            dest_reachable = True
+            break
 
     # Find the next closest node to send if dest isn't reachable
     if dest_reachable == False:
-    	print_str = "{}: Sent a new message bound for {}.".format(sensor_id, destinationID)
+        events.emit('sent', sensor_id, sensor_id, destinationID, 0)
     else:
-        print_str = "{}: Sent a new message directly to {}.".format(sensor_id, nextID)
-    print(print_str)
+        events.emit('sent_direct', sensor_id, sensor_id, nextID, 0)
 
-    # Format the string
-    send_string = "DATAMESSAGE {} {} {} {} {}".format(sensor_id, nextID, destinationID, hopListLength, hopList)
-    client.send(send_string.encode('utf-8'))        # Send the message
+    # Encode the message, DATAMESSAGE [OriginID] [NextID] [DestinationID] [HopListLength] [HopList]
+    requests.queue(codec.dataMessage(sensor_id, nextID, destinationID, hopList))         # Send the message
 
 #
 # handleMove()
@@ -109,32 +176,80 @@ def handleSendData(destinationID, client):
 # to send an updateposition call
 #
 def handleMove(new_x, new_y, client):
-    global x_coordinate, y_coordinate               # Must first recognize scope
+    global x_coordinate, y_coordinate, reachable_fresh      # Must first recognize scope
     x_coordinate = new_x                            # Assigns the new variables to the global ones
     y_coordinate = new_y
+    reachable_fresh = False                         # Out of date until the reply
+    where_cache.pop(sensor_id, None)
     sendUpdatePosition(client)                      # Updates the server with the new coordinates
 
 #
 # handleWhere()
-# Handles the where clause from stdin.
+# Handles the where clause from stdin. With --cache, a position still cached is printed
+# straight away, when no reply is outstanding to print ahead of it.
 #
-def handleWhere(send_string, client):
-    client.send(send_string.encode('utf-8'))        # Sends the WHERE to the server
-    buf = client.recv(1024)                         # We block on this recv call
-    print(buf.decode())                             # print it to the terminal
+def handleWhere(nodeID, client):
+    position = cachedWhere(nodeID)
+    if position is not None and not requests.pending and not sending_data:
+        events.output("THERE {} {} {}".format(nodeID, position[0], position[1]))
+        return
+    requests.send(codec.where(nodeID), ('THERE',), printThere)         # Sends the WHERE to the server, and prints the THERE when it comes
+
+def printThere(there):
+    rememberThere(there)
+    events.output("THERE {} {} {}".format(there[1], there[2], there[3]))
 
 #
 # internalWhere()
-# handles where calls needed by the code
+# handles where calls needed by the code: then gets {ID: (x, y)} once the THERE is in, or at
+# once from the cache
 #
-def internalWhere(nodeID, client):
-	send_string = "WHERE {}".format(nodeID)
-	client.send(send_string.encode('utf-8'))
-	buf = client.recv(1024)
-	there = buf.decode('utf-8').split()
+def internalWhere(nodeID, client, then):
+    position = cachedWhere(nodeID)
+    if position is not None:
+        then({nodeID: position})
+        return
+    requests.send(codec.where(nodeID), ('THERE',), lambda there: internalThere(there, then))
 
-	return {there[1]: ( int(there[2]),int(there[3]) )}
+def internalThere(there, then):
+    rememberThere(there)
+    then({there[1]: (int(there[2]), int(there[3]))})
 
+#
+# rememberThere()
+# Takes a THERE, and caches the position in it if the server sent it as cacheable: for good for a
+# base station, and for up to cache_ttl seconds for a sensor.
+#
+def rememberThere(there):
+    if len(there) < 5:                                              # No --cache, or a node the server does not know
+        return
+    expires = None if int(there[4]) else time.monotonic() + cache_ttl
+    where_cache[there[1]] = (int(there[2]), int(there[3]), expires)
+
+#
+# cachedWhere()
+# Takes an ID, and returns its cached (x, y), or None if it is not cached or has expired.
+#
+def cachedWhere(nodeID):
+    entry = where_cache.get(nodeID)
+    if entry is None:
+        return None
+    if entry[2] is not None and entry[2] <= time.monotonic():
+        del where_cache[nodeID]
+        return None
+    return entry[0], entry[1]
+
+#
+# handleInvalidate()
+# Takes the IDs of an INVALIDATE the server pushed: sensors that moved, whose cached positions
+# go, and this sensor's own ID when its reachable dict is no longer what the server would answer.
+#
+def handleInvalidate(ids):
+    global reachable_fresh
+    for id in ids:
+        where_cache.pop(id, None)
+        if id == sensor_id:
+            reachable_fresh = False
 
 #
 # readFromCommand()
@@ -142,67 +257,178 @@ def internalWhere(nodeID, client):
 # initial X position, and initial Y position. Stores in global variables for refrence
 #
 def readFromCommand():
-    if len(sys.argv) != 7:                                          # Ensuring the proper number of command-line agrs
-        print("Error, correct usage is {} [control address] [control port] [SensorID] [SensorRange] [InitalXPosition] [InitialYPosition]".format(sys.argv[0]))
-
     # Reading values from the command line and declaring them as global variables
-    global control_address, control_port, sensor_id, sensor_range, x_coordinate, y_coordinate
-    control_address = sys.argv[1]
-    control_port = int(sys.argv[2])
-    sensor_id = sys.argv[3]
-    sensor_range = sys.argv[4]
-    x_coordinate = sys.argv[5]
-    y_coordinate = sys.argv[6]
+    global control_address, control_port, sensor_id, sensor_range, x_coordinate, y_coordinate, options, cache_ttl
+    argv, options = splitOptions(sys.argv)                          # Pulls out the optional flags, i.e. --framed
+    cache_ttl = float(options.get('cache-ttl', cache_ttl))
+    if len(argv) != 7:                                              # Ensuring the proper number of command-line agrs
+        print("Error, correct usage is {} [control address] [control port] [SensorID] [SensorRange] [InitalXPosition] [InitialYPosition] [--framed] [--binary] [--delta] [--cache] [--cache-ttl=seconds] [--log-format=text|json] [--log-file=file] [--log-sync]".format(argv[0]))
+
+    control_address = argv[1]
+    control_port = int(argv[2])
+    sensor_id = argv[3]
+    sensor_range = argv[4]
+    x_coordinate = argv[5]
+    y_coordinate = argv[6]
+
+#
+# negotiate()
+# Takes the connected socket, and picks the codec to speak. With --framed, --binary, --delta or
+# --cache, the client sends HELLO, asking for "tags" too, and waits for the server's answer; a
+# server that does not answer in time only speaks text, framed with --framed. Otherwise no HELLO
+# is sent and the connection is plain text.
+#
+def negotiate(client):
+    global codec
+    wanted = [feature for feature in FEATURES if feature in options]
+    if 'cache' in wanted and 'binary' not in wanted and 'framed' not in wanted:
+        wanted.insert(0, 'framed')                                  # INVALIDATEs are pushed, so replies must be framed to be told apart
+    codec = makeCodec((), 'framed' in options)
+    if not wanted:
+        return
+    if 'tags' not in wanted:
+        wanted.append('tags')                                       # Replies matched by tag, where the server can tag them
+    accepted = askHello(client, wanted)
+    if accepted is not None:                                        # None from an older server, which ignores HELLO
+        codec = makeCodec(accepted, 'framed' in options)
+
+#
+# handleServerMessage()
+# Takes one message from the server: a DATAMESSAGE or INVALIDATE pushed to this sensor, or the reply to the
+# oldest pending request. Commands held back until then go out after it.
+#
+def handleServerMessage(str_list, client):
+    if not str_list:
+        return
+    if str_list[0] == 'DATAMESSAGE':
+        handleDataMessage(str_list)
+    elif str_list[0] == 'INVALIDATE':
+        handleInvalidate(str_list[2])
+    else:
+        handleReply(str_list)
+    releaseHeld(client)
+
+#
+# canSend()
+# Takes a command from stdin, and returns whether it can go out now rather than wait its turn.
+# Commands are pipelined, without waiting for the replies to the ones before, except that:
+# a MOVE waits for the SENDDATAs before it to send their DATAMESSAGE from where they were, QUIT
+# waits for every reply, and unframed, where one reply could not be told from the next, every
+# command waits for the last reply. Once the server is gone, no reply is waited for.
+#
+def canSend(input_array):
+    if requests.gone:
+        return True
+    if input_array[0] == 'QUIT':
+        return not requests.pending and not sending_data
+    if not codec.framed and (requests.pending or sending_data):
+        return False
+    return not (input_array[0] == 'MOVE' and sending_data)
+
+#
+# releaseHeld()
+# Runs the held commands, in order, for as long as the first of them can go out.
+#
+def releaseHeld(client):
+    while held and canSend(held[0]):
+        runCommand(held.popleft(), client)
+
+#
+# serverGone()
+# Called once the server hangs up: nothing pending will be answered, so the held commands
+# (QUIT among them) no longer wait for it.
+#
+def serverGone(client):
+    global sending_data
+    requests.clear()
+    sending_data = 0
+    releaseHeld(client)
+
+#
+# runCommand()
+# Runs one command from stdin.
+#
+def runCommand(input_array, client):
+    global running
+    if(input_array[0] == 'QUIT'):                                               # RECIEVE QUIT MESSAGE
+        running = False
+        requests.drain()                                                        # The last DATAMESSAGE may still be on its way out
+        client.close()
+    elif(input_array[0] == 'MOVE'):                                             # RECIEVE MOVE MESSAGE
+        new_x = input_array[1]                                                  # Read in the new values from stdin
+        new_y = input_array[2]
+        handleMove(new_x, new_y, client)                                        # Pass them to the handler function
+    elif(input_array[0] == 'SENDDATA'):                                         # RECIEVE SENDDATE MESSAGE
+        destinationID = input_array[1]
+        handleSendData(destinationID, client)
+    elif(input_array[0] == 'WHERE'):                                            # RECIEVE WHERE MESSAGE
+        handleWhere(input_array[1], client)
+    else:
+        events.output('Command not supported. Try again')
 
 #
 # runCLient()
-# Reads-in commands from stdin whilst listening on the client-server port via select()
+# Reads-in commands from stdin whilst listening on the client-server port via select().
+# Nothing blocks on a reply: requests go out as commands come in, and each reply is handed to
+# the request it answers as it arrives.
 #
 def runClient():
+    global events, requests
+    events = openEventLog(options)                                      # Everything printed goes through it, in order
     # First, we connect to the server
     client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)          # Create the TCP socket, connect to the server
     client.connect((control_address, control_port))                     # Bind takes a 2-tuple, not 2 arguments
     inputs = [client, sys.stdin]                                        # Inputs for the select call
-    outputs = []
-    cond = True
+    negotiate(client)                                                   # Plain text, unless --binary or --delta and the server agrees
+    client.setblocking(False)
+    requests = RequestQueue(client, codec)
 
     # Before we read input in from the server, we send an UPDATEPOSITION message
     # in the form UPDATEPOSITION [SensorID] [SensorRange] [CurrentXPosition] [CurrentYPosition]
     sendUpdatePosition(client)
 
     # Now we actively listen on stdin and the client port to
-    while cond:
-        readable, writable, exceptional = select.select(inputs, outputs, inputs)
+    while running:
+        events.flush()                                                              # What the last pass printed, to the writer thread
+        readable, writable, exceptional = select.select(inputs, [client] if requests.outbound else [], inputs)
         for i in readable:
             if i is client:
-                data = i.recv(1024)
-                if data:
-                    str = data.decode().strip()
-                    str_list = str.split()                                          # Array of string inputs
-                    if(str_list[0] == 'DATAMESSAGE'):
-                        handleDataMessage(str_list, i)
-                    if i not in outputs:                                            # We add the readable to outputs if necessary
-                        outputs.append(i)
-            elif i is sys.stdin:                                                    # RECIEVING DATA FROM STDIN
-                input_message = sys.stdin.readline().strip()                        # Strip the ending of new line character
-                input_array = input_message.split()                                 # Prepping for multi-input stdin values
-                if(input_message == 'QUIT'):                                        # RECIEVE QUIT MESSAGE
-                    cond = False
-                    client.close()
-                elif(input_array[0] == 'MOVE'):                                     # RECIEVE MOVE MESSAGE
-                    new_x = input_array[1]                                          # Read in the new values from stdin
-                    new_y = input_array[2]
-                    handleMove(new_x, new_y, client)                                # Pass them to the handler function
-                elif(input_array[0] == 'SENDDATA'):                                 # RECIEVE SENDDATE MESSAGE
-                    destinationID = input_array[1]
-                    handleSendData(destinationID, client)
-                elif(input_array[0] == 'WHERE'):                                    # RECIEVE WHERE MESSAGE
-                    handleWhere(input_message, client)
+                try:
+                    data = i.recv(codec.read_size)
+                except BlockingIOError:
+                    continue
+                except ConnectionResetError:                                        # As good as hanging up
+                    data = b''
+                if not data:                                                        # The server hung up, stop listening to it
+                    inputs.remove(i)
+                    serverGone(client)
                 else:
-                    print('Command not supported. Try again')
-            else:
-                print("CONNECTED2")
-                                                                # Open the data and read it into an array
+                    for message in codec.feed(data):                                # Every complete message, in order
+                        handleServerMessage(message, i)
+                        if not running:
+                            break
+            elif i is sys.stdin:                                                    # RECIEVING DATA FROM STDIN
+                for input_message in readLines(sys.stdin.fileno(), stdin_buffer):   # Every line it has, not just the first
+                    input_array = input_message.strip().split() or ['']             # Prepping for multi-input stdin values
+                    if not input_message:                                           # The end of stdin is as good as QUIT
+                        input_array = ['QUIT']
+                    if not held and canSend(input_array):
+                        runCommand(input_array, client)
+                    else:
+                        held.append(input_array)
+                    if input_array[0] == 'QUIT':                                    # Nothing after QUIT is read
+                        inputs.remove(sys.stdin)
+                        break
+                    if not running:
+                        break
+            if not running:
+                break
+        if running and writable and requests.outbound:
+            requests.flush()
+        if running and requests.gone and client in inputs:                         # A send found the server gone before a recv() did
+            inputs.remove(client)
+            serverGone(client)
+    events.close()                                                              # Whatever is still waiting to be printed
 
 
 #
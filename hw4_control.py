@@ -11,27 +11,117 @@
 import sys
 import socket
 import select
-import queue
+import selectors
 import math
+import collections
+import pickle
+import itertools
+import heapq
+import multiprocessing
+import time
+import cProfile
+from hw4_protocol import PacketReader, TextCodec, packet, splitOptions, makeCodec, hello, FEATURES
+from hw4_topology import loadTopology
+from hw4_metrics import Metrics
+from hw4_events import openEventLog
+try:
+    import numpy
+except ImportError:                     # Only needed by --storage=arrays, which falls back to Graph without it
+    numpy = None
 
 control_port = None                     # The port the server should listen on for sensors to connect to
 graph = None
-all_connections = {}
+route_cache = None                      # The RouteCache over graph, rebuilt with it
+cell_size = 10                          # The side of a grid cell, from --cell-size or the base station file, see readFromCommand()
+all_connections = {}                    # SensorId: the socket to send its DATAMESSAGEs to, shared by every sensor of a gateway
+connection_sensors = {}                 # Socket: {SensorId} of the sensors whose address it is
+options = {}                            # The optional --flags from the command line, e.g. --framed
+codecs = {}                             # Socket: the TextCodec or BinaryCodec it speaks, holding its partially received messages
+message_queues = {}                     # Socket: the OutboundQueue of the bytes still waiting to be sent to it
+reachable_sent = {}                     # SensorId: (socket, sequence number, {NodeId: (x, y)}) of the last REACHABLE sent, for "delta" sensors
+cache_watchers = {}                     # SensorId: the "cache" sockets told where it is by a THERE, until they are sent an INVALIDATE for it
+watched = {}                            # Socket: {SensorId} of the cache_watchers entries it is in, to leave them when it closes
+reachable_cached = set()                # SensorId of the "cache" sensors holding a REACHABLE no INVALIDATE has been sent about since
+inputs = []                             # The objects select() reads from, for the select engine
+outputs = {}                            # Socket: None for the sockets with queued output, watched for writability
+selector = None                         # The selectors.DefaultSelector, for the selectors engine
+writing = set()                         # The sockets registered with it for EVENT_WRITE too
+stdin_polled = False                    # Whether stdin is a regular file epoll can not watch, read once a pass instead
+metrics = Metrics()                     # Command latencies and counters, shown by STATS
+events = None                           # The EventLog every line of output goes through, see hw4_events.py
+stats_path = None                       # Where --stats dumps the metrics as JSON
+stats_every = 10.0                      # Seconds between those dumps (--stats-every)
+next_dump = 0.0                         # time.monotonic() of the next dump
+high_water = 1 << 20                    # Bytes queued for a sensor past which it is congested (--high-water)
+low_water = 1 << 18                     # Bytes it must drain under to stop being congested (--low-water, a quarter of --high-water by default)
+overflow = 'disconnect'                 # What is done about a congested sensor (--overflow), see sendBytes()
+OVERFLOW_POLICIES = ('disconnect', 'drop-new', 'drop-oldest')
+coalesce_window = None                  # Seconds UPDATEPOSITIONs are held for to be coalesced (--coalesce), None to apply each straight away
+held_moves = []                         # (SensorID, SensorRange, X, Y) of every UPDATEPOSITION held, in the order they came
+held_replies = []                       # (SensorId, socket) owed a REACHABLE for each of them
+held_due = 0.0                          # time.monotonic() by which the held moves are applied
+TIMED = ('HELLO', 'UPDATEPOSITION', 'UPDATEPOSITIONS', 'WHERE', 'DATAMESSAGE', 'RESYNC')    # The sensor commands with their own histogram
+
+shard_layout = None                     # The ShardLayout, in sharded (--shards) mode
+shard_sockets = {}                      # Socket: shard index, for the front's ends of the worker sockets
+shard_ends = []                         # The same sockets, by shard index
+shard_readers = {}                      # Socket: PacketReader for the replies coming back from a worker
+shard_outbox = []                       # By shard index: the packets for its worker queued this pass, see flushShards()
+base_stations = []                      # (BaseId, XPos, YPos, [edges]) from the file, for the workers to slice up
+directory = {}                          # NodeId: (x, y, range, insertion number), every node as the front knows it
+sensor_shards = {}                      # SensorId: the set of shards holding a copy of it
+sensor_versions = {}                    # SensorId: how many times it has moved, so shards can spot stale links
+shard_requests = {}                     # Request number: the state of a move or a route that is out with the shards
+shard_request_ids = itertools.count()   # Hands out the request numbers
+shard_backlog = {}                      # Socket: deque of its commands held back while one of its requests is out
+shard_batches = {}                      # Socket: the state of its UPDATEPOSITIONS, while its moves go out one by one
+shard_moving = collections.Counter()    # Shard index: how many moves out (an UPDATEPOSITIONS counting as one) it is in
+shard_walking = collections.Counter()   # Shard index: how many walks out have been through it
+walk_targets = collections.Counter()    # NodeId: how many walks out are headed for it
+shard_waiting = collections.deque()     # (kind, value, function, args) of the moves and walks held back, see startShardWork()
+shard_releasing = False                 # Whether releaseShardWork() is sending work out
+shard_recheck = False                   # Whether work ended meanwhile, so it has to look again
 
 #
 # class Graph
 # Used to represent the graph of base stations. Contains two dictionary values:
-# Graph: with a key value pair of NodeId: [List of edges]
+# Graph: with a key value pair of NodeId: {Edges}, an insertion-ordered dict used as a set
+# Reverse: with a key value pair of NodeId: {Nodes that have an edge to NodeId}
 # Positions: with a key value pair of NodeId: (x_coordinate, y_coordinate)
+# Nodes are also bucketed into a uniform grid of cell_size squares, so find_edges
+# only has to look at the cells a sensor's range can reach. An adaptive grid is rebuilt
+# at the typical sensor range once most ranges asked about are far bigger or smaller
+# than a cell, when either a few huge cells or a great many cells would be visited.
+# Every change to a node's edges or position bumps the graph epoch and stamps the
+# node with it, which is what the RouteCache checks its entries against.
 #
 class Graph(object):
-    def __init__(self, graph_dict=None):                            # Used to initialize the graph
+    scale_limit = 8                                                 # How many times bigger or smaller than a cell a range can be and still fit the grid
+    regrid_after = 64                                               # Ranges that do not fit, net of those that do, before an adaptive grid is rebuilt
+
+    def __init__(self, graph_dict=None, cell_size=10, adaptive=False):  # Used to initialize the graph
         if graph_dict == None:                                      # Allows for the option to pass a dictionary
             graph_dict = {}
-        self.graph = graph_dict
+        self.graph = {}
+        self.reverse = {}                                           # The reverse index, so removing a node's edges only visits its neighbours
         self.positions = {}                                         # An associated dictionary with the coordinates
         self.type = {}                                              # An associated dictionary with the type of object
                                                                     # i.e. if the object is a sensor (Range Value), or a base station (-1)
+        self.order = {}                                             # NodeId: insertion number, so range queries can replay the scan order of self.graph
+        self.added = 0                                              # The next insertion number
+        self.epoch = 0                                              # Bumped on every change to the graph
+        self.stamps = {}                                            # NodeId: the epoch its edges or position last changed in
+        for node in graph_dict:
+            self.graph[node] = {}
+            self.order[node] = self.added
+            self.added += 1
+        for node in graph_dict:
+            for edge in graph_dict[node]:
+                self.add_edge(node, edge)
+        self.cell_size = cell_size                                  # Side length of a spatial grid cell
+        self.cells = {}                                             # (cell_x, cell_y): {NodeId: None}, the spatial index over positions
+        self.adaptive = adaptive                                    # Whether the grid follows the sensor ranges, see rescale()
+        self.misfits = 0                                            # The ranges that did not fit the grid, net of those that did
 
     def vertices(self):                                             # Returns the number of verticies within the graph
         return list(self.graph.keys())
@@ -41,78 +131,419 @@ class Graph(object):
 
     def add_node(self, node, x, y, range):                          # Adds a node value if it not already in the graph
         if node not in self.graph:                                  # graph.add_node("b")
-            self.graph[node] = []
+            self.graph[node] = {}
+            self.order[node] = self.added
+            self.added += 1
+            self.touch(node)
         if node not in self.positions:                              # We have an associated dictionary with the coordinate values
             self.positions[node] = (int(x), int(y))
+            self.cells.setdefault(self.cell(self.positions[node]), {})[node] = None
         if node not in self.type:
             self.type[node] = float(range)                          # assigns the boolean value, TRUE if it is a base station, FALSE otherwise
 
-    def add_edge(self, id, edge):                                   # Adds an edge between two locations in the form:
-        if id in self.graph:
-            self.graph[id].append(edge)
+    def add_edge(self, id, edge):                                   # Adds an edge between two locations, ignoring duplicates
+        if id in self.graph and edge not in self.graph[id]:
+            self.graph[id][edge] = None
+            self.reverse.setdefault(edge, {})[id] = None
+            self.touch(id)
+
+    def touch(self, node):                                          # Records that a node's edges or position just changed
+        self.epoch += 1
+        self.stamps[node] = self.epoch
+
+    def move_node(self, node, x, y):                                # Updates the position of a node, keeping the spatial grid in step
+        old_cell = self.cell(self.positions[node])
+        self.positions[node] = (int(x), int(y))
+        self.touch(node)
+        new_cell = self.cell(self.positions[node])
+        if new_cell != old_cell:                                    # Only touch the grid when the node crossed into another cell
+            del self.cells[old_cell][node]
+            if not self.cells[old_cell]:
+                del self.cells[old_cell]
+            self.cells.setdefault(new_cell, {})[node] = None
+
+    def cell(self, position):                                       # Returns the grid cell that holds a position
+        return (position[0] // self.cell_size, position[1] // self.cell_size)
+
+    def rescale(self, distance):                                    # Counts a range asked about against the grid, and rebuilds it
+        if not self.adaptive or not 0 < distance < math.inf:        # once too many have not fitted it
+            return
+        if distance > self.cell_size * self.scale_limit or distance * self.scale_limit < self.cell_size:
+            self.misfits += 1
+            if self.misfits >= self.regrid_after:
+                self.regrid()
+        elif self.misfits:
+            self.misfits -= 1
+
+    def regrid(self):                                               # Rebuilds the grid with cells the median sensor range across
+        self.misfits = 0
+        ranges = sorted(r for r in map(float, self.type.values()) if 0 < r < math.inf)
+        if not ranges:
+            return
+        self.cell_size = max(1, int(ranges[len(ranges) // 2]))
+        self.cells = {}
+        for node, position in self.positions.items():
+            self.cells.setdefault(self.cell(position), {})[node] = None
+
+    def nearby(self, position, distance):                           # Returns every node whose cell overlaps the square of side 2*distance
+        if distance < 0:                                            # around position, in the same order as a scan of self.graph
+            return []
+        if math.isinf(distance) or math.isnan(distance):
+            return list(self.graph)
+        low_x = math.floor((position[0] - distance) / self.cell_size)
+        high_x = math.floor((position[0] + distance) / self.cell_size)
+        low_y = math.floor((position[1] - distance) / self.cell_size)
+        high_y = math.floor((position[1] + distance) / self.cell_size)
+        candidates = []
+        if (high_x - low_x + 1) * (high_y - low_y + 1) <= len(self.cells):
+            for cx in range(low_x, high_x + 1):                     # Small query: probe each cell in the square
+                for cy in range(low_y, high_y + 1):
+                    if (cx, cy) in self.cells:
+                        candidates.extend(self.cells[(cx, cy)])
+        else:                                                       # Huge range: cheaper to filter the occupied cells
+            for (cx, cy), nodes in self.cells.items():
+                if low_x <= cx <= high_x and low_y <= cy <= high_y:
+                    candidates.extend(nodes)
+        candidates.sort(key=self.order.__getitem__)
+        return candidates
+
+    def remove_node(self, node):                                    # Takes a node, and all of its edges, out of the graph
+        self.removeEdgesId(node)
+        self.clear_edges(node)
+        cell = self.cell(self.positions.pop(node))
+        del self.cells[cell][node]
+        if not self.cells[cell]:
+            del self.cells[cell]
+        del self.graph[node]
+        del self.type[node]
+        del self.order[node]
+        self.stamps.pop(node, None)                                 # Anything cached against it no longer matches
 
-    def find_edges(self, node, range):                              # Called by SENSORS ONLY, calculates all the connected values with EUCLEAN DISTANCE
-        range = float(range)
+    def find_edges(self, node, range, accept=None):                 # Called by SENSORS ONLY, calculates all the connected values with EUCLEAN DISTANCE
+        range = float(range)                                        # accept, if given, picks which vertices may be linked at all
         if self.type[node] == -1:                                   # Returns nothing if a base-station calls it
             return
-        else:                                                       # Otherwise, I loop through all the positions and calculate the edges
-            a = self.positions[node]                                # Gathering the current location of the node
-            for vertex in self.graph:
-                if vertex != node:
-                    b = self.positions[vertex]                          # Getting each vertex's location (x and y values) to calculate the distance
-                    dst = math.sqrt( (a[0]-b[0])**2 + (a[1]-b[1])**2 )
-                    if(self.type[vertex] == -1):                        # If it is a base station, all we need to check for an edge is the sensor's distance
-                        if(range >= dst):                               # If the point is within range ... we can add an edge to the base station and sensor
-                            self.add_edge(node, vertex)
-                            self.add_edge(vertex, node)
-                    else:                                               # Otherwise, if it is a sensor, they both have to be in range of one another
-                        range2 = self.type[vertex]
-                        if(float(range)>=dst and float(range2)>=dst):   # Here, we check to see if the ranges are compatable
-                            self.add_edge(node, vertex)             # and we add the edges accordingly
-                            self.add_edge(vertex, node)
+        else:                                                       # Otherwise, I loop through the positions near the node and calculate the edges
+            self.rescale(range)
+            self.link_within(node, range, self.nearby(self.positions[node], range), accept)  # Anything outside the grid square is out of range anyway
+
+    def link_within(self, node, range, candidates, accept):         # Adds the edges between node and each of the candidates in range, in order
+        a = self.positions[node]                                    # Gathering the current location of the node
+        for vertex in candidates:
+            if vertex != node and (accept is None or accept(vertex)):
+                b = self.positions[vertex]                          # Getting each vertex's location (x and y values) to calculate the distance
+                dst = math.sqrt( (a[0]-b[0])**2 + (a[1]-b[1])**2 )
+                if(self.type[vertex] == -1):                        # If it is a base station, all we need to check for an edge is the sensor's distance
+                    if(range >= dst):                               # If the point is within range ... we can add an edge to the base station and sensor
+                        self.add_edge(node, vertex)
+                        self.add_edge(vertex, node)
+                else:                                               # Otherwise, if it is a sensor, they both have to be in range of one another
+                    range2 = self.type[vertex]
+                    if(float(range)>=dst and float(range2)>=dst):   # Here, we check to see if the ranges are compatable
+                        self.add_edge(node, vertex)                 # and we add the edges accordingly
+                        self.add_edge(vertex, node)
+
+    def load(self, topology):                                       # Fills an empty graph with the base stations of a Topology, in bulk
+        names = topology.names
+        nodes = names[:topology.count]
+        links = list(map(names.__getitem__, topology.links))        # Every station's edges, one after the other
+        start = 0
+        for node, end in zip(nodes, topology.ends):
+            self.graph[node] = dict.fromkeys(links[start:end])
+            start = end
+        self.positions = dict(zip(nodes, zip(topology.xs, topology.ys)))
+        self.type = dict.fromkeys(nodes, -1.0)
+        self.order = dict(zip(nodes, range(len(nodes))))
+        self.added = len(nodes)
+        self.epoch += 1                                             # One change for the lot
+        self.stamps = dict.fromkeys(nodes, self.epoch)
+        for node, edges in self.graph.items():
+            for edge in edges:
+                self.reverse.setdefault(edge, {})[node] = None
+        size = self.cell_size
+        for node, (x, y) in self.positions.items():
+            self.cells.setdefault((x // size, y // size), {})[node] = None
+
+    def set_range(self, node, range):                               # Updates the range of a sensor
+        self.type[node] = range
+
+    def nearest(self, position, nodes, seen):                       # Returns the node nearest to position, and then alphanumeric,
+        best = None                                                 # among the nodes not in seen, or None if there is none
+        for node in nodes:
+            if node not in seen:                                    # Visited edges can never be picked, so skip them
+                b = self.positions[node]
+                candidate = (math.sqrt( (position[0]-b[0])**2 + (position[1]-b[1])**2 ), node)
+                if best is None or candidate < best:                # By distance, ties by id
+                    best = candidate
+        if best is None:
+            return None
+        return best[1]
+
+    def clear_edges(self, node):                                    # Removes all of the edges leaving "node"
+        for edge in self.graph[node]:
+            del self.reverse[edge][node]
+        self.graph[node] = {}
+        self.touch(node)
 
     def removeEdgesId(self, node):                                  # Removes all edge values with the same id value as "node"
-        for vertex in self.graph:
-            try:
-                self.graph[vertex].remove(node)                     # Deletes the value .... as i dont loop through to check...
-            except ValueError:                                      # I might get an error
-                pass                                                # do nothing in the case of getting the value error
+        for vertex in self.reverse.pop(node, {}):                   # Only the nodes that actually link to it need touching
+            del self.graph[vertex][node]
+            self.touch(vertex)
+
+#
+# class ArrayGraph
+# A Graph that also keeps every node's position and range in contiguous NumPy arrays (--storage=arrays):
+# Index: with a key value pair of NodeId: its slot in the arrays, slots of removed nodes going on a free list
+# Xs, Ys: the coordinates, as int64, so the squared distances are exact
+# Ranges: float(range) of each node, and Bases: whether its range is the base station -1
+# find_edges() and nearest() then work out the distances and range checks for all their nodes at once.
+# The dictionaries stay the record, so the result is exactly that of Graph, order included. Small
+# lists, and graphs with coordinates too large for int64 squares, go through Graph's loops.
+#
+class ArrayGraph(Graph):
+    vector_min = 16                                                 # Fewer nodes than this are quicker in plain Python
+    nearest_min = 64                                                # The same for nearest(), whose plain loop does less per node
+    exact_limit = 1 << 30                                           # Coordinates up to this keep dx*dx + dy*dy inside int64
+
+    def __init__(self, graph_dict=None, cell_size=10, adaptive=False, capacity=64):
+        self.index = {}                                             # NodeId: slot
+        self.free = []                                              # Slots of removed nodes, reused first
+        self.used = 0                                               # Slots handed out so far
+        self.wide = set()                                           # Nodes with a coordinate past exact_limit
+        self.xs = numpy.zeros(capacity, dtype=numpy.int64)
+        self.ys = numpy.zeros(capacity, dtype=numpy.int64)
+        self.ranges = numpy.zeros(capacity, dtype=numpy.float64)
+        self.bases = numpy.zeros(capacity, dtype=bool)
+        Graph.__init__(self, graph_dict, cell_size, adaptive)
+
+    def add_node(self, node, x, y, range):
+        Graph.add_node(self, node, x, y, range)
+        if node not in self.index:
+            if self.free:
+                slot = self.free.pop()
+            else:
+                if self.used == len(self.xs):                       # Full, so double the arrays
+                    self.xs = numpy.concatenate((self.xs, numpy.zeros_like(self.xs)))
+                    self.ys = numpy.concatenate((self.ys, numpy.zeros_like(self.ys)))
+                    self.ranges = numpy.concatenate((self.ranges, numpy.zeros_like(self.ranges)))
+                    self.bases = numpy.concatenate((self.bases, numpy.zeros_like(self.bases)))
+                slot = self.used
+                self.used += 1
+            self.index[node] = slot
+            self.store_position(node)
+            self.store_range(node)
+
+    def load(self, topology):
+        Graph.load(self, topology)
+        count = len(self.positions)
+        capacity = max(count, len(self.xs))
+        self.xs = numpy.zeros(capacity, dtype=numpy.int64)
+        self.ys = numpy.zeros(capacity, dtype=numpy.int64)
+        self.ranges = numpy.zeros(capacity, dtype=numpy.float64)
+        self.bases = numpy.zeros(capacity, dtype=bool)
+        self.index = dict(zip(self.positions, range(count)))
+        self.used = count
+        self.ranges[:count] = -1.0                                  # All base stations
+        self.bases[:count] = True
+        try:
+            self.xs[:count] = topology.xs
+            self.ys[:count] = topology.ys
+        except OverflowError:                                       # Some coordinates need more than int64
+            for node in self.positions:
+                self.store_position(node)
+            return
+        wide = (numpy.abs(self.xs[:count]) > self.exact_limit) | (numpy.abs(self.ys[:count]) > self.exact_limit)
+        self.wide.update(node for node, far in zip(self.positions, wide.tolist()) if far)
+
+    def move_node(self, node, x, y):
+        Graph.move_node(self, node, x, y)
+        self.store_position(node)
+
+    def set_range(self, node, range):
+        Graph.set_range(self, node, range)
+        self.store_range(node)
+
+    def remove_node(self, node):
+        Graph.remove_node(self, node)
+        self.free.append(self.index.pop(node))
+        self.wide.discard(node)
+
+    def store_position(self, node):                                 # Copies a node's position into its slot
+        x, y = self.positions[node]
+        if abs(x) > self.exact_limit or abs(y) > self.exact_limit:
+            self.wide.add(node)
+            return
+        self.wide.discard(node)
+        slot = self.index[node]
+        self.xs[slot] = x
+        self.ys[slot] = y
+
+    def store_range(self, node):                                    # Copies a node's range into its slot
+        slot = self.index[node]
+        self.bases[slot] = self.type[node] == -1                    # The same test Graph makes, so a "-1" string is still a sensor
+        self.ranges[slot] = float(self.type[node])
+
+    def slots(self, nodes):                                         # Returns the slots of the nodes, as an array
+        return numpy.fromiter(map(self.index.__getitem__, nodes), dtype=numpy.intp, count=len(nodes))
+
+    def distances_to(self, position, slots):                        # Returns the distances from position to the slots, as float64
+        dx = self.xs[slots] - position[0]                           # Exact in int64, then rounded once, as math.sqrt() rounds an int
+        dy = self.ys[slots] - position[1]
+        return numpy.sqrt((dx * dx + dy * dy).astype(numpy.float64))
+
+    def exact(self, position):                                      # Whether the arrays give the same distances as Graph from here
+        return not self.wide and abs(position[0]) <= self.exact_limit and abs(position[1]) <= self.exact_limit
+
+    def link_within(self, node, range, candidates, accept):
+        a = self.positions[node]
+        if len(candidates) < self.vector_min or not self.exact(a):
+            return Graph.link_within(self, node, range, candidates, accept)
+        slots = self.slots(candidates)
+        dst = self.distances_to(a, slots)
+        linked = range >= dst                                       # In the sensor's range, and for a sensor, the sensor in its range too
+        linked &= self.bases[slots] | (self.ranges[slots] >= dst)
+        for n in numpy.flatnonzero(linked).tolist():                # Still in candidate order
+            vertex = candidates[n]
+            if vertex != node and (accept is None or accept(vertex)):
+                self.add_edge(node, vertex)
+                self.add_edge(vertex, node)
+
+    def nearest(self, position, nodes, seen):
+        if len(nodes) < self.nearest_min or not self.exact(position):
+            return Graph.nearest(self, position, nodes, seen)
+        nodes = list(nodes)
+        dst = self.distances_to(position, self.slots(nodes))
+        dst[numpy.fromiter(map(seen.__contains__, nodes), dtype=bool, count=len(nodes))] = numpy.inf
+        best = dst.min()
+        if best == numpy.inf:                                       # All of them visited
+            return None
+        return min(nodes[n] for n in numpy.flatnonzero(dst == best).tolist())   # Ties by id
+
+#
+# class RouteCache
+# Remembers the results and walks of dfs() keyed by (OriginId, DestinationId). Each entry keeps the graph stamps
+# of the nodes it was computed from, and is only used while those stamps still match.
+# handleUpdatePosition also drops the entries that depend on the nodes a move touched.
+#
+class RouteCache(object):
+    def __init__(self, graph, max_entries=100000):
+        self.graph = graph
+        self.max_entries = max_entries                              # Oldest entries are evicted past this many
+        self.entries = {}                                           # (OriginId, DestinationId): (stamps, value)
+        self.watchers = {}                                          # NodeId: {the keys of the entries depending on it}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key):                                             # Returns the cached value, or None if missing or out of date
+        entry = self.entries.get(key)
+        if entry is not None:
+            stamps = self.graph.stamps
+            for node, stamp in entry[0]:
+                if stamps.get(node) != stamp:
+                    self.drop(key)
+                    break
+            else:
+                self.hits += 1
+                return entry[1]
+        self.misses += 1
+        return None
+
+    def put(self, key, nodes, value):                               # Stores a value computed from the given nodes
+        if len(self.entries) >= self.max_entries:
+            self.drop(next(iter(self.entries)))
+        stamps = self.graph.stamps
+        self.entries[key] = (tuple((node, stamps.get(node)) for node in nodes), value)
+        for node in nodes:
+            self.watchers.setdefault(node, set()).add(key)
+
+    def drop(self, key):                                            # Forgets one entry and its watcher links
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            for node, stamp in entry[0]:
+                watching = self.watchers.get(node)
+                if watching is not None:
+                    watching.discard(key)
+                    if not watching:
+                        del self.watchers[node]
+
+    def invalidate(self, nodes):                                    # Drops every entry whose walk touches these nodes
+        for node in nodes:
+            for key in list(self.watchers.get(node, ())):
+                self.drop(key)
+                self.invalidations += 1
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'invalidations': self.invalidations,
+                'entries': len(self.entries), 'epoch': self.graph.epoch}
+
+#
+# makeGraph()
+# Returns an empty graph with the storage picked by --storage: Graph's dictionaries (the default),
+# or the NumPy arrays of ArrayGraph, which fall back to the dictionaries if NumPy is not installed.
+# Its grid starts with cells cell_size across, and follows the sensor ranges unless --cell-size set them.
+#
+def makeGraph():
+    adaptive = 'cell-size' not in options                           # A --cell-size is kept whatever the sensors' ranges
+    if options.get('storage') == 'arrays':
+        if numpy is not None:
+            return ArrayGraph(cell_size=cell_size, adaptive=adaptive)
+        print("NumPy is not installed, using --storage=dicts", file=sys.stderr)
+    return Graph(cell_size=cell_size, adaptive=adaptive)
 
 #
 # inputToGraph()
-# Takes a file pointer as input, and converts the text file to a graph object
+# Takes the Topology read from the base station file, and converts it to a graph object
 #
-def inputToGraph(fp):
-    global graph
-    graph = Graph()                                                 # Initialize the graph object
-    for line in fp:                                                 # We need to parse the input
-        inputs = line.split()                                       # Creates an array of the values split on whitespace
-        BaseId = inputs[0]                                          # The Base id value
-        XPos = int(inputs[1])                                       # Y coordinate value
-        YPos = int(inputs[2])                                       # X coordinate value
-        NumLinks = int(inputs[3])                                   # The number of edges
-        edges = inputs[4:]                                          # All of the edges is what is left over
-        graph.add_node(BaseId, XPos, YPos, -1)                      # Adds the id to the graph
-        for i in edges:                                             # Adds all of the edges
-            graph.add_edge(BaseId, i)
+def inputToGraph(topology):
+    global graph, route_cache
+    graph = makeGraph()                                             # Initialize the graph object
+    route_cache = RouteCache(graph)                                 # And the routes cached against it
+    graph.load(topology)                                            # Adds every base station with its edges
+
+#
+# inputToShards()
+# Takes the Topology read from the base station file and the number of shards, and reads the base
+# stations into the front's directory, for the workers to build their slices of the graph from
+# (sharded mode).
+#
+def inputToShards(topology, count):
+    global shard_layout
+    for BaseId, XPos, YPos, edges in topology.stations():
+        base_stations.append((BaseId, XPos, YPos, edges))
+        directory[BaseId] = (XPos, YPos, -1, len(directory))
+    shard_layout = ShardLayout(count, topology.low, topology.high)
+
 #
 # readFromCommand()
 # Reads-in the values from the command-line: control port and text file
 #
 def readFromCommand():
-    if len(sys.argv) != 3:                                          # Ensuring the proper number of command-line agrs
-        print("Error, correct usage is {} [control port] [base station file]".format(sys.argv[0]))
+    global control_port, options, cell_size
+    argv, options = splitOptions(sys.argv)                          # Pulls out the optional flags, i.e. --framed
+    if len(argv) != 3:                                              # Ensuring the proper number of command-line agrs
+        print("Error, correct usage is {} [control port] [base station file] [--framed] [--engine=select|selectors] "
+              "[--storage=dicts|arrays] [--snapshot=off] [--cell-size=units] [--shards=N] [--high-water=bytes] "
+              "[--low-water=bytes] [--overflow=disconnect|drop-new|drop-oldest] [--coalesce[=microseconds]] "
+              "[--stats[=file]] [--stats-every=seconds] [--profile[=file]] [--log-format=text|json] [--log-file=file] "
+              "[--log-sync], see the Options section of README.md".format(argv[0]))
+        exit(1)
 
-    global control_port
-    control_port = sys.argv[1]                                      # The port to be listening on (global)
-    file = sys.argv[2]                                              # The file with the graph values
+    control_port = argv[1]                                          # The port to be listening on (global)
+    file = argv[2]                                                  # The file with the graph values
     try:
-        with open(file) as fp:                                      # If the file is valid, we now need to read it into a graph class
-            inputToGraph(fp)                                        # ^ This is that call, passes the file pointer to the function
-            fp.close()                                              # Closes the file
+        topology = loadTopology(file, options.get('snapshot') != 'off')    # From its snapshot if the file has not changed since
     except IOError:
             print("Could not read file: ", file)                    # If we catch an error, we can not proceed. Therefore, we exit
             exit(1)
+    if 'cell-size' in options:                                      # The grid's cells, or else the usual distance between linked stations
+        cell_size = max(1, int(options['cell-size']))
+    else:
+        cell_size = max(1, int(topology.spacing() or cell_size))
+    if 'shards' in options:                                         # Sharded, into the directory the workers are built from
+        inputToShards(topology, int(options['shards']))
+    else:
+        inputToGraph(topology)                                      # Otherwise we now need to read it into a graph class
 
 #
 # handleSendData()
@@ -120,45 +551,217 @@ def readFromCommand():
 # This is called in run() upon a senddata request.
 #
 def handleSendData(originID, destinationID, nextID):
-    client = all_connections[nextID]
-    send_string = "DATAMESSAGE {} {} {} {} {}".format(originID, nextID, destinationID, 0, '[]')
-    client.send(send_string.encode('utf-8'))        # Send the message
+    client = all_connections.get(nextID)
+    if client is None:                                              # It hung up, or was disconnected for falling behind
+        metrics.count('outbound_no_connection')
+        return
+    setup, message = codecs[client].dataMessageParts(originID, nextID, destinationID, [])
+    if setup:                                                       # IDs the binary codec defines, which later messages use
+        sendBytes(client, setup)
+    sendBytes(client, message, True)                                # Send the message, which a congested sensor may lose
+
+#
+# class OutboundQueue
+# The bytes still waiting to be sent to one socket, oldest first:
+# Chunks: a deque of [bytes, droppable]. Droppable marks a DATAMESSAGE pushed to a sensor, which
+# --overflow may throw away; replies never are, as a sensor matches them to its requests in order,
+# and nor is a chunk once part of it went out, as the rest of the stream would be garbled.
+# Size: the bytes in all of the chunks
+# Congested: set once the size passes the high-water mark, until it drains under the low-water mark
+#
+class OutboundQueue(object):
+    def __init__(self):
+        self.chunks = collections.deque()
+        self.size = 0
+        self.congested = False
+
+    def __bool__(self):                                             # Whether anything is waiting
+        return bool(self.chunks)
+
+    def append(self, data, droppable=False):
+        self.chunks.append([data, droppable])
+        self.size += len(data)
+
+    def sent(self, count):                                          # Takes how many bytes of the first chunk the socket took
+        chunk = self.chunks[0]
+        self.size -= count
+        if count == len(chunk[0]):
+            self.chunks.popleft()
+        elif count:
+            chunk[0] = chunk[0][count:]
+            chunk[1] = False
 
+    def dropNewest(self):                                           # Drops the chunk just appended. Returns its size
+        data, droppable = self.chunks.pop()
+        self.size -= len(data)
+        return len(data)
+
+    def dropOldest(self, limit):                                    # Drops droppable chunks, oldest first, until the size is down to limit.
+        kept = collections.deque()                                  # Returns how many chunks and bytes went
+        dropped = freed = 0
+        for chunk in self.chunks:
+            if chunk[1] and self.size - freed > limit:
+                dropped += 1
+                freed += len(chunk[0])
+            else:
+                kept.append(chunk)
+        self.chunks = kept
+        self.size -= freed
+        return dropped, freed
 
 #
-# distances()
-# Takes a destinationID and an originID. It computes all of the distances
-# From each edge of the originID to the destinationId, and returns a sorted
-# list of all of the edges by distance and then alphanumeric.
+# sendBytes()
+# Takes a socket, a message already encoded by its codec and whether the message may be dropped,
+# and sends it. Whatever the socket will not take right away is queued, and the socket is handed
+# to select() to be flushed once it is writable, so a slow sensor never holds up anyone else.
+# A sensor with more than --high-water bytes queued is congested until it drains under
+# --low-water, and --overflow says what is done about it:
+# disconnect: it is disconnected, the default
+# drop-new: droppable messages are thrown away for as long as it is congested
+# drop-oldest: past the high-water mark, the oldest droppable messages are thrown away, down to
+# the low-water mark
+# The links to the shards are never limited.
 #
-def distances(destinationID, originID):
-    global graph
-    distances_for_originID = {}
-    a = graph.positions[destinationID]                          # We choose the next node to traverse to by the shortest distance
-    for edge in graph.graph[originID]:
-        b = graph.positions[edge]
-        dst = math.sqrt( (a[0]-b[0])**2 + (a[1]-b[1])**2 )
-        distances_for_originID[edge] =  dst                     # A dictionary with all keys being edges of the origin id, values being distances
+def sendBytes(client, data, droppable=False):
+    if client.fileno() == -1:                                       # Closed since, e.g. disconnected earlier in the same command
+        return
+    queue = message_queues.setdefault(client, OutboundQueue())
+    metrics.count('bytes_out', len(data))
+    if not queue:                                                   # Nothing queued ahead of it, so try to send it straight away
+        start = time.perf_counter()
+        try:
+            sent = client.send(data)
+        except BlockingIOError:
+            sent = 0
+        except OSError:                                             # Reset by the sensor, which the next read will find out too
+            metrics.count('outbound_send_errors')
+            closeConnection(client)
+            return
+        metrics.record('send', time.perf_counter() - start)
+        if sent == len(data):
+            return
+        data = data[sent:]
+        droppable = droppable and not sent
+        outputs[client] = None
+    queue.append(data, droppable)
+    if client in shard_sockets:
+        return
+    if queue.size > high_water and not queue.congested:
+        queue.congested = True
+        metrics.count('outbound_congested')
+    if not queue.congested:
+        return
+    if overflow == 'disconnect':
+        metrics.count('outbound_disconnected')
+        closeConnection(client)
+        return
+    if overflow == 'drop-new':
+        if droppable:
+            metrics.count('outbound_dropped_new')
+            metrics.count('outbound_dropped_bytes', queue.dropNewest())
+    elif overflow == 'drop-oldest' and queue.size > high_water:
+        dropped, freed = queue.dropOldest(low_water)
+        metrics.count('outbound_dropped_oldest', dropped)
+        metrics.count('outbound_dropped_bytes', freed)
+    if queue.size <= low_water:                                     # Drained by the drop, maybe to nothing, which flushOutput() never sees
+        queue.congested = False
+
+#
+# flushOutput()
+# Called when select() reports a socket as writable. Sends as much of its queue as it takes.
+#
+def flushOutput(client):
+    queue = message_queues.get(client)
+    while queue:
+        data = queue.chunks[0][0]
+        try:
+            sent = client.send(data)
+        except BlockingIOError:
+            return
+        except OSError:
+            metrics.count('outbound_send_errors')
+            closeConnection(client)
+            return
+        queue.sent(sent)                            # A partial write keeps the rest at the front of the queue
+        if queue.congested and queue.size <= low_water:
+            queue.congested = False
+        if sent < len(data):
+            return
+    outputs.pop(client, None)                       # Drained, so stop asking select() about it
 
-    sort = sorted(distances_for_originID.items(), key=lambda item: (item[1], item[0])) # The sorted list
-    return sort
+#
+# closeConnection()
+# Takes a socket that has hung up, and forgets everything held for it.
+#
+def closeConnection(client):
+    if client in inputs:
+        inputs.remove(client)
+    if selector is not None:
+        selector.unregister(client)
+    writing.discard(client)
+    outputs.pop(client, None)
+    message_queues.pop(client, None)
+    codecs.pop(client, None)
+    shard_backlog.pop(client, None)
+    metrics.count('connections_closed')
+    for id in watched.pop(client, ()):                              # Only the sensors it was told about
+        cache_watchers[id].discard(client)
+        if not cache_watchers[id]:
+            del cache_watchers[id]
+    for id in connection_sensors.pop(client, ()):                   # Only its own sensors, not a scan of every one
+        del all_connections[id]
+        reachable_cached.discard(id)
+        if id in reachable_sent and reachable_sent[id][0] is client:
+            del reachable_sent[id]
+    client.close()
 
 
+#
+# nextHop()
+# Takes a destinationID, a nodeID and the set of visited nodes, and returns the unvisited edge of
+# nodeID nearest to the destination, ties by id, or None if there is none. The graph keeps a
+# running minimum, over the arrays at once in an ArrayGraph.
+# target is the destination's position, for when it is not in this graph (a shard's slice).
+#
+def nextHop(destinationID, nodeID, seen, target=None):
+    global graph
+    a = graph.positions[destinationID] if target is None else target
+    return graph.nearest(a, graph.graph[nodeID], seen)
+
 #
 # dfs()
 # Takes a start_node, empty vitited array and an end node,
 # and returns the finished visitied list if there is a path found.
 # Otherwise, it returns nothing.
+# The walk is greedy (it never backtracks), so it is run as a loop rather than recursing once
+# per hop, with a set beside the visited list for the membership checks.
 #
 def dfs(start_node, visited, end_node):
-    global graph
-    visited.append(start_node)
-    if start_node == end_node:                                  # If we found the end node, we csn return the visited list
-        return visited
-    dist = distances(end_node, start_node)                      # Otherwise, we get an array of all the distances of edges of the startID
-    for neighbour in dist:                                      # Loop over all of these edges
-        if neighbour[0] not in visited:                         # If it hasnt been visited, we can ... recurse on that value !
-            return dfs(neighbour[0], visited, end_node)
+    seen = set(visited)
+    node = start_node
+    while node is not None:
+        visited.append(node)
+        seen.add(node)
+        if node == end_node:                                    # If we found the end node, we csn return the visited list
+            return visited
+        node = nextHop(end_node, node, seen)                    # Otherwise, we move on to the closest unvisited edge
+    return None
+
+#
+# route()
+# Takes an originID and a destinationID, and returns what dfs() would, and the walk it took:
+# the path again if there is one, or else every node it went through before it got stuck. The
+# result is cached against every node the walk went through (and the destination), so repeated
+# sends between moves skip the search entirely.
+#
+def route(originID, destinationID):
+    cached = route_cache.get((originID, destinationID))
+    if cached is not None:
+        return cached
+    visited = []
+    path = dfs(originID, visited, destinationID)
+    route_cache.put((originID, destinationID), visited + [destinationID], (path, visited))
+    return path, visited
 
 #
 # handleDataMessage()
@@ -173,50 +776,62 @@ def handleDataMessage(str_list, server):
     destinationID = str_list[3]
     global graph
     cond = True
-    path = dfs(originID, [], destinationID)
+    start = time.perf_counter()
+    path, walk = route(originID, destinationID)
+    metrics.record('route', time.perf_counter() - start)
 
     # Handle the case where there isn't a path.
-    # Even though we know there isn't a path, we still need to play it out until it can't anymore
+    # Even though we know there isn't a path, we still need to play it out until it can't anymore.
+    # Sending to the unvisited node nearest to DEST, over and over, is the walk dfs() already took,
+    # so it is printed from there rather than walked again
     if path == None:
-        # Send to the node nearest to DEST reachable from client
-        nodes = distances(destinationID, originID)                     # Get reachable nodes sorted by increasing distance from dest
-        visited = [originID]
-        # While there are nodes to visit, visit them
-        # This loops through the "path" until there are no more moves
-        while len(nodes) > 0:
-            found_next = False
-            for i in nodes:
-                if i[0] not in visited:
-                    nextID = i[0]
-                    visited.append(nextID)
-                    print_string = "{}: Message from {} to {} being forwarded through {}".format(nextID, originID, destinationID, nextID)
-                    print(print_string)
-                    nodes = distances(destinationID, nextID)
-                    found_next = True
-                    break
-            # Onces there are no more moves, this runs
-            if found_next == False:
-                print_string = "{}: Message from {} to {} could not be delivered.".format(visited[-1], originID, destinationID)
-                print(print_string)
-                break
+        metrics.count('undeliverable')
+        reportWalk(originID, destinationID, walk, len(graph.graph[walk[-1]]) > 0)
     # Handle the case where the is a path
-    # In this case we do one move and hand off to the next client
     else:
-        i = 1
-        while i < len(path):
-            if(i == len(path)-1): #and graph.type[path[-1]] == '-1'):
-                if(graph.type[path[i]] == -1):
-                    print_string = "{}: Message from {} to {} successfully received.".format(destinationID, originID, destinationID)
-                    print(print_string)
-                else:
-                    handleSendData(originID, path[i], path[i])
+        reportPath(originID, destinationID, path)
+
+#
+# reportPath()
+# Takes the origin, destination and the path found between them, and plays it out:
+# base stations print as the message passes them, and each sensor on the way is sent the
+# DATAMESSAGE to hand off to the next client.
+#
+def reportPath(originID, destinationID, path):
+    i = 1
+    while i < len(path):
+        if(i == len(path)-1): #and graph.type[path[-1]] == '-1'):
+            if(isBaseStation(path[i])):
+                events.emit('received', destinationID, originID, destinationID, i)
             else:
-                if(graph.type[path[i]] == -1):
-                    print_string = "{}: Message from {} to {} being forwarded through {}".format(path[i], originID, destinationID, path[i])
-                    print(print_string)
-                else:
-                    handleSendData(originID, destinationID, path[i])
-            i += 1
+                handleSendData(originID, path[i], path[i])
+        else:
+            if(isBaseStation(path[i])):
+                events.emit('forwarded', path[i], originID, destinationID, i)
+            else:
+                handleSendData(originID, destinationID, path[i])
+        i += 1
+
+#
+# reportWalk()
+# Takes the origin, destination and the walk dfs() took before it got stuck, and prints it the
+# way the no-path case of handleDataMessage() does. stuck_with_edges is False when the walk
+# ended on a node with no edges at all, which ends the walk without a message.
+#
+def reportWalk(originID, destinationID, walk, stuck_with_edges):
+    for hop, nextID in enumerate(walk[1:], 1):
+        events.emit('forwarded', nextID, originID, destinationID, hop)
+    if stuck_with_edges:
+        events.emit('undeliverable', walk[-1], originID, destinationID, len(walk) - 1)
+
+#
+# isBaseStation()
+# Returns True if the id is one of the base stations (a range of -1).
+#
+def isBaseStation(id):
+    if shard_sockets:                                               # The front of a sharded server keeps no graph
+        return directory[id][2] == -1
+    return graph.type[id] == -1
 
 #
 # handleWhere()
@@ -227,11 +842,19 @@ def handleWhere(id, server):
     global graph
     x = -1
     y = -1
-    if(id in graph.positions):
-        x = graph.positions[id][0]
-        y = graph.positions[id][1]
-    send_string = "THERE {} {} {}".format(id, x, y)
-    server.send(send_string.encode('utf-8'))
+    positions = directory if shard_sockets else graph.positions     # The front of a sharded server answers from its directory
+    if(id in positions):
+        x = positions[id][0]
+        y = positions[id][1]
+    codec = codecs[server]
+    if 'cache' in codec.features and id in positions:               # A sensor that caches the answer is told whether it can keep it for good
+        permanent = isBaseStation(id)
+        if not permanent:
+            cache_watchers.setdefault(id, set()).add(server)
+            watched.setdefault(server, set()).add(id)
+        sendBytes(server, codec.there(id, x, y, permanent))
+    else:
+        sendBytes(server, codec.there(id, x, y))
 
 #
 # handleUpdatePosition()
@@ -246,84 +869,1058 @@ def handleUpdatePosition(value_list, server):
     new_x = value_list[3]
     new_y = value_list[4]
 
+    touched = {sensor_id}                                           # Every node whose cached routes this move can change
     if(sensor_id in graph.graph.keys()):                            # Check to see if the node is in the graph. If it is we update
-        graph.graph[sensor_id] = []                                 # Clear all of the edges
+        touched.update(graph.graph[sensor_id])
+        touched.update(graph.reverse.get(sensor_id, ()))
+        graph.clear_edges(sensor_id)                                # Clear all of the edges
         graph.removeEdgesId(sensor_id)                              # Removes all the edges with the passed sensor_id
-        graph.positions[sensor_id] = (int(new_x), int(new_y))       # Update the position
-        graph.type[sensor_id] = sensor_range                        # Update the range
-        graph.find_edges(sensor_id, sensor_range)                   # Finding all of the edges for the added node
+        graph.move_node(sensor_id, new_x, new_y)                    # Update the position (and its grid cell)
+        graph.set_range(sensor_id, sensor_range)                    # Update the range
     else:                                                           # If its not in the graph, we need to add it to the graph
         graph.add_node(sensor_id, new_x, new_y, sensor_range)       # Adding it to the graph
-        graph.find_edges(sensor_id, sensor_range)                   # Finding all of the edges for the added node
+    start = time.perf_counter()
+    graph.find_edges(sensor_id, sensor_range)                       # Finding all of the edges for the added node
+    metrics.record('find_edges', time.perf_counter() - start)
+
+    touched.update(graph.graph[sensor_id])
+    route_cache.invalidate(touched)
+    invalidateCaches({sensor_id}, touched)
 
-    num_reachable = len(graph.graph[sensor_id])                     # The number of reachable nodes
     reachable_list = []                                             # Initializing the reachable list
 
     for i in graph.graph[sensor_id]:
         x = graph.positions[i][0]
         y = graph.positions[i][1]
-        temp_string = "{} {} {}".format(i, x, y)                    # "Each entry in ReachableList is actually 3 strings: [ID] [XPosition] [YPosition].
-        reachable_list.append(temp_string)                          # Entries are separated by a space."
+        reachable_list.append((i, x, y))                            # "Each entry in ReachableList is actually 3 strings: [ID] [XPosition] [YPosition]."
 
-    send_string = "REACHABLE {} {}".format(num_reachable, reachable_list)
-    server.send(send_string.encode('utf-8'))                        # Sends the string to the client
+    sendReachable(server, sensor_id, reachable_list)                # Sends the REACHABLE to the client, in its encoding
     #print(graph.graph)
 
 #
-# run()
-# See https://pymotw.com/2/select/#module-select
-# Reads-in the commands from stdin whilst listening on the passed portnum using the select() call.
+# batchOrder()
+# Takes the (SensorID, SensorRange, X, Y) moves of an UPDATEPOSITIONS. Returns each sensor's last
+# move, keyed in the order the sensors first appear, and the sensors in the order of their last moves.
+#
+def batchOrder(moves):
+    final = {}
+    last = {}
+    for n, move in enumerate(moves):
+        final[move[0]] = move                                       # A later move replaces the earlier one, in the same place
+        last[move[0]] = n
+    return final, sorted(final, key=last.__getitem__)
+
+#
+# handleUpdatePositions()
+# Takes the server and the list of values passed by an UPDATEPOSITIONS [Count] [Moves], and applies
+# every move as one batch: all the sensors are moved first, then each one's edges are found once.
+# The graph ends up just as the moves one at a time would leave it, down to the order of each
+# adjacency. A sensor only keeps the edges from its last move, and its neighbours list it in the
+# order of those last moves, so the edges are found in that order, each sensor leaving out the
+# ones that move after it (which link to it themselves when their turn comes).
+# Replies with REACHABLES: each sensor's neighbours once the whole batch is in.
+#
+def handleUpdatePositions(value_list, server):
+    final = applyMoves(value_list[2])
+    replies = [(sensor_id, reachableOf(sensor_id)) for sensor_id in final]
+    if 'cache' in codecs[server].features:
+        reachable_cached.update(final)
+    sendBytes(server, codecs[server].reachables(replies))
+
+#
+# applyMoves()
+# Takes the (SensorID, SensorRange, X, Y) moves of a batch, and applies them as
+# handleUpdatePositions() describes. Returns the last move of each sensor, keyed in the order
+# the sensors first appear.
+#
+def applyMoves(moves):
+    final, ordered = batchOrder(moves)
+    touched = set(final)
+    for sensor_id, (_, sensor_range, new_x, new_y) in final.items():   # New sensors join in order of their first move
+        if(sensor_id in graph.graph):
+            touched.update(graph.graph[sensor_id])
+            touched.update(graph.reverse.get(sensor_id, ()))
+            graph.clear_edges(sensor_id)
+            graph.removeEdgesId(sensor_id)
+            graph.move_node(sensor_id, new_x, new_y)
+            graph.set_range(sensor_id, sensor_range)
+        else:
+            graph.add_node(sensor_id, new_x, new_y, sensor_range)
+
+    later = set(final)                                              # The sensors whose last move is still to come
+    for sensor_id in ordered:
+        later.discard(sensor_id)
+        start = time.perf_counter()
+        graph.find_edges(sensor_id, graph.type[sensor_id], lambda vertex: vertex not in later)
+        metrics.record('find_edges', time.perf_counter() - start)
+
+    for sensor_id in final:
+        touched.update(graph.graph[sensor_id])
+    route_cache.invalidate(touched)
+    invalidateCaches(final, touched)
+    return final
+
+#
+# reachableOf()
+# Takes a sensor ID, and returns its REACHABLE list as it stands: (id, x, y) of each neighbour.
+#
+def reachableOf(sensor_id):
+    return [(i, graph.positions[i][0], graph.positions[i][1]) for i in graph.graph[sensor_id]]
+
+#
+# holdPosition()
+# With --coalesce, takes an UPDATEPOSITION and the socket it came on, and holds it instead of
+# applying it. Held moves are applied together by applyHeld(): at the end of the readiness pass,
+# or once the first of them has waited --coalesce microseconds, or before anything that must see
+# them (any other command, a line on stdin or a sensor hanging up).
+#
+def holdPosition(value_list, server):
+    global held_due
+    if not held_moves:
+        held_due = time.monotonic() + coalesce_window
+    held_moves.append(tuple(value_list[1:5]))
+    held_replies.append((value_list[1], server))
+    connectSensor(value_list[1], server)                            # Stores the address to send to, as handleCommand() would
+
+#
+# applyHeld()
+# Applies the held UPDATEPOSITIONs as one batch, only the last of each sensor's counting, just as
+# handleUpdatePositions() applies one. Each of them is then answered, in the order they came, with
+# the sensor's REACHABLE as it stands after the whole batch, a socket's answers sent together.
+# Counts the moves left out.
+#
+def applyHeld():
+    global held_moves, held_replies
+    moves, replies = held_moves, held_replies
+    held_moves, held_replies = [], []
+    start = time.perf_counter()
+    final = applyMoves(moves)
+    metrics.record('coalesce', time.perf_counter() - start)
+    metrics.count('positions_held', len(moves))
+    metrics.count('positions_coalesced', len(moves) - len(final))
+    lists = {sensor_id: reachableOf(sensor_id) for sensor_id in final}
+    answers = {}                                                    # Socket: its REACHABLEs, in order
+    for sensor_id, client in replies:
+        if client in codecs:                                        # Sockets that hung up since are owed nothing
+            answers.setdefault(client, []).append(encodeReachable(client, sensor_id, lists[sensor_id]))
+    for client, data in answers.items():
+        sendBytes(client, b''.join(data))
+
+#
+# heldTimeout()
+# Takes the seconds the engine would otherwise wait in select(), and returns them cut down to
+# when the held moves are due, if there are any.
+#
+def heldTimeout(timeout):
+    if not held_moves:
+        return timeout
+    remaining = max(0.0, held_due - time.monotonic())
+    return remaining if timeout is None else min(timeout, remaining)
+
+#
+# invalidateCaches()
+# Takes the sensors that just moved and every node whose edges the moves changed, and pushes an
+# INVALIDATE to each "cache" sensor holding something now out of date: the position of a sensor
+# that moved, from a THERE, or its own REACHABLE list, which it is told about by its own ID. The
+# movers get their new lists in the reply. Each sensor is told once, until it asks again.
+#
+def invalidateCaches(moved, touched):
+    notices = {}                                                    # Socket: the IDs to send it
+    for sensor_id in moved:
+        for client in cache_watchers.pop(sensor_id, ()):
+            watched[client].discard(sensor_id)
+            notices.setdefault(client, []).append(sensor_id)
+    for node in touched:
+        if node in reachable_cached and node not in moved:
+            reachable_cached.discard(node)
+            client = all_connections.get(node)
+            if client is not None:
+                notices.setdefault(client, []).append(node)
+    for client, ids in notices.items():
+        if client in codecs:                                        # Sockets that hung up since are only forgotten here
+            sendBytes(client, codecs[client].invalidate(ids))
+
+#
+# sendReachable()
+# Takes a sensor's socket, its ID and its list of (id, x, y) neighbours, and sends the list.
+# A sensor that agreed to "delta" gets a REACHABLEDELTA with only the entries added (or moved)
+# and removed since the last one it was sent, numbered so it can tell if it missed one. The
+# whole list goes instead when it is the first, or no bigger than the changes.
+#
+def sendReachable(client, sensor_id, reachable_list):
+    sendBytes(client, encodeReachable(client, sensor_id, reachable_list))
+
+#
+# encodeReachable()
+# Returns the bytes sendReachable() sends, for sending along with others.
+#
+def encodeReachable(client, sensor_id, reachable_list):
+    codec = codecs[client]
+    if 'cache' in codec.features:
+        reachable_cached.add(sensor_id)
+    if 'delta' not in codec.features:
+        return codec.reachable(reachable_list)
+    current = {id: (x, y) for id, x, y in reachable_list}
+    last = reachable_sent.get(sensor_id)
+    sequence = 1
+    if last is not None and last[0] is client:
+        sequence = last[1] + 1
+        previous = last[2]
+        added = [(id, x, y) for id, x, y in reachable_list if previous.get(id) != (x, y)]
+        removed = [id for id in previous if id not in current]
+    reachable_sent[sensor_id] = (client, sequence, current)
+    if sequence == 1 or len(added) + len(removed) >= len(current):
+        return codec.reachableDelta(sequence, True, reachable_list, [])
+    return codec.reachableDelta(sequence, False, added, removed)
+
+#
+# handleResync()
+# Takes RESYNC [SensorID] from a sensor that lost track of its deltas, and sends it all of the
+# last list it was sent again, as a full REACHABLEDELTA with the next sequence number.
+#
+def handleResync(sensor_id, client):
+    last = reachable_sent.get(sensor_id)
+    sequence = 1
+    current = {}
+    if last is not None and last[0] is client:
+        sequence = last[1] + 1
+        current = last[2]
+    reachable_sent[sensor_id] = (client, sequence, current)
+    sendBytes(client, codecs[client].reachableDelta(sequence, True, [(id, x, y) for id, (x, y) in current.items()], []))
+
+#
+# handleCommand()
+# Takes the list of strings of one message from a sensor and the socket it came on,
+# and passes it to the matching handler.
+#
+def handleCommand(str_list, i):
+    if held_moves and str_list[0] != 'UPDATEPOSITION':                              # Whatever it is, it comes after the held moves
+        applyHeld()
+    if(str_list[0] == 'HELLO'):
+        handleHello(str_list, i)
+    elif shard_sockets:
+        handleShardCommand(str_list, i)
+    elif(str_list[0] == 'UPDATEPOSITION' and coalesce_window is not None):
+        holdPosition(str_list, i)
+    elif(str_list[0] == 'UPDATEPOSITION'):                                            # Checks if the input is Update Position
+        handleUpdatePosition(str_list, i)
+        connectSensor(str_list[1], i)                                               # Stores the address to send to
+    elif(str_list[0] == 'UPDATEPOSITIONS'):
+        handleUpdatePositions(str_list, i)
+        connectBatch(str_list[2], i)
+    elif(str_list[0] == 'WHERE'):                                                   # Checks if the input is where
+        handleWhere(str_list[1], i)
+    elif(str_list[0] == 'DATAMESSAGE'):
+        handleDataMessage(str_list, i)
+    elif(str_list[0] == 'RESYNC'):
+        handleResync(str_list[1], i)
+
+#
+# connectBatch()
+# Takes the moves of an UPDATEPOSITIONS and the socket they came on, and stores it as the address
+# of every sensor in them. Their REACHABLES carried whole lists, so any delta starts over.
+#
+def connectBatch(moves, i):
+    for move in moves:
+        connectSensor(move[0], i)
+        reachable_sent.pop(move[0], None)
+
+#
+# connectSensor()
+# Takes a sensor ID and the socket it spoke on, and stores the socket as its address. A gateway
+# hosting many sensors is the address of all of them, and the NextID of each DATAMESSAGE sent
+# to it says which of its sensors it is for.
+#
+def connectSensor(sensor_id, i):
+    previous = all_connections.get(sensor_id)
+    if previous is not i:
+        if previous is not None:                                    # The sensor came back on another connection
+            del connection_sensors[previous][sensor_id]
+        all_connections[sensor_id] = i
+        connection_sensors.setdefault(i, {})[sensor_id] = None
+
+#
+# handleHello()
+# Takes a HELLO [Version] [Features...] from a sensor, and answers with the features this
+# server agrees to, plus "framed" if it was started --framed or a text sensor asked for "cache",
+# which the front of a sharded server never agrees to, and "tags" only on a framed or binary connection. The connection speaks the agreed
+# encoding from the next message on; the sensor waits for the answer before sending
+# anything else.
+#
+def handleHello(str_list, i):
+    accepted = [feature for feature in str_list[2:] if feature in FEATURES]
+    if shard_sockets and 'cache' in accepted:                       # The front does not see the moves that would invalidate
+        accepted.remove('cache')
+    if 'framed' not in accepted and ('framed' in options or ('cache' in accepted and 'binary' not in accepted)):
+        accepted.append('framed')                                   # INVALIDATEs are pushed, so must be told apart from replies
+    if 'tags' in accepted and 'framed' not in accepted and 'binary' not in accepted:
+        accepted.remove('tags')                                     # Unframed, only one request is ever out anyway
+    sendBytes(i, hello(accepted))
+    codecs[i] = makeCodec(accepted, 'framed' in options)
+
+#
+# handleClientData()
+# Reads what a sensor sent, and handles every complete message in it, in order, as its
+# codec decodes them. Unframed, the whole read is taken as one message. A read of nothing
+# means the sensor hung up.
+#
+def handleClientData(i):
+    try:
+        data = i.recv(codecs[i].read_size)                                          # Open the data and read it into an array
+    except ConnectionResetError:
+        data = b''
+    if not data:
+        if held_moves:                                                              # Its moves still count, as they would have one at a time
+            applyHeld()
+        closeConnection(i)
+        return
+    metrics.count('bytes_in', len(data))
+    for str_list in codecs[i].feed(data):                                           # Array of inputs, for each message
+        if i.fileno() == -1:                                                        # Disconnected by one of them, see sendBytes()
+            break
+        if str_list:
+            start = time.perf_counter()
+            handleCommand(str_list, i)
+            metrics.record(str_list[0] if str_list[0] in TIMED else 'other', time.perf_counter() - start)
+
+#
+# class ShardLayout
+# Used in sharded mode to split the plane into count vertical stripes of equal width across the
+# x range of the base stations. The outer two stripes run on forever, so every position has
+# exactly one owning shard.
+#
+class ShardLayout(object):
+    def __init__(self, count, low_x, high_x):
+        self.count = count
+        self.low_x = low_x
+        self.width = max(1.0, (high_x - low_x + 1) / count)
+
+    def index(self, x):                                             # Returns the shard owning an x coordinate
+        return min(max(int((x - self.low_x) // self.width), 0), self.count - 1)
+
+    def span(self, x, distance):                                    # Returns the shards whose stripes overlap [x - distance, x + distance]
+        if not distance >= 0:                                       # A negative (or NaN) range reaches nothing past its own stripe
+            return {self.index(x)}
+        if math.isinf(distance):
+            return set(range(self.count))
+        return set(range(self.index(x - distance), self.index(x + distance) + 1))
+
+#
+# startShards()
+# Forks one worker process per shard, each with a socket pair back to the front.
+#
+def startShards():
+    context = multiprocessing.get_context('fork')
+    for index in range(shard_layout.count):
+        front, back = socket.socketpair()
+        worker = context.Process(target=runShard, args=(index, back), daemon=True)
+        worker.start()
+        back.close()
+        front.setblocking(0)
+        shard_sockets[front] = index
+        shard_ends.append(front)
+        shard_readers[front] = PacketReader()
+        shard_outbox.append([])
+
+#
+# sendShard()
+# Takes a shard index and a message tuple, and queues it for that shard's worker.
+#
+def sendShard(index, message):
+    shard_outbox[index].append(packet(pickle.dumps(message, pickle.HIGHEST_PROTOCOL)))
+
+#
+# flushShards()
+# Sends each worker the messages queued for it, all of a pass's in one write rather than a write
+# each. Called before every wait in select(), in the order they were queued.
+#
+def flushShards():
+    for index, packets in enumerate(shard_outbox):
+        if packets:
+            sendBytes(shard_ends[index], b''.join(packets))
+            shard_outbox[index] = []
+
+#
+# runShard()
+# The loop of one shard's worker process. It builds its slice of the graph: the base stations in
+# its stripe, plus copies of the nodes they link to. A sensor is copied into every shard its range
+# reaches, and each shard links it only to the nodes it owns (or, in its owner, to everything), so
+# between them the shards find each edge exactly where it is needed. Then it answers the front:
+# ('move', Request, SensorId, Range, X, Y, Version, Order, Form) -> ('moved', Request, ...) with, by Form
+#     None       [the sensor's edges found here]
+#     'parts'    [the base stations among them], [(insertion number, its REACHABLE entry)] in that order
+#     'text'     None, the whole REACHABLE in the text protocol ('framed' with the newline)
+# ('link', SensorId, Version, [(BaseId, X, Y)])     adds the base stations other shards linked to a sensor owned here
+# ('remove', SensorId)                               drops the copy of a sensor that moved out of reach
+# ('route', Request, DestinationId, (X, Y), Visited) -> ('routed', Request, Status, Visited, StuckWithEdges)
+#
+def runShard(index, connection):
+    global graph
+    for other in shard_ends:                                        # The other workers' sockets belong to the front
+        other.close()
+    graph = makeGraph()
+    owned = lambda node: shard_layout.index(graph.positions[node][0]) == index
+    for BaseId, XPos, YPos, edges in base_stations:
+        if shard_layout.index(directory[BaseId][0]) == index:
+            graph.add_node(BaseId, XPos, YPos, -1)
+            for i in edges:
+                if i not in graph.graph and i in directory:         # A copy of the far end of the link
+                    graph.add_node(i, directory[i][0], directory[i][1], -1)
+                graph.add_edge(BaseId, i)
+    versions = {}
+    orders = {node: entry[3] for node, entry in directory.items()}  # NodeId: its insertion number, as the front numbers them
+    reply_codecs = {'text': TextCodec(False), 'framed': TextCodec(True)}
+    reader = PacketReader()
+    while True:
+        data = connection.recv(1 << 20)
+        if not data:                                                # The front is gone
+            return
+        replies = []
+        for payload in reader.feed(data):
+            message = pickle.loads(payload)
+            if message[0] == 'move':
+                request, sensor_id, sensor_range, x, y, version, order, form = message[1:]
+                versions[sensor_id] = version
+                orders[sensor_id] = order
+                if sensor_id in graph.graph:
+                    graph.clear_edges(sensor_id)
+                    graph.removeEdgesId(sensor_id)
+                    graph.move_node(sensor_id, x, y)
+                    graph.set_range(sensor_id, sensor_range)
+                else:
+                    graph.add_node(sensor_id, x, y, sensor_range)
+                graph.find_edges(sensor_id, sensor_range, None if owned(sensor_id) else owned)
+                neighbours = list(graph.graph[sensor_id])
+                if form is None:
+                    replies.append(('moved', request, neighbours))
+                    continue
+                neighbours.sort(key=orders.__getitem__)
+                entries = [(n, graph.positions[n][0], graph.positions[n][1]) for n in neighbours]
+                if form == 'parts':
+                    replies.append(('moved', request, [n for n in neighbours if graph.type[n] == -1],
+                                    [(orders[n], repr("{} {} {}".format(*entry))) for n, entry in zip(neighbours, entries)]))
+                else:
+                    replies.append(('moved', request, None, reply_codecs[form].reachable(entries)))
+            elif message[0] == 'link':
+                sensor_id, version, links = message[1:]
+                if versions.get(sensor_id) == version and sensor_id in graph.graph:     # Skip it if the sensor has moved again since
+                    for BaseId, x, y in links:
+                        if BaseId not in graph.graph:
+                            graph.add_node(BaseId, x, y, -1)
+                        graph.add_edge(sensor_id, BaseId)
+            elif message[0] == 'remove':
+                if message[1] in graph.graph:
+                    graph.remove_node(message[1])
+                versions.pop(message[1], None)
+            elif message[0] == 'route':
+                request, destinationID, target, visited = message[1:]
+                replies.append(('routed', request) + shardWalk(destinationID, target, visited, owned))
+        if replies:
+            connection.sendall(b''.join(packet(pickle.dumps(reply, pickle.HIGHEST_PROTOCOL)) for reply in replies))
+
+#
+# shardWalk()
+# Carries on a dfs() walk inside a worker, from the last node visited, for as long as the walk
+# stays on nodes this shard owns. Returns the status ('done', 'stuck' or 'handoff' when the next
+# node belongs to another shard), the visited list, and whether a stuck walk ended on a node with edges.
+#
+def shardWalk(destinationID, target, visited, owned):
+    seen = set(visited)
+    node = visited[-1]
+    while node != destinationID:
+        if node not in graph.graph:
+            return ('stuck', visited, False)
+        if not owned(node):
+            return ('handoff', visited, False)
+        nextID = nextHop(destinationID, node, seen, target)
+        if nextID is None:
+            return ('stuck', visited, len(graph.graph[node]) > 0)
+        visited.append(nextID)
+        seen.add(nextID)
+        node = nextID
+    return ('done', visited, False)
+
+#
+# handleShardCommand()
+# handleCommand() for the front of a sharded server. A sensor's commands are run one at a time:
+# while one of its requests is out with the shards, whatever it sends next waits behind it.
+#
+def handleShardCommand(str_list, i):
+    if i in shard_backlog:
+        shard_backlog[i].append(str_list)
+    elif(str_list[0] == 'UPDATEPOSITION'):
+        shard_backlog[i] = collections.deque()
+        startShardWork('move', [str_list[1:5]], shardUpdatePosition, str_list, i)
+        connectSensor(str_list[1], i)                                               # Stores the address to send to
+    elif(str_list[0] == 'UPDATEPOSITIONS'):
+        shard_backlog[i] = collections.deque()
+        startShardWork('move', str_list[2], shardUpdatePositions, str_list, i)
+        connectBatch(str_list[2], i)
+    elif(str_list[0] == 'WHERE'):
+        handleWhere(str_list[1], i)
+    elif(str_list[0] == 'DATAMESSAGE'):
+        shard_backlog[i] = collections.deque()
+        startShardWork('walk', (str_list[1], str_list[3]), shardDataMessage, str_list, i)
+    elif(str_list[0] == 'RESYNC'):
+        handleResync(str_list[1], i)
+
+#
+# startShardWork()
+# Takes 'move' and the (SensorID, SensorRange, X, Y) of the moves, 'walk' and the (OriginID,
+# DestinationID) of a message, or 'step' and the shard a walk goes on to, then the function that
+# sends it out to the shards and its arguments. It is queued in shard_waiting, and goes out as soon
+# as releaseShardWork() finds nothing it has to wait for.
+#
+def startShardWork(kind, value, start, *args):
+    if not shard_waiting and not shard_releasing:                   # Nothing queued ahead of it, so only the work out counts
+        shards = workShards(kind, value)
+        if not shardWorkHeld(kind, value, shards, (), ()):
+            start(*args, shards)
+            return
+    entry = (kind, value, start, args)
+    shard_waiting.append(entry)
+    releaseShardWork()
+    if any(waiting is entry for waiting in shard_waiting):
+        metrics.count('shard_waits')
+
+#
+# workShards()
+# Returns the set of shards a queued piece of work needs: every shard a move reaches or takes a
+# copy of the sensor out of, the shard owning a message's origin, or the shard a walk goes on to.
+#
+def workShards(kind, value):
+    if kind == 'step':
+        return {value}
+    if kind == 'walk':
+        origin = directory.get(value[0])
+        return {shard_layout.index(origin[0])} if origin is not None and value[1] in directory else set()
+    shards = set()
+    for sensor_id, sensor_range, new_x, new_y in value:
+        shards |= shard_layout.span(int(new_x), float(sensor_range))
+        shards |= sensor_shards.get(sensor_id, set())
+    return shards
+
+#
+# shardWorkHeld()
+# Takes a piece of work, the shards it needs, and the shards of the moves and of the walks queued
+# ahead of it and still held. Returns whether it must wait. Moves run alongside moves, but walks
+# and moves are ordered shard by shard, so that every walk sees each move whole or not at all, as
+# it would in one process, where a walk runs between two moves:
+# A move waits while a walk out has been through any of its shards, or is headed for a sensor it
+# moves (whose position the walk steers by).
+# A walk, at its start and at each shard it goes on to, waits while a move is out in that shard.
+# So a walk only ever sees the moves made before it got to a shard, and none that changed a shard
+# it had already been through. Work also waits behind any work queued ahead of it that it would
+# otherwise overtake in the same shards, except a walk already out, which only waits for moves
+# already out, as they never wait themselves.
+#
+def shardWorkHeld(kind, value, shards, moves_held, walks_held):
+    if kind == 'move':
+        return (any(shard_walking[index] for index in shards) or any(walk_targets[move[0]] for move in value)
+                or not shards.isdisjoint(moves_held) or not shards.isdisjoint(walks_held))
+    return any(shard_moving[index] for index in shards) or (kind == 'walk' and not shards.isdisjoint(moves_held))
+
+#
+# releaseShardWork()
+# Sends out, in order, the work in shard_waiting that shardWorkHeld() no longer holds back.
+#
+def releaseShardWork():
+    global shard_releasing, shard_recheck
+    if shard_releasing:                                             # Work that ended while sending out the last of it
+        shard_recheck = True
+        return
+    shard_releasing = True
+    try:
+        shard_recheck = True
+        while shard_recheck:
+            shard_recheck = False
+            moves_held = set()                                      # The shards of the moves held back so far
+            walks_held = set()                                      # The shards walks are held back from so far
+            n = 0
+            while n < len(shard_waiting):
+                kind, value, start, args = shard_waiting[n]
+                shards = workShards(kind, value)
+                if shardWorkHeld(kind, value, shards, moves_held, walks_held):
+                    (moves_held if kind == 'move' else walks_held).update(shards)
+                    n += 1
+                    continue
+                del shard_waiting[n]
+                start(*args, shards)
+    finally:
+        shard_releasing = False
+
+#
+# endShardMove()
+# Called once a move (or a whole UPDATEPOSITIONS) is done with the shards, with the shards it had.
+#
+def endShardMove(shards):
+    for index in shards:
+        shard_moving[index] -= 1
+    if shard_waiting:
+        releaseShardWork()
+
+#
+# endShardWalk()
+# Called once a walk is over, with its state, to let go of the shards it went through.
+#
+def endShardWalk(state):
+    for index in state['shards']:
+        shard_walking[index] -= 1
+    walk_targets[state['destination']] -= 1
+    if not walk_targets[state['destination']]:
+        del walk_targets[state['destination']]
+    if shard_waiting:
+        releaseShardWork()
+
+#
+# finishShardRequest()
+# Called once a sensor's request is done, to run the commands it sent in the meantime.
+#
+def finishShardRequest(i):
+    backlog = shard_backlog.pop(i, None)
+    while backlog:
+        handleShardCommand(backlog.popleft(), i)
+        if i in shard_backlog:                                                      # That one went out to the shards as well
+            shard_backlog[i].extend(backlog)
+            return
+
+#
+# shardUpdatePosition()
+# handleUpdatePosition() for the front of a sharded server. Sends the move to every shard in the
+# sensor's range, and tells the shards that held a copy of it but are now out of range to drop it.
+# work is the set of shards it holds (None for one move of an UPDATEPOSITIONS, which holds them all).
+# A text connection's REACHABLE is put together by the shards: whole by the one shard the move
+# reaches, or else as the entries each shard found, which the front only has to merge. Otherwise
+# the shards send the IDs back, see shardMoved().
+#
+def shardUpdatePosition(value_list, i, work=None):
+    sensor_id = value_list[1]
+    sensor_range = float(value_list[2])
+    new_x = int(value_list[3])
+    new_y = int(value_list[4])
+    for index in work or ():
+        shard_moving[index] += 1
+    order = directory[sensor_id][3] if sensor_id in directory else len(directory)
+    directory[sensor_id] = (new_x, new_y, sensor_range, order)
+    version = sensor_versions.get(sensor_id, 0) + 1
+    sensor_versions[sensor_id] = version
+    shards = shard_layout.span(new_x, sensor_range)
+    for index in sensor_shards.get(sensor_id, set()) - shards:
+        sendShard(index, ('remove', sensor_id))
+    sensor_shards[sensor_id] = shards
+    codec = codecs.get(i)
+    form = None                                                                     # IDs, for an UPDATEPOSITIONS, binary or "delta"
+    if i not in shard_batches and codec is not None and not codec.binary and 'delta' not in codec.features:
+        form = 'parts' if len(shards) > 1 else 'framed' if codec.framed else 'text'
+    request = next(shard_request_ids)
+    shard_requests[request] = {'client': i, 'sensor': sensor_id, 'version': version, 'owner': shard_layout.index(new_x),
+                               'waiting': len(shards), 'form': form, 'found': set(), 'parts': [], 'reply': None,
+                               'links': set(), 'work': work}
+    for index in shards:
+        sendShard(index, ('move', request, sensor_id, sensor_range, new_x, new_y, version, order, form))
+
+#
+# shardDataMessage()
+# handleDataMessage() for the front of a sharded server. Starts the walk in the shard owning the
+# origin; shardRouted() passes it on from shard to shard until it ends.
+#
+def shardDataMessage(str_list, i, shards):
+    originID = str_list[1]
+    destinationID = str_list[3]
+    if originID not in directory or destinationID not in directory:
+        finishShardRequest(i)
+        return
+    request = next(shard_request_ids)
+    target = directory[destinationID][:2]
+    shard_requests[request] = {'client': i, 'origin': originID, 'destination': destinationID, 'target': target,
+                               'hops': 1, 'shards': set()}
+    walk_targets[destinationID] += 1
+    shardStep(request, [originID], shards)
+
+#
+# shardStep()
+# Sends a walk on to the one shard in shards, which it now holds until it ends.
+#
+def shardStep(request, visited, shards):
+    state = shard_requests[request]
+    for index in shards - state['shards']:
+        shard_walking[index] += 1
+    state['shards'] |= shards
+    for index in shards:
+        sendShard(index, ('route', request, state['destination'], state['target'], visited))
+
+#
+# handleShardReply()
+# Reads the replies a shard's worker sent back, and passes each to shardMoved() or shardRouted().
+#
+def handleShardReply(connection):
+    data = connection.recv(1 << 20)
+    if not data:
+        events.output("Shard {} exited".format(shard_sockets[connection]))
+        exit(1)
+    for payload in shard_readers[connection].feed(data):
+        reply = pickle.loads(payload)
+        if reply[0] == 'moved':
+            shardMoved(reply[1], shard_sockets[connection], *reply[2:])
+        else:
+            shardRouted(*reply[1:])
+
+#
+# shardMoved()
+# Collects one shard's share of a moved sensor's edges: the IDs, the entries of its REACHABLE (and
+# the base stations among them), or the whole REACHABLE. Once every shard has answered, the base
+# stations found by the other shards are linked to it in its owning shard, and the sensor gets
+# its REACHABLE in the same order the single process would list it (the order nodes were added).
+#
+def shardMoved(request, index, neighbours, reachable=None):
+    state = shard_requests[request]
+    if index != state['owner']:
+        state['links'].update(n for n in neighbours if directory[n][2] == -1)
+    if state['form'] is None:
+        state['found'].update(neighbours)
+    elif state['form'] == 'parts':
+        state['parts'].append(reachable)
+    else:
+        state['reply'] = reachable
+    state['waiting'] -= 1
+    if state['waiting'] > 0:
+        return
+    del shard_requests[request]
+    client = state['client']
+    if state['links']:
+        links = [(n, directory[n][0], directory[n][1]) for n in state['links']]
+        sendShard(state['owner'], ('link', state['sensor'], state['version'], links))
+    if state['form'] is not None:                                                   # Text, already encoded by the shards
+        if client in codecs:
+            codec = codecs[client]
+            if state['form'] == 'parts':
+                sendBytes(client, codec.reachableEntries(mergeEntries(state['parts'])))
+            else:
+                sendBytes(client, codec.reply(state['reply']))
+        work = state['work']
+    else:
+        reachable = sorted(state['found'], key=lambda n: directory[n][3])
+        batch = shard_batches.get(client)
+        if batch is not None:                                                       # One of the moves of an UPDATEPOSITIONS
+            batch['found'][state['sensor']] = reachable
+            if batch['left']:
+                shardNextMove(client)
+                return
+            del shard_batches[client]
+            if client in codecs:
+                sendBytes(client, codecs[client].reachables(batchReachables(batch)))
+            work = batch['work']
+        else:
+            if client in codecs:                                                    # Unless the sensor hung up meanwhile
+                reachable_list = [(n, directory[n][0], directory[n][1]) for n in reachable]
+                sendReachable(client, state['sensor'], reachable_list)
+            work = state['work']
+    endShardMove(work)                                                              # Its links are on their way to the owner first
+    finishShardRequest(client)
+
+#
+# mergeEntries()
+# Takes each shard's (insertion number, entry) list, each in order, and returns the entries of
+# them all in order, once each, for reachableEntries().
+#
+def mergeEntries(parts):
+    entries = []
+    last = None
+    for order, entry in heapq.merge(*parts):
+        if order != last:                                                           # A node two shards both hold
+            entries.append(entry)
+            last = order
+    return entries
+
+#
+# shardUpdatePositions()
+# handleUpdatePositions() for the front of a sharded server. Each sensor's last move goes out to
+# the shards in turn, in the order of the last moves, and the REACHABLES goes back once the
+# shards have answered them all. New sensors are put in the directory first, so they are
+# numbered in the order they first appear, as in one process.
+#
+def shardUpdatePositions(value_list, i, work):
+    for index in work:
+        shard_moving[index] += 1
+    final, ordered = batchOrder(value_list[2])
+    for sensor_id, (_, sensor_range, new_x, new_y) in final.items():
+        if sensor_id not in directory:
+            directory[sensor_id] = (int(new_x), int(new_y), float(sensor_range), len(directory))
+    shard_batches[i] = {'final': final, 'ordered': ordered, 'left': collections.deque(ordered), 'found': {}, 'work': work}
+    shardNextMove(i)
+
+#
+# shardNextMove()
+# Sends the next move of a sensor's UPDATEPOSITIONS out to the shards.
+#
+def shardNextMove(i):
+    batch = shard_batches[i]
+    sensor_id = batch['left'].popleft()
+    shardUpdatePosition(['UPDATEPOSITION'] + list(batch['final'][sensor_id]), i)
+
+#
+# batchReachables()
+# Takes a finished batch, and returns each sensor's neighbours as one process would list them:
+# the ones its own move found, less the sensors that moved after it, and then those sensors
+# that found it, in the order they moved.
+#
+def batchReachables(batch):
+    replies = []
+    ordered = batch['ordered']
+    for position, sensor_id in enumerate(ordered):
+        later = ordered[position + 1:]
+        skip = set(later)
+        reachable = [n for n in batch['found'][sensor_id] if n not in skip]
+        reachable += [n for n in later if sensor_id in batch['found'][n]]
+        replies.append((sensor_id, [(n, directory[n][0], directory[n][1]) for n in reachable]))
+    first = {sensor_id: n for n, sensor_id in enumerate(batch['final'])}
+    replies.sort(key=lambda reply: first[reply[0]])                 # Back in the order they came in
+    return replies
+
+#
+# shardRouted()
+# Takes a walk back from a shard. A handoff goes on to the shard owning the next node, once it
+# may go there; otherwise the walk is over and is played out just as handleDataMessage() would.
+#
+def shardRouted(request, status, visited, stuck_with_edges):
+    state = shard_requests[request]
+    if status == 'handoff' and len(visited) > state['hops']:
+        state['hops'] = len(visited)
+        startShardWork('step', shard_layout.index(directory[visited[-1]][0]), shardStep, request, visited)
+        return
+    del shard_requests[request]
+    if status == 'done':
+        reportPath(state['origin'], state['destination'], visited)
+    else:                                                                           # A handoff that got nowhere is stuck too
+        reportWalk(state['origin'], state['destination'], visited, stuck_with_edges)
+    endShardWalk(state)
+    finishShardRequest(state['client'])
+
+#
+# acceptConnections()
+# Takes the (non-blocking) listening socket, and accepts every sensor waiting on it, so a
+# burst of connects does not have to wait for one loop pass each.
+# Returns the list of new, non-blocking, connections.
+#
+def acceptConnections(server):
+    connections = []
+    while True:
+        try:
+            connection, client_address = server.accept()
+        except BlockingIOError:                                                     # No more waiting
+            return connections
+        connection.setblocking(0)
+        codecs[connection] = makeCodec((), 'framed' in options)                     # Text until it says HELLO
+        metrics.count('connections_accepted')
+        connections.append(connection)
+
+#
+# handleStdin()
+# Reads one command from the terminal and runs it. Returns False once the server should stop.
 # STD input options
 # SENDDATA [OriginID] [destinationID]
+# STATS
 # QUIT
-# Sensor input options
 #
-def runServer():
-    global all_connections                                              # A global dictionary with the client_name, and the socket as value
-    global graph
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)          # Create a TCP socket
-
-    server.bind(('', int(control_port)))                                # Set the socket to listen on any address, on the specified port
-    server.listen(5)                                                    # bind takes a 2-tuple, not 2 arguments
-    #server.setblocking(0)
-    cond = True                                                         # A condition to loop on, until the input from the terminal is QUIT
-    inputs = [server, sys.stdin]                                        # Setting up the inputs for the select() call
-    outputs = []
-    cond = True
+def handleStdin(server):
+    global stdin_polled
+    input_message = sys.stdin.readline()
+    if not input_message:                                                           # The end of stdin, so stop listening to it
+        if sys.stdin in inputs:
+            inputs.remove(sys.stdin)
+        if stdin_polled:
+            stdin_polled = False
+        elif selector is not None:
+            selector.unregister(sys.stdin)
+        return True
+    if held_moves:                                                                  # SENDDATA and STATS see the moves that came before them
+        applyHeld()
+    input_message = input_message.strip()                                           # Strip the ending of new line character
+    input_array = input_message.split()                                             # Prepping for a send_data call
+    if(input_message == 'QUIT'):                                                    # If the input is quit, we exit the loop
+        server.close()
+        return False
+    elif(len(input_array) == 3 and input_array[0] == 'SENDDATA'):                   # If we received a send sata call... we have to
+        originID = input_array[1]
+        destinationID = input_array[2]
+        positions = directory if shard_sockets else graph.positions
+        if originID not in positions or destinationID not in positions:
+            events.output('invalid command entered')
+            return True
+        str_list = ['DATAMESSAGE', originID, '-1', destinationID, 1, [originID]]      # Routed just as if the origin had sent it
+        start = time.perf_counter()
+        if shard_sockets:                                                           # Waits its turn like a sensor's, stdin standing in for the socket
+            handleShardCommand(str_list, sys.stdin)
+        else:
+            handleDataMessage(str_list, None)
+        metrics.record('SENDDATA', time.perf_counter() - start)
+    elif(input_message == 'STATS'):                                                 # Print the metrics, see hw4_metrics.py
+        for line in metrics.lines():
+            events.output(line)
+    else:
+        events.output('invalid command entered')                                            # If the input is incorrect ...
+    return True
 
+#
+# runSelect()
+# See https://pymotw.com/2/select/#module-select
+# The default engine. Reads-in the commands from stdin whilst listening on the server socket
+# using the select() call.
+#
+def runSelect(server):
+    inputs.extend([server, sys.stdin] + shard_ends)                                 # Setting up the inputs for the select() call
+    cond = True                                                                     # A condition to loop on, until the input from the terminal is QUIT
     while cond:
-        readable, writable, exceptional = select.select(inputs, outputs, inputs)    # Call to select, selects a queue of input possibilities
+        if held_moves and time.monotonic() >= held_due:                             # With --coalesce, the moves held long enough
+            applyHeld()
+        flushShards()                                                               # What the last pass queued for the workers
+        events.flush()                                                              # What the last pass printed, to the writer thread
+        readable, writable, exceptional = select.select(inputs, outputs, inputs, heldTimeout(dumpStats()))   # Call to select, selects a queue of input possibilities
         for i in readable:
+            if i.fileno() == -1:                                                    # Closed earlier in this pass
+                continue
             if i is server:                                                         # We now loop over possible read-in sets
-                connection, client_address = i.accept()                             # If it is a new connection on listen(), we add it to inputs
-                connection.setblocking(0)
-                inputs.append(connection)
+                inputs.extend(acceptConnections(i))                                 # If it is a new connection on listen(), we add it to inputs
             elif i is sys.stdin:                                                    # Otherwise, it is a message from the terminal
-                input_message = sys.stdin.readline().strip()                        # Strip the ending of new line character
-                input_array = input_message.split()                                 # Prepping for a send_data call
-                if(input_message == 'QUIT'):                                        # If the input is quit, we exit the loop
-                    cond = False
-                    server.close()
-                elif(input_array[0] == 'SENDDATA'):                                 # If we received a send sata call... we have to
-                    originID = input_array[1]
-                    destinationID = input_array[2]
-                    handleSendData(originID, destinationID)                         # Handle the send data accordingly in a call
-                else:
-                    print('invalid command entered')                                # If the input is incorrect ...
+                cond = handleStdin(server)
+                if not cond:
+                    break
+            elif i in shard_sockets:                                                # Or replies from a shard's worker
+                handleShardReply(i)
             else:                                                                   # Otherwise, data was sent from existing client
-                data = i.recv(1024)                                                 # Open the data and read it into an array
-                if data:
-                    str = data.decode().strip()
-                    str_list = str.split()                                          # Array of string inputs
-                    if(str_list[0] == 'UPDATEPOSITION'):                            # Checks if the input is Update Position
-                        handleUpdatePosition(str_list, i)
-                        all_connections[str_list[1]] = i                            # Stores the address to send to
-                    elif(str_list[0] == 'WHERE'):                                   # Checks if the input is where
-                        handleWhere(str_list[1], i)
-                    elif(str_list[0] == 'DATAMESSAGE'):
-                        handleDataMessage(str_list, i)
-                    if i not in outputs:                                            # We add the readable to outputs if necessary
-                        outputs.append(i)
+                handleClientData(i)
+        for i in writable:                                                          # Flush the queued output of the writable sockets
+            if i in message_queues and i.fileno() != -1:
+                flushOutput(i)
+
+#
+# runSelectors()
+# The --engine=selectors engine. The same loop as runSelect(), but on selectors.DefaultSelector
+# (epoll on Linux): the registrations persist between calls instead of being passed in again
+# every time, and there is no FD_SETSIZE cap on the number of sensors. A regular file on stdin,
+# which epoll can not watch, is always ready to read, as select() would find it, so a line of
+# it is read every pass instead, without waiting in select().
+#
+def runSelectors(server):
+    global selector, stdin_polled
+    selector = selectors.DefaultSelector()
+    selector.register(server, selectors.EVENT_READ)
+    try:
+        selector.register(sys.stdin, selectors.EVENT_READ)
+    except PermissionError:                                                         # epoll can not watch a regular file on stdin
+        stdin_polled = True
+    for shard in shard_ends:
+        selector.register(shard, selectors.EVENT_READ)
+    cond = True
+    while cond:
+        if stdin_polled:
+            cond = handleStdin(server)
+            if not cond:
+                break
+        if held_moves and time.monotonic() >= held_due:
+            applyHeld()
+        flushShards()
+        for client in outputs:                                                      # Sockets that queued output since the last pass
+            if client not in writing:
+                selector.modify(client, selectors.EVENT_READ | selectors.EVENT_WRITE)
+                writing.add(client)
+        events.flush()
+        for key, mask in selector.select(0 if stdin_polled else heldTimeout(dumpStats())):
+            i = key.fileobj
+            if i.fileno() == -1:                                                    # Closed earlier in this pass
+                continue
+            if i is server:
+                for connection in acceptConnections(i):
+                    selector.register(connection, selectors.EVENT_READ)
+            elif i is sys.stdin:
+                cond = handleStdin(server)
+                if not cond:
+                    break
+            else:
+                if mask & selectors.EVENT_READ and i in shard_sockets:
+                    handleShardReply(i)
+                elif mask & selectors.EVENT_READ:
+                    handleClientData(i)
+                if mask & selectors.EVENT_WRITE and i in message_queues and i.fileno() != -1:
+                    flushOutput(i)
+                if i in writing and i not in outputs:                               # Drained (or closed), back to reading only
+                    writing.discard(i)
+                    if i in message_queues:
+                        selector.modify(i, selectors.EVENT_READ)
+
+#
+# serverGauges()
+# Returns the current size of things, for the metrics: the graph, the connections, the output
+# still queued and the route cache.
+#
+def serverGauges():
+    gauges = {'connections': len(codecs), 'sensors': len(all_connections),
+              'queued_bytes': sum(queue.size for queue in message_queues.values()),
+              'congested': sum(queue.congested for queue in message_queues.values()),
+              'cache_watches': sum(len(ids) for ids in watched.values())}
+    if graph is not None:
+        gauges['vertices'] = len(graph.graph)
+        gauges['edges'] = sum(len(edges) for edges in graph.graph.values())
+        gauges['cell_size'] = graph.cell_size
+        for key, value in route_cache.stats().items():
+            gauges['route_cache_' + key] = value
+    else:                                                               # The front of a sharded server only has its directory
+        gauges['vertices'] = len(directory)
+        gauges['shard_requests'] = len(shard_requests)
+        gauges['shard_waiting'] = len(shard_waiting)
+    return gauges
+
+#
+# dumpStats()
+# With --stats, writes the metrics to its file once they are due. Returns the seconds until the
+# next dump, for the engine to wait at most that long, or None to wait as long as it takes.
+#
+def dumpStats():
+    global next_dump
+    if stats_path is None:
+        return None
+    now = time.monotonic()
+    if now >= next_dump:
+        metrics.dump(stats_path)
+        next_dump = now + stats_every
+    return next_dump - now
+
+#
+# runServer()
+# Listens on the control port, and hands the socket to the engine picked with --engine
+# (select by default, or selectors).
+# Sensor input options
+# UPDATEPOSITION, WHERE and DATAMESSAGE, see handleCommand()
+#
+def runServer():
+    global stats_path, stats_every, high_water, low_water, overflow, events, coalesce_window
+    metrics.gauges = serverGauges
+    high_water = int(options.get('high-water', high_water))
+    low_water = min(int(options.get('low-water', high_water // 4)), high_water)
+    overflow = options.get('overflow', overflow)
+    if overflow not in OVERFLOW_POLICIES:
+        print("Error, --overflow must be one of {}".format(', '.join(OVERFLOW_POLICIES)))
+        exit(1)
+    if 'coalesce' in options:                                           # Hold UPDATEPOSITIONs for the readiness pass, or --coalesce=[microseconds]
+        coalesce_window = 0.0 if options['coalesce'] is True else float(options['coalesce']) / 1e6
+    if 'stats' in options:                                              # Dump the metrics as JSON every --stats-every seconds
+        stats_path = options['stats'] if options['stats'] is not True else 'hw4_stats.json'
+        stats_every = float(options.get('stats-every', stats_every))
+    if shard_layout is not None:                                        # Fork the workers before there is anything for them to inherit
+        startShards()
+    events = openEventLog(options)                                      # After the fork, as a worker would not get the writer thread
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)          # Create a TCP socket
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)        # So a restart does not wait out TIME_WAIT
+    server.bind(('', int(control_port)))                                # Set the socket to listen on any address, on the specified port
+    server.listen(socket.SOMAXCONN)                                     # bind takes a 2-tuple, not 2 arguments; a deep backlog for bursts of sensors
+    server.setblocking(0)
+    if options.get('engine') == 'selectors':
+        runSelectors(server)
+    else:
+        runSelect(server)
+    if stats_path is not None:                                          # And once more on the way out
+        metrics.dump(stats_path)
+    events.close()
 
 #
 # main()
@@ -331,4 +1928,9 @@ def runServer():
 #
 if __name__ == '__main__':
     readFromCommand()
-    runServer()
+    if 'profile' in options:                                            # Run the whole server under cProfile, written out on QUIT
+        profiler = cProfile.Profile()
+        profiler.runcall(runServer)
+        profiler.dump_stats(options['profile'] if options['profile'] is not True else 'hw4_control.prof')
+    else:
+        runServer()
@@ -0,0 +1,152 @@
+#
+# hw4_events.py
+# Written by: Daniel Dukeshire, Thomas Durkin, Chris Pence, Chris Allen
+# Date: 11.30.2020
+# The event log of the control server (hw4_control.py) and the sensors (hw4_client.py,
+# hw4_gateway.py): the lines they print about a message on its way (sent, forwarded through a
+# node, received, or stuck), and every other line they print, kept in the order they happened.
+#
+# Each line is kept as a record, and the records are handed to a background thread in batches,
+# by flush() once per pass of the program's select loop (or every BATCH_SIZE records), and the
+# thread writes each batch with one write. So printing a hop is an append to a list, not a
+# blocking write on the routing path. The queue is bounded: if the writer falls QUEUE_SIZE
+# batches behind, the next flush() waits for it.
+# Where the lines go and what they look like is up to the sink:
+# TextSink: the lines as they were always printed, the default
+# JsonSink: one JSON object per line, with the time, the event, the node, origin, destination
+# and, where it is known, the hop's index along the message's route
+# Any object with a write(records) method will do.
+#
+# Flags, on all three programs: --log-format=text|json, --log-file=[file] (stdout by default),
+# and --log-sync to write every line as it happens, on the calling thread.
+#
+
+import sys
+import json
+import time
+import queue
+import atexit
+import threading
+
+QUEUE_SIZE = 100                                                    # Batches waiting for the writer before flush() waits in turn
+BATCH_SIZE = 1000                                                   # Records kept before they are flushed anyway
+
+TEMPLATES = {                                                       # The text line of each event, as printed before the log
+    'forwarded': '{node}: Message from {origin} to {destination} being forwarded through {node}',
+    'received': '{node}: Message from {origin} to {destination} successfully received.',
+    'undeliverable': '{node}: Message from {origin} to {destination} could not be delivered.',
+    'sent': '{node}: Sent a new message bound for {destination}.',
+    'sent_direct': '{node}: Sent a new message directly to {destination}.',
+}
+
+#
+# class TextSink
+# Writes records to a stream as the text lines of TEMPLATES, and other output as it is.
+#
+class TextSink(object):
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, records):
+        lines = []
+        for record in records:
+            if record['event'] == 'output':
+                lines.append(record['text'] + '\n')
+            else:
+                lines.append(TEMPLATES[record['event']].format(**record) + '\n')
+        self.stream.write(''.join(lines))
+        self.stream.flush()
+
+#
+# class JsonSink
+# Writes records to a stream as JSON lines. Other output comes as {"event": "output", "text": ...},
+# so the stream stays JSON throughout.
+#
+class JsonSink(object):
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, records):
+        self.stream.write(''.join(json.dumps(record, separators=(',', ':')) + '\n' for record in records))
+        self.stream.flush()
+
+#
+# class EventLog
+# Takes records from the program, in order, and has its sink write them: from a background
+# thread in batches, or straight away when threaded is False. close() writes out what is left,
+# and is also run at exit.
+#
+class EventLog(object):
+    def __init__(self, sink, threaded=True, size=QUEUE_SIZE):
+        self.sink = sink
+        self.batch = []                                             # Records not yet handed to the writer
+        self.queue = None
+        self.thread = None
+        if threaded:
+            self.queue = queue.Queue(size)
+            self.thread = threading.Thread(target=self.run, name='event-log', daemon=True)
+            self.thread.start()
+            atexit.register(self.close)
+
+    def emit(self, event, node, origin, destination, hop=None):     # A message's event at a node, see TEMPLATES
+        record = {'time': time.time(), 'event': event, 'node': node, 'origin': origin, 'destination': destination}
+        if hop is not None:
+            record['hop'] = hop
+        self.put(record)
+
+    def output(self, text):                                         # Any other line, kept in order with the events
+        self.put({'time': time.time(), 'event': 'output', 'text': text})
+
+    def put(self, record):
+        if self.queue is None:
+            self.write([record])
+            return
+        self.batch.append(record)
+        if len(self.batch) >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):                                                # Hands the records kept so far to the writer
+        if self.batch and self.queue is not None:
+            self.queue.put(self.batch)                              # Only waits if the writer is QUEUE_SIZE batches behind
+            self.batch = []
+
+    def write(self, records):
+        try:
+            self.sink.write(records)
+        except (OSError, ValueError):                               # The reader went away, as a print would have found out
+            pass
+
+    def run(self):                                                  # The writer thread: every batch waiting, in one write
+        while True:
+            batches = [self.queue.get()]
+            while True:
+                try:
+                    batches.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            closing = batches[-1] is None                           # close() puts None last
+            if closing:
+                batches.pop()
+            if batches:
+                self.write([record for batch in batches for record in batch])
+            if closing:
+                return
+
+    def close(self):                                                # Writes out whatever is waiting, and stops the writer
+        if self.thread is not None:
+            self.flush()
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+            self.queue = None
+
+#
+# openEventLog()
+# Takes the --flags of a program, and returns the EventLog they ask for.
+#
+def openEventLog(options):
+    stream = sys.stdout
+    if options.get('log-file', True) is not True:
+        stream = open(options['log-file'], 'a')
+    sink = JsonSink(stream) if options.get('log-format') == 'json' else TextSink(stream)
+    return EventLog(sink, threaded='log-sync' not in options)
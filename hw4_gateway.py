@@ -0,0 +1,289 @@
+#
+# hw4_gateway.py
+# Written by: Daniel Dukeshire, Thomas Durkin, Chris Pence, Chris Allen
+# Date: 11.30.2020
+# A gateway: one process and one connection to the control server (hw4_control.py) hosting many
+# sensors, instead of a hw4_client.py process and socket for each. The server stores the
+# gateway's socket as the address of every sensor it hosts, and each DATAMESSAGE it sends names
+# (as its NextID) the sensor it is for.
+#
+# Usage: python3 -u hw4_gateway.py [control address] [control port] [SensorFile] [--binary] [--log-*]
+# Each line of the sensor file is [SensorID] [SensorRange] [InitialXPosition] [InitialYPosition].
+# The sensors join with one UPDATEPOSITIONS. Then each line of stdin is a sensor's command,
+# [SensorID] MOVE [X] [Y], [SensorID] SENDDATA [DestinationID] or [SensorID] WHERE [NodeID],
+# and prints what hw4_client.py would; QUIT (or the end of stdin) ends them all.
+#
+# The connection is always framed (or binary), since the replies to many sensors share it.
+# Requests are pipelined as in hw4_client.py: the server answers them in order, so each reply
+# belongs to the oldest one pending, and only a MOVE behind a SENDDATA of the same sensor waits.
+#
+
+import sys
+import socket
+import select
+import collections
+from hw4_protocol import RequestQueue, splitOptions, makeCodec, askHello, readLines
+from hw4_events import openEventLog
+
+control_address = None      # The address to connect to
+control_port = None         # The port to connect to
+sensor_file = None          # The file of the sensors to host
+options = {}                # The optional --flags from the command line, e.g. --binary
+codec = None                # The TextCodec or BinaryCodec spoken with the server
+sensors = {}                # SensorId: its VirtualSensor, in the order of the file
+requests = None             # The RequestQueue of what was sent to the server: what waits on a reply, and what waits to go out
+stdin_buffer = bytearray()  # The start of a line of stdin whose end has not been read yet
+quitting = False            # QUIT was read, and waits for the last replies
+running = True              # Until QUIT
+events = None               # The EventLog every line of output goes through, see hw4_events.py
+
+#
+# class VirtualSensor
+# One sensor hosted by the gateway: what hw4_client.py keeps in its globals.
+# Reachable: the nodes in range as of its last REACHABLE, {ID: (x, y)}
+# Sending: its SENDDATAs waiting on their REACHABLE before their DATAMESSAGE can go out
+# Held: its commands from stdin that wait for those, in order
+#
+class VirtualSensor(object):
+    def __init__(self, id, range, x, y):
+        self.id = id
+        self.range = range
+        self.x = x
+        self.y = y
+        self.reachable = {}
+        self.sending = 0
+        self.held = collections.deque()
+
+#
+# readSensors()
+# Takes the path of a sensor file, and returns its VirtualSensors by ID, in order.
+#
+def readSensors(path):
+    hosted = {}
+    with open(path) as fp:
+        for line in fp:
+            fields = line.split()
+            if fields:
+                hosted[fields[0]] = VirtualSensor(fields[0], fields[1], fields[2], fields[3])
+    return hosted
+
+#
+# handleReply()
+# Takes a message that answers a request, and hands it to the oldest pending request.
+#
+def handleReply(message):
+    if not requests.answer(message):
+        events.output("gateway: Unexpected {} from the server".format(message[0]))
+
+#
+# joinSensors()
+# Places every hosted sensor with one UPDATEPOSITIONS, and fills in their reachable dicts from
+# the REACHABLES.
+#
+def joinSensors(client):
+    moves = [(sensor.id, sensor.range, sensor.x, sensor.y) for sensor in sensors.values()]
+    requests.send(codec.updatePositions(moves), ('REACHABLES',), joined)
+
+def joined(message):
+    for id, entries in message[2]:
+        sensors[id].reachable = {name: (x, y) for name, x, y in entries}
+
+#
+# sendUpdatePosition()
+# Takes the socket and a sensor, and sends its UPDATEPOSITION. Once the REACHABLE is in, the
+# sensor's reachable dict is replaced and passed to then, if given.
+#
+def sendUpdatePosition(client, sensor, then=None):
+    requests.send(codec.updatePosition(sensor.id, sensor.range, sensor.x, sensor.y),
+                  ('REACHABLE',), lambda message: interpretPositionString(message, sensor, then))
+
+def interpretPositionString(msg, sensor, then):
+    sensor.reachable = {name: (xpos, ypos) for name, xpos, ypos in msg[2]}
+    if then is not None:
+        then(sensor.reachable)
+
+#
+# handleSendData()
+# Handles a SENDDATA: updates the sensor's position, and once its reachable dict is back,
+# sendData() sends the message.
+#
+def handleSendData(sensor, destinationID, client):
+    sensor.sending += 1
+    sendUpdatePosition(client, sensor, lambda reachable: sendData(sensor, destinationID, reachable, client))
+
+#
+# sendData()
+# Sends a data message for the sensor, as hw4_client.py does, then lets its held commands go.
+# DATAMESSAGE [OriginID] [NextID] [DestinationID] [HopListLength] [HopList]
+#
+def sendData(sensor, destinationID, reachable, client):
+    sensor.sending -= 1
+    if(len(reachable) == 0):
+        events.emit('undeliverable', sensor.id, sensor.id, destinationID, 0)
+    else:
+        nextID = destinationID if destinationID in reachable else "-1"
+        if nextID == "-1":
+            events.emit('sent', sensor.id, sensor.id, destinationID, 0)
+        else:
+            events.emit('sent_direct', sensor.id, sensor.id, nextID, 0)
+        requests.queue(codec.dataMessage(sensor.id, nextID, destinationID, [sensor.id]))
+    while sensor.held and canRun(sensor, sensor.held[0]):
+        runCommand(sensor, sensor.held.popleft(), client)
+
+#
+# handleWhere()
+# Handles a WHERE, printing the THERE when it comes.
+#
+def handleWhere(nodeID, client):
+    requests.send(codec.where(nodeID), ('THERE',),
+                  lambda there: events.output("THERE {} {} {}".format(there[1], there[2], there[3])))
+
+#
+# handleDataMessage()
+# Handles a DATAMESSAGE the server delivered to the gateway, for the hosted sensor it names
+# as its NextID.
+#
+def handleDataMessage(str_list):
+    originID = str_list[1]
+    sensor_id = str_list[2]
+    destinationID = str_list[3]
+    if sensor_id not in sensors:
+        events.output("gateway: Message from {} to {} for {}, which is not hosted here".format(originID, destinationID, sensor_id))
+    elif(destinationID == sensor_id):
+        events.emit('received', sensor_id, originID, sensor_id)
+    else:
+        events.emit('forwarded', sensor_id, originID, destinationID)
+
+#
+# canRun()
+# Takes a hosted sensor and one of its commands, and returns whether it can go out now: a MOVE
+# waits for the sensor's SENDDATAs to send their DATAMESSAGE from where they were.
+#
+def canRun(sensor, input_array):
+    return not (input_array[0] == 'MOVE' and sensor.sending)
+
+#
+# runCommand()
+# Runs one command of a hosted sensor.
+#
+def runCommand(sensor, input_array, client):
+    if(input_array[0] == 'MOVE' and len(input_array) == 3):
+        sensor.x = input_array[1]
+        sensor.y = input_array[2]
+        sendUpdatePosition(client, sensor)
+    elif(input_array[0] == 'SENDDATA' and len(input_array) == 2):
+        handleSendData(sensor, input_array[1], client)
+    elif(input_array[0] == 'WHERE' and len(input_array) == 2):
+        handleWhere(input_array[1], client)
+    else:
+        events.output('Command not supported. Try again')
+
+#
+# handleStdin()
+# Takes one line of stdin: [SensorID] [Command...], or QUIT.
+#
+def handleStdin(input_message, client):
+    global quitting
+    input_array = input_message.strip().split()
+    if not input_message or input_array[:1] == ['QUIT']:                       # The end of stdin is as good as QUIT
+        quitting = True
+    elif not input_array:
+        return
+    elif input_array[0] not in sensors or len(input_array) < 2:
+        events.output('Command not supported. Try again')
+    else:
+        sensor = sensors[input_array[0]]
+        if not sensor.held and canRun(sensor, input_array[1:]):
+            runCommand(sensor, input_array[1:], client)
+        else:                                                                   # Behind its earlier commands
+            sensor.held.append(input_array[1:])
+
+#
+# negotiate()
+# Takes the connected socket, and asks the server for framing, and binary with --binary. A server
+# that does not answer the HELLO can not host a gateway, which needs both framing and UPDATEPOSITIONS.
+#
+def negotiate(client):
+    global codec
+    wanted = ['framed', 'binary', 'tags'] if 'binary' in options else ['framed', 'tags']
+    accepted = askHello(client, wanted)
+    if accepted is None:
+        print("Error, the control server did not answer HELLO")
+        exit(1)
+    codec = makeCodec(accepted, True)
+
+#
+# readFromCommand()
+# Reads-in the values from the command-line: control address, control port and sensor file.
+#
+def readFromCommand():
+    global control_address, control_port, sensor_file, options, sensors
+    argv, options = splitOptions(sys.argv)
+    if len(argv) != 4:
+        print("Error, correct usage is {} [control address] [control port] [SensorFile] [--binary] [--log-format=text|json] [--log-file=file] [--log-sync]".format(argv[0]))
+        exit(1)
+    control_address = argv[1]
+    control_port = int(argv[2])
+    sensor_file = argv[3]
+    sensors = readSensors(sensor_file)
+
+#
+# runGateway()
+# Connects, joins every sensor, then reads commands from stdin whilst listening on the socket
+# via select(), as hw4_client.py does for one sensor.
+#
+def runGateway():
+    global running, events, requests
+    events = openEventLog(options)
+    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    client.connect((control_address, control_port))
+    inputs = [client, sys.stdin]
+    negotiate(client)
+    client.setblocking(False)
+    requests = RequestQueue(client, codec)
+    if sensors:
+        joinSensors(client)
+
+    while running:
+        events.flush()
+        readable, writable, exceptional = select.select(inputs, [client] if requests.outbound else [], inputs)
+        for i in readable:
+            if i is client:
+                try:
+                    data = i.recv(codec.read_size)
+                except BlockingIOError:
+                    continue
+                except ConnectionResetError:                                    # As good as hanging up
+                    data = b''
+                if not data:                                                    # The server hung up: nothing pending will be answered
+                    inputs.remove(i)
+                    requests.clear()
+                    running = False
+                    break
+                for message in codec.feed(data):
+                    if message[0] == 'DATAMESSAGE':
+                        handleDataMessage(message)
+                    else:
+                        handleReply(message)
+            elif i is sys.stdin:
+                for input_message in readLines(sys.stdin.fileno(), stdin_buffer):
+                    handleStdin(input_message, client)
+                    if quitting:                                                # Nothing after QUIT is read
+                        inputs.remove(sys.stdin)
+                        break
+        if writable and requests.outbound:
+            requests.flush()
+        if requests.gone or (quitting and not requests.pending):                # A send found the server gone, or QUIT has its replies
+            running = False
+    requests.drain()                                                            # The last DATAMESSAGEs may still be on their way out
+    client.close()
+    events.close()
+
+
+#
+# main()
+# Gets the gateway going, calls read-in functions
+#
+if __name__ == '__main__':
+    readFromCommand()
+    runGateway()
@@ -0,0 +1,95 @@
+#
+# hw4_metrics.py
+# Written by: Daniel Dukeshire, Thomas Durkin, Chris Pence, Chris Allen
+# Date: 11.30.2020
+# Counters and latency histograms for the control server (hw4_control.py), read with the
+# STATS command on its stdin or dumped as JSON every few seconds with --stats=[file].
+#
+# Recording a latency is a bucket increment: the histograms keep one bucket per power of two
+# microseconds, so percentiles come back as the upper edge of the bucket they fall in.
+#
+
+import os
+import json
+import time
+
+BUCKETS = 40                                                        # Up to 2**39 us, about six days
+
+#
+# class Histogram
+# The latencies of one command or phase: how many, their total and largest, and how many fell
+# in each bucket. Bucket b holds the latencies under 2**b microseconds that are not in b - 1.
+#
+class Histogram(object):
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * BUCKETS
+
+    def record(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.buckets[min(int(seconds * 1e6).bit_length(), BUCKETS - 1)] += 1
+
+    def percentile(self, percent):                                  # Returns the upper edge of the bucket holding the percentile, in seconds
+        rank = percent / 100.0 * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min((1 << bucket) / 1e6, self.max)
+        return self.max
+
+    def summary(self):
+        if not self.count:
+            return {'count': 0}
+        return {'count': self.count, 'total_ms': self.total * 1e3, 'mean_ms': self.total / self.count * 1e3,
+                'p50_ms': self.percentile(50) * 1e3, 'p99_ms': self.percentile(99) * 1e3, 'max_ms': self.max * 1e3}
+
+#
+# class Metrics
+# Every histogram and counter of the server, by name. gauges is a function returning the values
+# that are read rather than counted (graph size, connections...), called only when they are shown.
+#
+class Metrics(object):
+    def __init__(self, gauges=None):
+        self.started = time.time()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = gauges
+
+    def record(self, name, seconds):                                # Adds one latency to the named histogram
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.record(seconds)
+
+    def count(self, name, amount=1):                                # Adds to the named counter
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def snapshot(self):                                             # Returns everything, as a dictionary ready for JSON
+        return {'time': time.time(), 'uptime_s': time.time() - self.started,
+                'latency': {name: histogram.summary() for name, histogram in sorted(self.histograms.items())},
+                'counters': dict(sorted(self.counters.items())),
+                'gauges': self.gauges() if self.gauges is not None else {}}
+
+    def lines(self):                                                # Returns the snapshot as lines of text, for STATS
+        snapshot = self.snapshot()
+        lines = ['STATS uptime_s={:.1f}'.format(snapshot['uptime_s'])]
+        for name, summary in snapshot['latency'].items():
+            lines.append('STATS {} '.format(name) + ' '.join(
+                '{}={:.3f}'.format(key, value) if isinstance(value, float) else '{}={}'.format(key, value)
+                for key, value in summary.items()))
+        for group in ('counters', 'gauges'):
+            if snapshot[group]:
+                lines.append('STATS {} '.format(group) + ' '.join('{}={}'.format(key, value) for key, value in snapshot[group].items()))
+        return lines
+
+    def dump(self, path):                                           # Writes the snapshot to path as JSON, replacing it whole
+        temporary = path + '.tmp'
+        with open(temporary, 'w') as fp:
+            json.dump(self.snapshot(), fp, indent=2)
+        os.replace(temporary, path)
@@ -0,0 +1,629 @@
+#
+# hw4_protocol.py
+# Written by: Daniel Dukeshire, Thomas Durkin, Chris Pence, Chris Allen
+# Date: 11.30.2020
+# Pieces of the wire protocol shared by the control server (hw4_control.py)
+# and the sensors (hw4_client.py).
+#
+# Framed mode: every message is terminated by a newline, so several messages that
+# arrive in one recv() (or one message split over several) can still be told apart.
+# Without it, each recv() is taken to be exactly one message, as it always was.
+#
+# Binary mode: a client may open with HELLO [Version] [Features...]; the server answers with
+# HELLO [Version] and the features it accepted, and from then on that connection speaks the
+# accepted encoding. With "delta" a move is answered by REACHABLEDELTA, only the entries
+# that changed since the last one (see handleUpdatePosition()). With "binary" every message is a length-prefixed packet, one byte of
+# message type and then struct-packed fields. Node IDs are sent once, in a DEFINE packet that
+# gives them a number, and by number after that; coordinates are packed as int32. Clients that
+# never send HELLO keep the text protocol.
+#
+# Caching: with "cache" a WHERE about a known node is answered THERE [ID] [X] [Y] [Permanent],
+# 1 for a base station, which never moves. The server remembers who was told where each sensor
+# is, and pushes INVALIDATE [Count] [ID]... to them when it moves or changes range; a sensor
+# whose own REACHABLE list went out of date is sent its own ID. Each notice is sent once, until
+# the client asks again. A connection with "cache" is always framed.
+#
+# Pipelining: hw4_client.py and hw4_gateway.py send requests without waiting for the replies to
+# the ones before, and keep them in a RequestQueue. With "tags", agreed only for a framed or
+# binary connection, each request that is answered carries a number, @[Tag] in front of the text
+# or a TAG packet ahead of the binary message, and its reply carries the same number back, so a
+# reply is matched to its request by tag. Without it, nothing on the wire says which request a
+# reply is for: the server answers a connection's requests in the order they were sent, so each
+# reply belongs to the oldest one pending.
+#
+
+import os
+import socket
+import struct
+import itertools
+import collections
+
+FRAME_END = b'\n'
+PACKET_HEADER = struct.Struct('!I')                                 # The length prefix of a packet
+
+HELLO_VERSION = 1                                                   # The protocol version a HELLO announces
+HELLO_TIMEOUT = 2.0                                                 # Seconds a client waits for the HELLO reply before giving up on it
+FEATURES = ('framed', 'binary', 'delta', 'cache', 'tags')          # What a server can agree to in a HELLO
+REPLIES = ('REACHABLE', 'REACHABLEDELTA', 'REACHABLES', 'THERE')    # The messages that answer a request, which "tags" tags
+
+(DEFINE, UPDATEPOSITION, REACHABLE, WHERE, THERE, DATAMESSAGE,      # The binary message types
+ REACHABLEDELTA, RESYNC, UPDATEPOSITIONS, REACHABLES, INVALIDATE, TAG) = range(12)
+DEFINE_HEAD = struct.Struct('!BI')                                  # Type, number; the rest is the ID in UTF-8
+UPDATE_BODY = struct.Struct('!BIdii')                               # Type, sensor, range, x, y
+REACHABLE_HEAD = struct.Struct('!BI')                               # Type, count; then count entries of
+ENTRY = struct.Struct('!Iii')                                       # node, x, y
+WHERE_BODY = struct.Struct('!BI')                                   # Type, node
+THERE_BODY = struct.Struct('!BIii')                                 # Type, node, x, y
+THERE_CACHE_BODY = struct.Struct('!BIii?')                          # Type, node, x, y, permanent, for "cache"
+DATA_HEAD = struct.Struct('!BIIII')                                 # Type, origin, next, destination, hop count; then the hops
+DELTA_HEAD = struct.Struct('!BI?II')                                # Type, sequence, full, added count, removed count; then the entries and the removed nodes
+RESYNC_BODY = struct.Struct('!BI')                                  # Type, sensor
+BATCH_HEAD = struct.Struct('!BI')                                   # Type, count; then count moves or replies
+MOVE = struct.Struct('!Idii')                                       # sensor, range, x, y
+TAG_BODY = struct.Struct('!BI')                                     # Type, tag, for the message after it
+REPLY_HEAD = struct.Struct('!II')                                   # sensor, count; then count entries
+INVALIDATE_HEAD = struct.Struct('!BI')                              # Type, count; then count nodes
+
+#
+# class FrameReader
+# A per-connection receive buffer. Bytes are fed in as they arrive, and every
+# complete frame is handed back; a partial frame waits for the rest of its bytes.
+#
+class FrameReader(object):
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):                                           # Adds the bytes read off the socket, returns the complete frames
+        self.buffer += data
+        end = self.buffer.rfind(FRAME_END)
+        if end == -1:                                               # Nothing finished yet
+            return []
+        frames = bytes(self.buffer[:end]).split(FRAME_END)
+        del self.buffer[:end + 1]
+        return [frame for frame in frames if frame.strip()]         # Blank lines carry no command
+
+#
+# class PacketReader
+# The receive buffer for length-prefixed packets: a 4 byte big-endian length, then that many
+# bytes. Used where the payload itself may contain newlines.
+#
+class PacketReader(object):
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):                                           # Adds the bytes read off the socket, returns the complete packets
+        self.buffer += data
+        packets = []
+        start = 0
+        while len(self.buffer) - start >= PACKET_HEADER.size:
+            length, = PACKET_HEADER.unpack_from(self.buffer, start)
+            end = start + PACKET_HEADER.size + length
+            if end > len(self.buffer):                              # The rest of this one has not arrived yet
+                break
+            packets.append(bytes(self.buffer[start + PACKET_HEADER.size:end]))
+            start = end
+        del self.buffer[:start]
+        return packets
+
+#
+# packet()
+# Takes a payload of bytes, and returns it with its length prefix.
+#
+def packet(payload):
+    return PACKET_HEADER.pack(len(payload)) + payload
+
+#
+# frame()
+# Takes a message string, and returns the bytes to put on the wire for it.
+#
+def frame(message, framed):
+    data = message.encode('utf-8')
+    if framed:
+        data += FRAME_END
+    return data
+
+#
+# class Tagged
+# A reply decoded with the tag of the request it answers: the message's list, and its tag.
+#
+class Tagged(list):
+    def __init__(self, message, tag):
+        list.__init__(self, message)
+        self.tag = tag
+
+#
+# class Tagging
+# What both codecs do with "tags". A server's codec keeps the tags of the requests it decoded,
+# oldest first, and puts the oldest on the next reply it encodes: the server answers in order,
+# so that is the request the reply is for. On a client, a tagged reply is decoded as a Tagged
+# message, for its RequestQueue to match by tag.
+#
+class Tagging(object):
+    def untag(self, tag, message):                                  # Takes the tag that came with a message, and returns the message
+        if message and message[0] in REPLIES:
+            return Tagged(message, tag)
+        self.tags.append(tag)
+        return message
+
+    def reply(self, data):                                          # Takes an encoded reply, and returns it with the oldest request tag
+        if not self.tags:
+            return data
+        return self.tag(self.tags.popleft(), data)
+
+#
+# class TextCodec
+# The encoding of one connection that speaks the text protocol. The message methods
+# return the bytes to send; feed() takes the bytes read and returns the messages in them,
+# each as its list of strings, e.g. ['WHERE', 'base_station_a']. A REACHABLE comes back as
+# ['REACHABLE', count, [(id, x, y), ...]], the same as from a BinaryCodec, and so does
+# a REACHABLEDELTA, as ['REACHABLEDELTA', sequence, full, [(id, x, y), ...], [removed ids]].
+# UPDATEPOSITIONS and REACHABLES come back as [name, count, [(id, ...), ...]] too, and an
+# INVALIDATE as ['INVALIDATE', count, [ids]].
+#
+class TextCodec(Tagging):
+    binary = False
+
+    def __init__(self, framed, features=()):
+        self.framed = framed
+        self.features = set(features)                               # What was agreed in the HELLO
+        self.tags = collections.deque()                             # With "tags", those of the requests not answered yet
+        self.reader = FrameReader() if framed else None
+        self.read_size = 65536 if framed else 1024                  # Unframed, one recv() has always been one message
+
+    def feed(self, data):                                           # Adds the bytes read off the socket, returns the messages
+        if not self.framed:
+            return [self.decode(data)]
+        return [self.decode(message) for message in self.reader.feed(data)]
+
+    def decode(self, data):
+        if data.startswith(b'@') and 'tags' in self.features:       # @[Tag] [Message]
+            tag, _, data = data.partition(b' ')
+            return self.untag(int(tag[1:]), self.decode(data))
+        str_list = data.decode('utf-8').split()
+        if str_list and str_list[0] == 'REACHABLE':
+            return parseReachable(str_list)
+        if str_list and str_list[0] == 'REACHABLEDELTA':
+            return parseReachableDelta(str_list)
+        if str_list and str_list[0] == 'UPDATEPOSITIONS':
+            return parseUpdatePositions(str_list)
+        if str_list and str_list[0] == 'REACHABLES':
+            return parseReachables(str_list)
+        if str_list and str_list[0] == 'INVALIDATE':
+            return ['INVALIDATE', int(str_list[1]), str_list[2:2 + int(str_list[1])]]
+        return str_list
+
+    def encode(self, message):
+        return frame(message, self.framed)
+
+    def tag(self, tag, data):                                       # Takes an encoded message, and returns it tagged
+        return b'@%d ' % tag + data
+
+    def updatePosition(self, id, sensor_range, x, y):
+        return self.encode("UPDATEPOSITION {} {} {} {}".format(id, sensor_range, x, y))
+
+    def reachable(self, entries):                                   # Takes a list of (id, x, y)
+        reachable_list = ["{} {} {}".format(id, x, y) for id, x, y in entries]
+        return self.reply(self.encode("REACHABLE {} {}".format(len(reachable_list), reachable_list)))
+
+    def reachableEntries(self, entries):                            # Takes the repr() of each "[ID] [X] [Y]", as the shards send them
+        return self.reply(self.encode("REACHABLE {} [{}]".format(len(entries), ', '.join(entries))))
+
+    def reachableDelta(self, sequence, full, added, removed):     # REACHABLEDELTA [Seq] [Full] [NumAdded] [ID X Y]... [NumRemoved] [ID]...
+        fields = ['REACHABLEDELTA', str(sequence), str(int(full)), str(len(added))]
+        for id, x, y in added:
+            fields += (id, str(x), str(y))
+        fields.append(str(len(removed)))
+        fields += removed
+        return self.reply(self.encode(' '.join(fields)))
+
+    def resync(self, id):
+        return self.encode("RESYNC {}".format(id))
+
+    def updatePositions(self, moves):                               # UPDATEPOSITIONS [Count] ([SensorID] [SensorRange] [X] [Y])...
+        fields = ['UPDATEPOSITIONS', str(len(moves))]
+        for id, sensor_range, x, y in moves:
+            fields += (id, str(sensor_range), str(x), str(y))
+        return self.encode(' '.join(fields))
+
+    def reachables(self, replies):                                  # REACHABLES [Count] ([SensorID] [NumReachable] ([ID] [X] [Y])...)...
+        fields = ['REACHABLES', str(len(replies))]
+        for sensor, entries in replies:
+            fields += (sensor, str(len(entries)))
+            for id, x, y in entries:
+                fields += (id, str(x), str(y))
+        return self.reply(self.encode(' '.join(fields)))
+
+    def where(self, id):
+        return self.encode("WHERE {}".format(id))
+
+    def there(self, id, x, y, permanent=None):                     # permanent is only sent to "cache" connections
+        if permanent is None:
+            return self.reply(self.encode("THERE {} {} {}".format(id, x, y)))
+        return self.reply(self.encode("THERE {} {} {} {}".format(id, x, y, int(permanent))))
+
+    def invalidate(self, ids):                                      # INVALIDATE [Count] [ID]...
+        return self.encode(' '.join(['INVALIDATE', str(len(ids))] + list(ids)))
+
+    def dataMessage(self, originID, nextID, destinationID, hops):
+        return self.encode("DATAMESSAGE {} {} {} {} {}".format(originID, nextID, destinationID, len(hops), hops))
+
+    def dataMessageParts(self, originID, nextID, destinationID, hops):  # (what later messages need, the message), see BinaryCodec
+        return b'', self.dataMessage(originID, nextID, destinationID, hops)
+
+#
+# class BinaryCodec
+# The encoding of one connection that agreed to "binary" in its HELLO. Has the same methods
+# as TextCodec. Each side numbers the IDs it sends, so a codec keeps the numbers it handed
+# out and the ones the other side defined.
+#
+class BinaryCodec(Tagging):
+    binary = True
+    framed = True
+    read_size = 65536
+
+    def __init__(self, features=()):
+        self.features = set(features)
+        self.reader = PacketReader()
+        self.numbers = {}                                           # ID: the number we defined it as
+        self.names = []                                             # The IDs the other side defined, by number
+        self.tags = collections.deque()                             # With "tags", those of the requests not answered yet
+        self.next_tag = None                                        # The tag of a TAG packet, for the next message
+
+    def feed(self, data):
+        messages = []
+        for payload in self.reader.feed(data):
+            message = self.decode(payload)
+            if message is not None:                                 # DEFINEs and TAGs only set up later messages
+                if self.next_tag is not None:
+                    message = self.untag(self.next_tag, message)
+                    self.next_tag = None
+                messages.append(message)
+        return messages
+
+    def tag(self, tag, data):
+        return packet(TAG_BODY.pack(TAG, tag)) + data
+
+    def intern(self, id, out):                                      # Returns the number for an ID, defining it first if it is new
+        number = self.numbers.get(id)
+        if number is None:
+            number = self.numbers[id] = len(self.numbers)
+            name = str(id).encode('utf-8')
+            out.append(packet(DEFINE_HEAD.pack(DEFINE, number) + name))
+        return number
+
+    def decode(self, payload):
+        kind = payload[0]
+        names = self.names
+        if kind == DEFINE:
+            number, = struct.unpack_from('!I', payload, 1)
+            name = payload[DEFINE_HEAD.size:].decode('utf-8')
+            if number == len(names):
+                names.append(name)
+            else:
+                names[number] = name
+            return None
+        if kind == TAG:
+            _, self.next_tag = TAG_BODY.unpack(payload)
+            return None
+        if kind == UPDATEPOSITION:
+            _, id, sensor_range, x, y = UPDATE_BODY.unpack(payload)
+            return ['UPDATEPOSITION', names[id], sensor_range, x, y]
+        if kind == REACHABLE:
+            _, count = REACHABLE_HEAD.unpack_from(payload)
+            fields = struct.unpack_from('!' + 'Iii' * count, payload, REACHABLE_HEAD.size)
+            return ['REACHABLE', count, [(names[fields[n]], fields[n + 1], fields[n + 2]) for n in range(0, 3 * count, 3)]]
+        if kind == WHERE:
+            _, id = WHERE_BODY.unpack(payload)
+            return ['WHERE', names[id]]
+        if kind == THERE:
+            if len(payload) == THERE_CACHE_BODY.size:
+                _, id, x, y, permanent = THERE_CACHE_BODY.unpack(payload)
+                return ['THERE', names[id], x, y, permanent]
+            _, id, x, y = THERE_BODY.unpack(payload)
+            return ['THERE', names[id], x, y]
+        if kind == DATAMESSAGE:
+            _, origin, next, destination, count = DATA_HEAD.unpack_from(payload)
+            hops = struct.unpack_from('!' + 'I' * count, payload, DATA_HEAD.size)
+            return ['DATAMESSAGE', names[origin], names[next], names[destination], count, [names[hop] for hop in hops]]
+        if kind == REACHABLEDELTA:
+            _, sequence, full, added, removed = DELTA_HEAD.unpack_from(payload)
+            fields = struct.unpack_from('!' + 'Iii' * added + 'I' * removed, payload, DELTA_HEAD.size)
+            entries = [(names[fields[n]], fields[n + 1], fields[n + 2]) for n in range(0, 3 * added, 3)]
+            return ['REACHABLEDELTA', sequence, full, entries, [names[id] for id in fields[3 * added:]]]
+        if kind == RESYNC:
+            _, id = RESYNC_BODY.unpack(payload)
+            return ['RESYNC', names[id]]
+        if kind == UPDATEPOSITIONS:
+            _, count = BATCH_HEAD.unpack_from(payload)
+            moves = []
+            for id, sensor_range, x, y in MOVE.iter_unpack(payload[BATCH_HEAD.size:BATCH_HEAD.size + count * MOVE.size]):
+                moves.append((names[id], sensor_range, x, y))
+            return ['UPDATEPOSITIONS', count, moves]
+        if kind == REACHABLES:
+            _, count = BATCH_HEAD.unpack_from(payload)
+            offset = BATCH_HEAD.size
+            replies = []
+            for n in range(count):
+                sensor, entries = REPLY_HEAD.unpack_from(payload, offset)
+                offset += REPLY_HEAD.size
+                fields = struct.unpack_from('!' + 'Iii' * entries, payload, offset)
+                offset += ENTRY.size * entries
+                replies.append((names[sensor], [(names[fields[k]], fields[k + 1], fields[k + 2]) for k in range(0, 3 * entries, 3)]))
+            return ['REACHABLES', count, replies]
+        if kind == INVALIDATE:
+            _, count = INVALIDATE_HEAD.unpack_from(payload)
+            return ['INVALIDATE', count, [names[id] for id in struct.unpack_from('!' + 'I' * count, payload, INVALIDATE_HEAD.size)]]
+        raise ValueError('unknown binary message type {}'.format(kind))
+
+    def updatePosition(self, id, sensor_range, x, y):
+        out = []
+        body = UPDATE_BODY.pack(UPDATEPOSITION, self.intern(id, out), float(sensor_range), int(x), int(y))
+        out.append(packet(body))
+        return b''.join(out)
+
+    def reachable(self, entries):
+        out = []
+        fields = []
+        for id, x, y in entries:
+            fields += (self.intern(id, out), x, y)
+        body = REACHABLE_HEAD.pack(REACHABLE, len(entries)) + struct.pack('!' + 'Iii' * len(entries), *fields)
+        out.append(packet(body))
+        return self.reply(b''.join(out))
+
+    def reachableDelta(self, sequence, full, added, removed):
+        out = []
+        fields = []
+        for id, x, y in added:
+            fields += (self.intern(id, out), x, y)
+        fields += [self.intern(id, out) for id in removed]
+        body = DELTA_HEAD.pack(REACHABLEDELTA, sequence, full, len(added), len(removed))
+        out.append(packet(body + struct.pack('!' + 'Iii' * len(added) + 'I' * len(removed), *fields)))
+        return self.reply(b''.join(out))
+
+    def resync(self, id):
+        out = []
+        out.append(packet(RESYNC_BODY.pack(RESYNC, self.intern(id, out))))
+        return b''.join(out)
+
+    def updatePositions(self, moves):
+        out = []
+        body = [BATCH_HEAD.pack(UPDATEPOSITIONS, len(moves))]
+        for id, sensor_range, x, y in moves:
+            body.append(MOVE.pack(self.intern(id, out), float(sensor_range), int(x), int(y)))
+        out.append(packet(b''.join(body)))
+        return b''.join(out)
+
+    def reachables(self, replies):
+        out = []
+        body = [BATCH_HEAD.pack(REACHABLES, len(replies))]
+        for sensor, entries in replies:
+            fields = []
+            for id, x, y in entries:
+                fields += (self.intern(id, out), x, y)
+            body.append(REPLY_HEAD.pack(self.intern(sensor, out), len(entries)))
+            body.append(struct.pack('!' + 'Iii' * len(entries), *fields))
+        out.append(packet(b''.join(body)))
+        return self.reply(b''.join(out))
+
+    def where(self, id):
+        out = []
+        out.append(packet(WHERE_BODY.pack(WHERE, self.intern(id, out))))
+        return b''.join(out)
+
+    def there(self, id, x, y, permanent=None):
+        out = []
+        if permanent is None:
+            out.append(packet(THERE_BODY.pack(THERE, self.intern(id, out), int(x), int(y))))
+        else:
+            out.append(packet(THERE_CACHE_BODY.pack(THERE, self.intern(id, out), int(x), int(y), permanent)))
+        return self.reply(b''.join(out))
+
+    def invalidate(self, ids):
+        out = []
+        numbers = [self.intern(id, out) for id in ids]
+        out.append(packet(INVALIDATE_HEAD.pack(INVALIDATE, len(numbers)) + struct.pack('!' + 'I' * len(numbers), *numbers)))
+        return b''.join(out)
+
+    def dataMessage(self, originID, nextID, destinationID, hops):
+        return b''.join(self.dataMessageParts(originID, nextID, destinationID, hops))
+
+    def dataMessageParts(self, originID, nextID, destinationID, hops):  # The DEFINEs of new IDs, which must arrive even if the message does not, and the message
+        out = []
+        numbers = [self.intern(id, out) for id in [originID, nextID, destinationID] + list(hops)]
+        body = DATA_HEAD.pack(DATAMESSAGE, numbers[0], numbers[1], numbers[2], len(hops)) + struct.pack('!' + 'I' * len(hops), *numbers[3:])
+        return b''.join(out), packet(body)
+
+#
+# parseReachable()
+# Takes the list of strings of a text REACHABLE [NumReachable] [ReachableList], where the list is
+# printed like ['id x y', ...], and returns ['REACHABLE', count, [(id, x, y), ...]].
+#
+def parseReachable(str_list):
+    count = int(str_list[1])
+    fields = [field.strip('[],\'"') for field in str_list[2:2 + 3 * count]]
+    return ['REACHABLE', count, [(fields[n], int(fields[n + 1]), int(fields[n + 2])) for n in range(0, 3 * count, 3)]]
+
+#
+# parseReachableDelta()
+# Takes the list of strings of a text REACHABLEDELTA, and returns
+# ['REACHABLEDELTA', sequence, full, [(id, x, y), ...], [removed ids]].
+#
+def parseReachableDelta(str_list):
+    added = int(str_list[3])
+    fields = str_list[4:4 + 3 * added]
+    entries = [(fields[n], int(fields[n + 1]), int(fields[n + 2])) for n in range(0, 3 * added, 3)]
+    removed = str_list[5 + 3 * added:5 + 3 * added + int(str_list[4 + 3 * added])]
+    return ['REACHABLEDELTA', int(str_list[1]), str_list[2] == '1', entries, removed]
+
+#
+# parseUpdatePositions()
+# Takes the list of strings of a text UPDATEPOSITIONS, and returns
+# ['UPDATEPOSITIONS', count, [(id, range, x, y), ...]], the fields still strings.
+#
+def parseUpdatePositions(str_list):
+    count = int(str_list[1])
+    fields = str_list[2:2 + 4 * count]
+    return ['UPDATEPOSITIONS', count, [tuple(fields[n:n + 4]) for n in range(0, 4 * count, 4)]]
+
+#
+# parseReachables()
+# Takes the list of strings of a text REACHABLES, and returns
+# ['REACHABLES', count, [(sensor, [(id, x, y), ...]), ...]].
+#
+def parseReachables(str_list):
+    count = int(str_list[1])
+    position = 2
+    replies = []
+    for n in range(count):
+        sensor = str_list[position]
+        entries = int(str_list[position + 1])
+        fields = str_list[position + 2:position + 2 + 3 * entries]
+        replies.append((sensor, [(fields[k], int(fields[k + 1]), int(fields[k + 2])) for k in range(0, 3 * entries, 3)]))
+        position += 2 + 3 * entries
+    return ['REACHABLES', count, replies]
+
+#
+# hello()
+# Takes the features to ask for (or, from the server, the ones accepted), and returns the HELLO
+# to send. It is always framed, and is text whatever comes after it, so any client can read it.
+#
+def hello(features):
+    return frame(' '.join(['HELLO', str(HELLO_VERSION)] + list(features)), True)
+
+#
+# askHello()
+# Takes a connected, blocking socket and the features to ask for, sends HELLO and waits for the
+# answer. Returns the features the server accepted, or None if it did not answer in time, as a
+# server that ignores HELLO would not.
+#
+def askHello(sock, features):
+    sock.sendall(hello(features))
+    reader = FrameReader()
+    reply = []
+    sock.settimeout(HELLO_TIMEOUT)
+    try:
+        while not reply:
+            data = sock.recv(1024)
+            if not data:
+                break
+            reply = reader.feed(data)
+    except socket.timeout:
+        pass
+    sock.settimeout(None)
+    if not reply:
+        return None
+    return reply[0].decode().split()[2:]
+
+#
+# class RequestQueue
+# A client's side of its connection to the server, once it no longer blocks.
+# Pending: the requests sent and not answered yet, oldest first: Tag: (reply kinds, on_reply).
+# Every request is numbered, but the number only goes on the wire with "tags".
+# Outbound: the bytes the socket has not taken yet, sent as select() reports it writable
+# Gone: whether the server closed or reset the connection, after which nothing is sent
+#
+class RequestQueue(object):
+    def __init__(self, sock, codec):
+        self.sock = sock
+        self.codec = codec
+        self.tagged = 'tags' in codec.features
+        self.pending = collections.OrderedDict()
+        self.tags = itertools.count(1)
+        self.outbound = bytearray()
+        self.gone = False
+
+    def send(self, data, kinds, on_reply):                          # Sends a request; on_reply gets the message, of one of kinds, that answers it
+        if self.gone:                                               # It would never be answered
+            return
+        tag = next(self.tags)
+        self.pending[tag] = (kinds, on_reply)
+        self.queue(self.codec.tag(tag, data) if self.tagged else data)
+
+    def queue(self, data):                                          # Sends bytes that are not answered, such as a DATAMESSAGE
+        self.outbound.extend(data)
+        self.flush()
+
+    def flush(self):                                                # Sends as much of outbound as the socket takes now
+        if self.gone:
+            return
+        try:
+            sent = self.sock.send(self.outbound)
+        except BlockingIOError:
+            return
+        except (BrokenPipeError, ConnectionResetError):             # The caller finds gone set, and hangs up
+            self.clear()
+            return
+        del self.outbound[:sent]
+
+    def answer(self, message):                                      # Hands a reply to the request it answers, False if it answers none
+        if isinstance(message, Tagged):
+            tag = message.tag
+        elif self.pending and not self.tagged:                      # Untagged, so it is for the oldest
+            tag = next(iter(self.pending))
+        else:
+            return False
+        if message[0] not in self.pending.get(tag, ((),))[0]:
+            return False
+        kinds, on_reply = self.pending.pop(tag)
+        on_reply(message)
+        return True
+
+    def clear(self):                                                # Once the server is gone: nothing pending will be answered
+        self.pending.clear()
+        self.outbound.clear()
+        self.gone = True
+
+    def drain(self):                                                # At QUIT, blocks until the last of outbound is sent
+        if not self.outbound:
+            return
+        self.sock.setblocking(True)
+        try:
+            self.sock.sendall(self.outbound)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        self.outbound.clear()
+
+#
+# readLines()
+# Takes a file descriptor, stdin's, and the bytearray holding the start of a line whose end has not
+# been read yet. Reads what it has, and returns the complete lines in it, with '' at the end of the
+# input. It is read straight from the descriptor rather than with readline(), whose buffer would
+# keep the other lines a script sent at once where select() does not see them.
+#
+def readLines(fd, buffer):
+    data = os.read(fd, 65536)
+    if not data:                                                    # A last line without its newline, then the end
+        lines = [bytes(buffer).decode() + '\n'] if buffer.strip() else []
+        buffer.clear()
+        return lines + ['']
+    buffer.extend(data)
+    end = buffer.rfind(b'\n') + 1
+    lines = bytes(buffer[:end]).decode().splitlines(True)
+    del buffer[:end]
+    return lines
+
+#
+# makeCodec()
+# Takes the features a connection agreed to in its HELLO (or none, for one that never sent one)
+# and the server's own --framed, and returns the codec for it.
+#
+def makeCodec(features, framed):
+    if 'binary' in features:
+        return BinaryCodec(features)
+    return TextCodec(framed or 'framed' in features, features)
+
+#
+# splitOptions()
+# Takes the command-line arguments, and pulls out the optional --name or --name=value flags.
+# Returns the remaining positional arguments and a dictionary of the flags.
+#
+def splitOptions(argv):
+    positional = []
+    options = {}
+    for arg in argv:
+        if arg.startswith('--'):
+            name, _, value = arg[2:].partition('=')
+            options[name] = value if value else True
+        else:
+            positional.append(arg)
+    return positional, options
@@ -0,0 +1,217 @@
+#
+# hw4_topology.py
+# Written by: Daniel Dukeshire, Thomas Durkin, Chris Pence, Chris Allen
+# Date: 11.30.2020
+# Reading the base station file for the control server (hw4_control.py).
+#
+# Each line of the file is [BaseID] [XPos] [YPos] [NumLinks] [Links...]. It is read into a
+# Topology: every ID interned to a number, the base stations first in the order of their first
+# line, then the IDs that only appear as links. A station listed twice keeps its first position
+# and the links of all its lines.
+#
+# Snapshots: the first time a file is read, its Topology is also written next to it as
+# [file].snapshot, a binary file of the IDs, the coordinates and the links in CSR form (every
+# station's links one after the other, with an offset where each station's start). While the
+# file keeps the size and modification time recorded in the snapshot, later starts memory-map
+# the snapshot instead of parsing the text.
+#
+
+import os
+import mmap
+import math
+import struct
+import bisect
+
+SNAPSHOT_SUFFIX = '.snapshot'
+SNAPSHOT_MAGIC = b'HW4T'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct('<4sIIqqqqqqq')             # Magic, version, width, file size, file mtime_ns, stations, IDs, links, lowest x, highest x
+# Then, all little-endian: the IDs' end offsets into the name bytes (IDs), the stations' x and
+# y (stations each) and the end offset of each station's links (stations), all of them int32, or
+# int64 (width 8) if any does not fit; then the links as ID numbers (int32 * links), and the IDs
+# in UTF-8, one after the other.
+INT32 = 1 << 31
+
+#
+# class Topology
+# The base stations of a file:
+# Names: every ID, the stations' first
+# Count: how many of the names are stations
+# Xs, Ys: each station's coordinates
+# Ends: where each station's links end in Links, which holds the ID number of every link
+# Low, High: the lowest and highest x of any line of the file, which the sharded server splits
+# Xs, Ys, Ends and Links are lists for a parsed file, and views of the mapped file for a snapshot.
+#
+class Topology(object):
+    def __init__(self, names, count, xs, ys, ends, links, low, high):
+        self.names = names
+        self.count = count
+        self.xs = xs
+        self.ys = ys
+        self.ends = ends
+        self.links = links
+        self.low = low
+        self.high = high
+
+    def stations(self):                                     # Yields (BaseId, XPos, YPos, [Links]) of each station, in order
+        names = self.names
+        links = self.links
+        start = 0
+        for n, end in enumerate(self.ends):
+            yield names[n], self.xs[n], self.ys[n], [names[link] for link in links[start:end]]
+            start = end
+
+    def spacing(self, samples=1001):                        # Returns the median length of up to samples links between stations,
+        lengths = []                                        # spread evenly over the file; without any, the side of the square
+        step = max(1, len(self.links) // samples)
+        for k in range(0, len(self.links), step):
+            link = self.links[k]
+            if link < self.count:                           # Links to IDs with no line of their own have no position
+                n = bisect.bisect_right(self.ends, k)       # The station whose links k is among
+                length = math.hypot(self.xs[n] - self.xs[link], self.ys[n] - self.ys[link])
+                if length > 0:
+                    lengths.append(length)
+        if not lengths:                                     # each station would have to itself, or None for fewer than two
+            if self.count < 2:
+                return None
+            area = (max(self.xs) - min(self.xs) + 1) * (max(self.ys) - min(self.ys) + 1)
+            return math.sqrt(area / self.count)
+        lengths.sort()
+        return lengths[len(lengths) // 2]
+
+#
+# parseTopology()
+# Takes a file pointer to a base station file, and reads it into a Topology one line at a time.
+#
+def parseTopology(fp):
+    stations = {}                                           # BaseId: (XPos, YPos, {Links}), in the order of their first lines
+    low = high = None
+    for line in fp:
+        inputs = line.split()
+        if not inputs:                                      # Blank lines, e.g. at the end of the file
+            continue
+        XPos = int(inputs[1])
+        YPos = int(inputs[2])
+        if low is None or XPos < low:
+            low = XPos
+        if high is None or XPos > high:
+            high = XPos
+        station = stations.get(inputs[0])
+        if station is None:
+            stations[inputs[0]] = (XPos, YPos, dict.fromkeys(inputs[4:]))
+        else:                                               # A later line for the same station only adds links
+            station[2].update(dict.fromkeys(inputs[4:]))
+    index = {BaseId: n for n, BaseId in enumerate(stations)}
+    names = list(stations)
+    xs = []
+    ys = []
+    ends = []
+    links = []
+    for XPos, YPos, edges in stations.values():
+        xs.append(XPos)
+        ys.append(YPos)
+        for edge in edges:
+            if edge not in index:                           # Only ever a link, so it goes after the stations
+                index[edge] = len(names)
+                names.append(edge)
+            links.append(index[edge])
+        ends.append(len(links))
+    return Topology(names, len(stations), xs, ys, ends, links, low or 0, high or 0)
+
+#
+# narrow()
+# Takes a list of ints, and returns whether they all fit in an int32.
+#
+def narrow(values):
+    return not values or (-INT32 <= min(values) and max(values) < INT32)
+
+#
+# writeSnapshot()
+# Takes the path of a snapshot, the os.stat() of the file it was read from and its Topology, and
+# writes the snapshot. It is written to a temporary file and renamed into place, so a reader never
+# sees half of one.
+#
+def writeSnapshot(path, stat, topology):
+    encoded = [name.encode('utf-8') for name in topology.names]
+    offsets = []
+    end = 0
+    for name in encoded:
+        end += len(name)
+        offsets.append(end)
+    count = topology.count
+    code = 'i' if narrow(offsets) and narrow(topology.xs) and narrow(topology.ys) else 'q'
+    header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, struct.calcsize(code), stat.st_size, stat.st_mtime_ns,
+                                  count, len(encoded), len(topology.links), topology.low, topology.high)
+    temporary = path + '.tmp'
+    try:
+        with open(temporary, 'wb') as fp:
+            fp.write(header)
+            fp.write(struct.pack('<{}{}'.format(len(offsets), code), *offsets))
+            fp.write(struct.pack('<{}{}'.format(count, code), *topology.xs))
+            fp.write(struct.pack('<{}{}'.format(count, code), *topology.ys))
+            fp.write(struct.pack('<{}{}'.format(count, code), *topology.ends))
+            fp.write(struct.pack('<{}i'.format(len(topology.links)), *topology.links))
+            fp.write(b''.join(encoded))
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+#
+# readSnapshot()
+# Takes the path of a snapshot and the os.stat() of the file it should match. Returns its Topology,
+# or None if there is no snapshot or it was made from a different version of the file.
+#
+def readSnapshot(path, stat):
+    try:
+        with open(path, 'rb') as fp:
+            data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):                           # Missing, unreadable or empty
+        return None
+    if len(data) < SNAPSHOT_HEADER.size:
+        return None
+    magic, version, width, size, mtime_ns, count, names, links, low, high = SNAPSHOT_HEADER.unpack_from(data)
+    if (magic, version, size, mtime_ns) != (SNAPSHOT_MAGIC, SNAPSHOT_VERSION, stat.st_size, stat.st_mtime_ns):
+        return None
+    position = SNAPSHOT_HEADER.size
+    if width not in (4, 8) or len(data) < position + width * (names + 3 * count) + 4 * links:  # Cut short
+        return None
+    code = 'i' if width == 4 else 'q'
+    view = memoryview(data)
+    sections = []
+    for length, section_code, section_width in ((names, code, width), (count, code, width), (count, code, width),
+                                                (count, code, width), (links, 'i', 4)):
+        sections.append(view[position:position + length * section_width].cast(section_code))
+        position += length * section_width
+    offsets, xs, ys, ends, links = sections
+    text = bytes(view[position:])
+    if len(text) != (offsets[-1] if names else 0):          # Cut short
+        return None
+    start = 0
+    decoded = []
+    for end in offsets.tolist():
+        decoded.append(text[start:end].decode('utf-8'))
+        start = end
+    return Topology(decoded, count, xs, ys, ends, links, low, high)
+
+#
+# loadTopology()
+# Takes the path of a base station file, and returns its Topology: from its snapshot when that
+# is up to date, or else parsed from the text, writing the snapshot for next time. With
+# snapshot=False the text is always parsed, and no snapshot is written.
+#
+def loadTopology(path, snapshot=True):
+    stat = os.stat(path)
+    if snapshot:
+        topology = readSnapshot(path + SNAPSHOT_SUFFIX, stat)
+        if topology is not None:
+            return topology
+    with open(path) as fp:
+        topology = parseTopology(fp)
+    if snapshot:
+        try:
+            writeSnapshot(path + SNAPSHOT_SUFFIX, stat, topology)
+        except (OSError, struct.error):                     # A read-only directory, or coordinates past 64 bits: just parse next time too
+            pass
+    return topology